@@ -1,8 +1,9 @@
-import os
+import os, json
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
 from .clinical_data.clinical_data_loader import load_clinical_data
-from .utils import find_max_shape, rescale_outliers
+from .utils import find_max_shape, rescale_outliers, PRECISION
 
 # provided a given directory return list of paths to ct_sequences and lesion_maps
 def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences, mri_label_sequences, brain_mask_name):
@@ -100,8 +101,9 @@ def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences,
 # - ct_paths : list of lists of paths of channels
 # - lesion_paths : list of paths of lesions maps
 # - brain_mask_paths : list of paths of ct brain masks
+# - n_workers : number of threads loading subjects concurrently
 # - return three lists containing image data for cts (as 4D array), brain masks and lesion_maps
-def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution = False):
+def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution = False, n_workers = 4):
     if len(ct_paths) != len(ct_lesion_paths):
         raise ValueError('Number of CT and number of lesions maps should be the same.', len(ct_paths), len(ct_lesion_paths))
 
@@ -114,11 +116,11 @@ def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_ma
     ct_n_c = len(ct_paths[0])
     print(ct_n_c, 'CT channels found.')
 
-    ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c))
+    ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c), dtype = PRECISION['inputs'])
     if len(first_image_data.shape) == 4:
-        ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c, n_t))
-    ct_lesion_outputs = np.empty((len(ct_lesion_paths), n_x, n_y, n_z))
-    brain_masks = np.empty((len(ct_lesion_paths), n_x, n_y, n_z), dtype = bool)
+        ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c, n_t), dtype = PRECISION['inputs'])
+    ct_lesion_outputs = np.empty((len(ct_lesion_paths), n_x, n_y, n_z), dtype = PRECISION['labels'])
+    brain_masks = np.empty((len(ct_lesion_paths), n_x, n_y, n_z), dtype = PRECISION['masks'])
 
     # get MRI dimensions by extracting first image
     if mri_paths[0]:
@@ -128,20 +130,20 @@ def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_ma
         mri_n_c = len(mri_paths[0])
         print(mri_n_c, 'MRI channels found.')
 
-        mri_inputs = np.empty((len(mri_paths), mri_n_x, mri_n_y, mri_n_z, mri_n_c))
-        mri_lesion_outputs = np.empty((len(mri_lesion_paths), mri_n_x, mri_n_y, mri_n_z))
+        mri_inputs = np.empty((len(mri_paths), mri_n_x, mri_n_y, mri_n_z, mri_n_c), dtype = PRECISION['inputs'])
+        mri_lesion_outputs = np.empty((len(mri_lesion_paths), mri_n_x, mri_n_y, mri_n_z), dtype = PRECISION['labels'])
 
     # for high res images not all images have the same shape
     if high_resolution:
         data_dir = '/'.join(ct_paths[0][0].split('/')[:-3])
         max_shape_x, max_shape_y, max_shape_z = find_max_shape(data_dir, 'coreg_Tmax')
-        ct_inputs = np.empty((len(ct_paths), max_shape_x, max_shape_y, max_shape_z, ct_n_c))
-        ct_lesion_outputs = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z))
-        brain_masks = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z), dtype=bool)
+        ct_inputs = np.empty((len(ct_paths), max_shape_x, max_shape_y, max_shape_z, ct_n_c), dtype = PRECISION['inputs'])
+        ct_lesion_outputs = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z), dtype = PRECISION['labels'])
+        brain_masks = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z), dtype = PRECISION['masks'])
 
         if mri_paths[0]:
-            mri_inputs = np.empty((len(mri_paths), max_shape_x, max_shape_y, max_shape_z))
-            mri_lesion_outputs = np.empty((len(mri_lesion_paths), max_shape_x, max_shape_y, max_shape_z, mri_n_c))
+            mri_inputs = np.empty((len(mri_paths), max_shape_x, max_shape_y, max_shape_z), dtype = PRECISION['inputs'])
+            mri_lesion_outputs = np.empty((len(mri_lesion_paths), max_shape_x, max_shape_y, max_shape_z, mri_n_c), dtype = PRECISION['labels'])
 
     def rectify_shape(image_data):
         # high resolution data has to be padded to have constant dimensions
@@ -150,7 +152,7 @@ def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_ma
             image_data = np.pad(image_data, ((0, 0), (0, 0), (n_missing_layers, 0)), 'constant', constant_values=0)
         return image_data
 
-    for subject in range(len(ct_paths)):
+    def load_subject(subject):
         ct_channels = ct_paths[subject]
         for c in range(ct_n_c):
             image = nib.load(ct_channels[c])
@@ -218,6 +220,15 @@ def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_ma
             brain_mask_data = np.nan_to_num(brain_mask_data)
         brain_masks[subject, :, :, :] = brain_mask_data
 
+    # Loading is mostly IO and decompression: subjects are loaded concurrently, each writing to its own slices
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers = n_workers) as executor:
+            # consume the results to raise any error of the loading threads
+            list(executor.map(load_subject, range(len(ct_paths))))
+    else:
+        for subject in range(len(ct_paths)):
+            load_subject(subject)
+
     if not mri_paths[0]:
         mri_inputs = []
         mri_lesion_outputs = []
@@ -225,18 +236,18 @@ def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_ma
     return ct_inputs, ct_lesion_outputs, mri_inputs, mri_lesion_outputs, brain_masks
 
 
-def load_nifti(main_dir, ct_sequences, label_sequences, mri_sequences, mri_label_sequences, brain_mask_name, high_resolution = False):
+def load_nifti(main_dir, ct_sequences, label_sequences, mri_sequences, mri_label_sequences, brain_mask_name, high_resolution = False, n_workers = 4):
     ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths = get_paths_and_ids(
         main_dir, ct_sequences, label_sequences,
         mri_sequences, mri_label_sequences,
         brain_mask_name)
-    return (ids, load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution))
+    return (ids, load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution, n_workers))
 
 # Save data as compressed numpy array
 def load_and_save_data(save_dir, main_dir, clinical_dir = None, clinical_name = None,
                        ct_sequences = [], label_sequences = [], use_mri_sequences = False,
                        external_memory=False, high_resolution = False, enforce_VOI=True,
-                       use_vessels=False, use_angio=False, use_4d_pct=False):
+                       use_vessels=False, use_angio=False, use_4d_pct=False, chunked=False, n_workers=4):
     """
     Load data
         - Image data (from preprocessed Nifti)
@@ -254,6 +265,9 @@ def load_and_save_data(save_dir, main_dir, clinical_dir = None, clinical_name =
     :param     use_vessels (optional, default False): use vessel masks as ct input
     :param     use_angio (optional, default False): use angio CT as ct input
     :param     use_4d_pct (optional, default False): use 4D perfusion CT as input
+    :param     chunked (optional, default False): save as chunked store (one .npy per subject and channel)
+                instead of a compressed data_set.npz
+    :param     n_workers (optional, default 4): number of threads loading nifti images concurrently
 
 
     Returns:
@@ -321,7 +335,7 @@ def load_and_save_data(save_dir, main_dir, clinical_dir = None, clinical_name =
     ids, (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks) = load_nifti(main_dir, ct_sequences,
                                                                                         label_sequences, mri_sequences,
                                                                                         mri_label_sequences, brain_mask_name,
-                                                                                        high_resolution)
+                                                                                        high_resolution, n_workers)
     ids = np.array(ids)
 
     if clinical_dir is not None:
@@ -335,6 +349,13 @@ def load_and_save_data(save_dir, main_dir, clinical_dir = None, clinical_name =
 
         print('Excluded', ids.shape[0] - ct_inputs.shape[0], 'subjects.')
 
+    params = {'ct_sequences': ct_sequences, 'ct_label_sequences': label_sequences,
+              'mri_sequences': mri_sequences, 'mri_label_sequences': mri_label_sequences}
+    if chunked:
+        dataset = (clinical_data, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+        save_chunked_dataset(dataset, save_dir, included_subjects = included_subjects)
+        return
+
     print('Saving a total of', ct_inputs.shape[0], 'subjects.')
     np.savez_compressed(os.path.join(save_dir, 'data_set'),
         params = {'ct_sequences': ct_sequences, 'ct_label_sequences': label_sequences,
@@ -343,7 +364,11 @@ def load_and_save_data(save_dir, main_dir, clinical_dir = None, clinical_name =
         clinical_inputs = clinical_data, ct_inputs = ct_inputs, ct_lesion_GT = ct_lesion_GT,
         mri_inputs = mri_inputs, mri_lesion_GT = mri_lesion_GT, brain_masks = brain_masks)
 
-def save_dataset(dataset, outdir, out_file_name='data_set.npz'):
+def save_dataset(dataset, outdir, out_file_name='data_set.npz', chunked=False):
+    if chunked:
+        # out_file_name is then the name of the store directory (see save_chunked_dataset)
+        save_chunked_dataset(dataset, outdir, out_file_name)
+        return
     (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset
 
     print('Saving a total of', ct_inputs.shape[0], 'subjects.')
@@ -389,14 +414,14 @@ def standardize_data(data_dir, filename = 'data_set.npz'):
     print('After outlier scaling', np.mean(ct_inputs[..., 0]), np.std(ct_inputs[..., 0]))
 
 
-    standardized_ct_inputs = np.empty(ct_inputs.shape)
+    standardized_ct_inputs = np.empty(ct_inputs.shape, dtype = ct_inputs.dtype)
     for c in range(ct_inputs.shape[-1]):
 
         standardized_ct_inputs[..., c] = standardize(ct_inputs[..., c])
         print('CT channel', c, np.mean(standardized_ct_inputs[..., c]), np.std(standardized_ct_inputs[..., c]))
 
     if len(mri_inputs) != 0:
-        standardized_mri_inputs = np.empty(mri_inputs.shape)
+        standardized_mri_inputs = np.empty(mri_inputs.shape, dtype = mri_inputs.dtype)
         for c in range(mri_inputs.shape[-1]):
             standardized_mri_inputs[..., c] = standardize(mri_inputs[..., c])
             print('MRI channel', c, np.mean(standardized_mri_inputs[..., c]), np.std(standardized_mri_inputs[..., c]))
@@ -410,24 +435,325 @@ def standardize_data(data_dir, filename = 'data_set.npz'):
                         mri_inputs=standardized_mri_inputs, mri_lesion_GT=mri_lesion_GT, brain_masks=brain_masks)
 
 
-def load_saved_data(data_dir, filename = 'data_set.npz'):
-    params = np.load(os.path.join(data_dir, filename), allow_pickle=True)['params']
-    ids = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ids']
-    clinical_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['clinical_inputs']
-    ct_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_inputs']
-    try:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_lesion_GT']
-    except:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['lesion_GT']
-
-    try:
-        mri_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_inputs']
-        mri_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_lesion_GT']
-    except:
-        mri_inputs = []
-        mri_lesion_GT = []
+# Arrays with one entry per subject, saved as one file per subject (and channel) in chunked stores
+SUBJECT_ARRAYS = ['ct_inputs', 'ct_lesion_GT', 'mri_inputs', 'mri_lesion_GT', 'brain_masks']
+# Arrays with a channel dimension (last dimension), saved as one file per channel in chunked stores
+CHANNEL_ARRAYS = ['ct_inputs', 'mri_inputs']
+
+def save_chunked_dataset(dataset, outdir, store_name='data_set', included_subjects = None):
+    """
+    Save a dataset as a chunked store: a directory containing a manifest.json and
+    one uncompressed .npy file per subject and modality (and per channel for multi-channel modalities)
+    Chunks can then be opened as memory maps to access single subjects and channels
+
+    :param dataset: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+    :param outdir: directory to save the store to
+    :param store_name: name of the store directory
+    :param included_subjects (optional): indices of included subjects
+    """
+    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset
+    store_dir = os.path.join(outdir, store_name)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    print('Saving a total of', ct_inputs.shape[0], 'subjects to chunked store', store_dir)
+    if isinstance(params, np.ndarray):
+        params = params.item()
+    manifest = {
+        'format_version': 1,
+        'ids': [str(subj_id) for subj_id in ids],
+        'params': params,
+        'arrays': {}
+    }
+
+    arrays = {'ct_inputs': ct_inputs, 'ct_lesion_GT': ct_lesion_GT, 'mri_inputs': mri_inputs,
+              'mri_lesion_GT': mri_lesion_GT, 'brain_masks': brain_masks}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        array_dir = os.path.join(store_dir, name)
+        if not os.path.exists(array_dir):
+            os.makedirs(array_dir)
+        manifest['arrays'][name] = {'shape': list(array.shape), 'dtype': array.dtype.str,
+                                    'channels': name in CHANNEL_ARRAYS and array.ndim > 1}
+        for subject in range(array.shape[0] if array.ndim > 1 else 0):
+            if manifest['arrays'][name]['channels']:
+                for c in range(array.shape[-1]):
+                    np.save(chunk_path(store_dir, name, subject, c), np.ascontiguousarray(array[subject, ..., c]))
+            else:
+                np.save(chunk_path(store_dir, name, subject), array[subject])
+
+    # small arrays are saved as a whole
+    np.save(os.path.join(store_dir, 'clinical_inputs.npy'), np.asarray(clinical_inputs), allow_pickle=True)
+    if included_subjects is not None:
+        np.save(os.path.join(store_dir, 'included_subjects.npy'), np.asarray(included_subjects))
+
+    # the manifest is written last, a store without manifest is incomplete
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+def chunk_path(store_dir, name, subject, channel = None):
+    if channel is None:
+        return os.path.join(store_dir, name, str(subject) + '.npy')
+    return os.path.join(store_dir, name, str(subject) + '_c' + str(channel) + '.npy')
+
+def is_chunked_store(path):
+    return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, 'manifest.json'), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def open_chunk(store_dir, name, subject, channel = None, mmap_mode = 'r'):
+    """
+    Open the data of a single subject (and channel) of a chunked store
+    :param store_dir: directory of the chunked store
+    :param name: name of the array (ie. ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks)
+    :param subject: index of the subject
+    :param channel: index of the channel (only for multi-channel arrays)
+    :param mmap_mode: memory map mode passed to np.load (None to load into memory)
+    :return: array of the subject (x, y, z)
+    """
+    return np.load(chunk_path(store_dir, name, subject, channel), mmap_mode=mmap_mode)
 
-    brain_masks = np.load(os.path.join(data_dir, filename), allow_pickle=True)['brain_masks']
+def load_chunked_array(store_dir, name, subjects = None, channels = None, manifest = None):
+    """
+    Load an array of a chunked store for a selection of subjects and channels
+    Only the chunks of the selected subjects and channels are read
+    :param store_dir: directory of the chunked store
+    :param name: name of the array
+    :param subjects (optional): indices of subjects to load, defaults to all subjects
+    :param channels (optional): indices of channels to load (only for multi-channel arrays), defaults to all channels
+    :param manifest (optional): already loaded manifest of the store
+    :return: array (n_subjects, ...)
+    """
+    if manifest is None:
+        manifest = load_manifest(store_dir)
+    array_info = manifest['arrays'][name]
+    shape = array_info['shape']
+    if len(shape) < 2:
+        return np.empty(shape, dtype=array_info['dtype'])
+    if subjects is None:
+        subjects = range(shape[0])
+    subjects = np.arange(shape[0])[subjects]
+    if not array_info['channels']:
+        channels = None
+    elif channels is None:
+        channels = range(shape[-1])
+
+    if channels is None:
+        array = np.empty([len(subjects)] + shape[1:], dtype=array_info['dtype'])
+    else:
+        array = np.empty([len(subjects)] + shape[1:-1] + [len(channels)], dtype=array_info['dtype'])
+    for i, subject in enumerate(subjects):
+        if channels is None:
+            array[i] = open_chunk(store_dir, name, subject)
+            continue
+        for k, channel in enumerate(channels):
+            array[i, ..., k] = open_chunk(store_dir, name, subject, channel)
+    return array
+
+def load_chunked_data(store_dir, subjects = None, channels = None):
+    """
+    Load a dataset saved with save_chunked_dataset
+    :param store_dir: directory of the chunked store
+    :param subjects (optional): indices of subjects to load, defaults to all subjects
+    :param channels (optional): indices of CT channels to load, defaults to all channels
+    :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+    """
+    manifest = load_manifest(store_dir)
+    params = np.array(manifest['params'], dtype=object)
+    ids = np.array(manifest['ids'])
+    clinical_inputs = np.load(os.path.join(store_dir, 'clinical_inputs.npy'), allow_pickle=True)
+    if subjects is not None:
+        ids = ids[subjects]
+        if len(clinical_inputs) > 0:
+            clinical_inputs = clinical_inputs[subjects]
+
+    ct_inputs = load_chunked_array(store_dir, 'ct_inputs', subjects, channels, manifest)
+    ct_lesion_GT = load_chunked_array(store_dir, 'ct_lesion_GT', subjects, manifest=manifest)
+    mri_inputs = load_chunked_array(store_dir, 'mri_inputs', subjects, manifest=manifest)
+    mri_lesion_GT = load_chunked_array(store_dir, 'mri_lesion_GT', subjects, manifest=manifest)
+    brain_masks = load_chunked_array(store_dir, 'brain_masks', subjects, manifest=manifest)
+    if mri_inputs.size == 0: mri_inputs, mri_lesion_GT = [], []
+
+    print('Loading a total of', ct_inputs.shape[0], 'subjects.')
+    print('Sequences used:', params)
+
+    return (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+
+class LazyDataset():
+    """
+    Dataset saved by load_and_save_data (data_set.npz or chunked store), opened only once
+    Arrays are loaded on first access and cached
+
+    Selections do not load any array:
+        - subset(ids) selects subjects
+        - channels([...]) selects CT channels (channels of ct_inputs)
+    Selected arrays of a .npz archive are decompressed subject by subject, keeping only the selection in memory.
+    With a chunked store, only the chunks of the selection are read.
+    """
+    ARRAY_NAMES = ['clinical_inputs', 'ct_inputs', 'ct_lesion_GT', 'mri_inputs', 'mri_lesion_GT', 'brain_masks']
+    # names used by older versions of load_and_save_data
+    LEGACY_NAMES = {'ct_lesion_GT': 'lesion_GT'}
+
+    def __init__(self, data_dir, filename = 'data_set.npz', subject_indices = None, channel_indices = None, parent = None):
+        self.path = os.path.join(data_dir, filename)
+        self.data_dir, self.filename = data_dir, filename
+        self.subject_indices = subject_indices
+        self.channel_indices = channel_indices
+        self.parent = parent
+        self._cache = {}
+
+        if parent is not None:
+            # share the opened archive with the dataset this selection was made from
+            self.chunked, self.manifest, self.archive = parent.chunked, parent.manifest, parent.archive
+        elif is_chunked_store(self.path):
+            self.chunked, self.manifest, self.archive = True, load_manifest(self.path), None
+        else:
+            self.chunked, self.manifest, self.archive = False, None, np.load(self.path, allow_pickle=True)
+
+    @property
+    def params(self):
+        if 'params' not in self._cache:
+            if self.chunked: self._cache['params'] = np.array(self.manifest['params'], dtype=object)
+            else: self._cache['params'] = self.archive['params']
+        return self._cache['params']
+
+    @property
+    def ids(self):
+        if 'ids' not in self._cache:
+            if self.chunked: ids = np.array(self.manifest['ids'])
+            else: ids = self.archive['ids']
+            if self.subject_indices is not None:
+                ids = ids[self.subject_indices]
+            self._cache['ids'] = ids
+        return self._cache['ids']
+
+    @property
+    def clinical_inputs(self): return self.get('clinical_inputs')
+    @property
+    def ct_inputs(self): return self.get('ct_inputs')
+    @property
+    def ct_lesion_GT(self): return self.get('ct_lesion_GT')
+    @property
+    def mri_inputs(self): return self.get('mri_inputs')
+    @property
+    def mri_lesion_GT(self): return self.get('mri_lesion_GT')
+    @property
+    def brain_masks(self): return self.get('brain_masks')
+
+    def subset(self, ids):
+        """
+        Select subjects by id
+        :param ids: ids of the subjects to select (in the order of the selection)
+        :return: LazyDataset of the selected subjects
+        """
+        all_ids = list(self.ids)
+        missing_ids = [subj_id for subj_id in ids if subj_id not in all_ids]
+        if missing_ids:
+            raise ValueError('Subjects not found in dataset:', missing_ids)
+        indices = np.array([all_ids.index(subj_id) for subj_id in ids], dtype=int)
+        if self.subject_indices is not None:
+            indices = np.asarray(self.subject_indices)[indices]
+        return LazyDataset(self.data_dir, self.filename, indices, self.channel_indices, parent = self)
+
+    def channels(self, channels):
+        """
+        Select CT channels
+        :param channels: indices of the channels of ct_inputs to select
+        :return: LazyDataset of the selected channels
+        """
+        indices = np.array(channels, dtype=int)
+        if self.channel_indices is not None:
+            indices = np.asarray(self.channel_indices)[indices]
+        return LazyDataset(self.data_dir, self.filename, self.subject_indices, indices, parent = self)
+
+    def get(self, name):
+        if name not in self._cache:
+            self._cache[name] = self._load(name)
+        return self._cache[name]
+
+    def _load(self, name):
+        channels = self.channel_indices if name == 'ct_inputs' else None
+
+        # reuse the arrays already loaded by the dataset this selection was made from
+        if self.parent is not None and name in self.parent._cache:
+            array = self.parent._cache[name]
+            if len(array) == 0: return array
+            if self.subject_indices is not None and self.parent.subject_indices is not self.subject_indices:
+                array = array[self._relative_indices(self.subject_indices, self.parent.subject_indices)]
+            if channels is not None and self.parent.channel_indices is not channels:
+                array = array[..., self._relative_indices(channels, self.parent.channel_indices)]
+            return array
+
+        if self.chunked:
+            if name == 'clinical_inputs':
+                array = np.load(os.path.join(self.path, 'clinical_inputs.npy'), allow_pickle=True)
+                if self.subject_indices is not None and len(array) > 0: array = array[self.subject_indices]
+                return array
+            array = load_chunked_array(self.path, name, self.subject_indices, channels, self.manifest)
+            if name in ['mri_inputs', 'mri_lesion_GT'] and array.size == 0: return []
+            return array
+
+        key = name
+        if key not in self.archive.files:
+            key = self.LEGACY_NAMES.get(name, name)
+        if key not in self.archive.files:
+            if name in ['mri_inputs', 'mri_lesion_GT']: return []
+            raise KeyError(name + ' is not part of the dataset ' + self.path)
+        return self._read_npz_array(key, self.subject_indices, channels)
+
+    @staticmethod
+    def _relative_indices(indices, parent_indices):
+        if parent_indices is None:
+            return indices
+        parent_indices = list(parent_indices)
+        return np.array([parent_indices.index(i) for i in indices], dtype=int)
+
+    def _read_npz_array(self, key, subjects = None, channels = None):
+        """
+        Read an array of the archive, decompressing it subject by subject to keep only the selected subjects and channels
+        """
+        with self.archive.zip.open(key + '.npy') as member:
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(member)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(member)
+            else:
+                shape, fortran_order, dtype = None, True, None
+
+            if fortran_order or dtype.hasobject or len(shape) < 2 or (subjects is None and channels is None):
+                array = self.archive[key]
+                if subjects is not None and len(array) > 0: array = array[subjects]
+                if channels is not None: array = array[..., channels]
+                return array
+
+            subjects = np.arange(shape[0]) if subjects is None else np.asarray(subjects)
+            subject_shape = shape[1:] if channels is None else shape[1:-1] + (len(channels),)
+            array = np.empty((len(subjects),) + subject_shape, dtype=dtype)
+            subject_n_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+            for subject in range(np.max(subjects) + 1):
+                subject_data = member.read(subject_n_bytes)
+                positions = np.flatnonzero(subjects == subject)
+                if positions.size == 0:
+                    continue
+                subject_data = np.frombuffer(subject_data, dtype=dtype).reshape(shape[1:])
+                if channels is not None:
+                    subject_data = subject_data[..., channels]
+                array[positions] = subject_data
+            return array
+
+    def as_tuple(self):
+        """
+        :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+        """
+        return (self.clinical_inputs, self.ct_inputs, self.ct_lesion_GT, self.mri_inputs, self.mri_lesion_GT,
+                self.brain_masks, self.ids, self.params)
+
+def load_saved_data(data_dir, filename = 'data_set.npz'):
+    dataset = LazyDataset(data_dir, filename)
+    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset.as_tuple()
 
     print('Loading a total of', ct_inputs.shape[0], 'subjects.')
     print('Sequences used:', params)
@@ -0,0 +1,21 @@
+import numpy as np
+
+# Precision policy: dtypes used to store perfusion maps (inputs), lesion labels and brain masks
+# float32 halves the memory of the inputs compared to float64 and is sufficient for perfusion maps
+PRECISION = {
+    'inputs': np.float32,
+    'labels': np.uint8,
+    'masks': bool
+}
+
+def set_precision(inputs=None, labels=None, masks=None):
+    '''
+    Change the precision policy used for image data, labels and masks
+    The policy is read when arrays are allocated, hence it has to be set before loading / preparing the data
+    :param inputs: dtype of perfusion maps and model input buffers (ie. np.float64 to restore full precision)
+    :param labels: dtype of lesion labels
+    :param masks: dtype of brain masks
+    '''
+    for kind, dtype in (('inputs', inputs), ('labels', labels), ('masks', masks)):
+        if dtype is not None:
+            PRECISION[kind] = np.dtype(dtype).type
@@ -3,8 +3,7 @@ sys.path.insert(0, '..')
 
 import numpy as np
 from collections import Counter
-from voxelwise.ext_mem_utils import delete_lines
-import xgboost as xgb
+from voxelwise.ext_mem_utils import filter_lines, read_svmlight_labels, SvmlightWriter
 
 def undersample_by_index(X, y):
     print('initial', X.shape, y.shape)
@@ -13,14 +12,32 @@ def undersample_by_index(X, y):
     # return (np.delete(X, unselected_indices, 0), np.delete(y, unselected_indices, 0))
 
 def ext_mem_undersample(datapath):
+    """
+    Undersample an svmlight file in place
+    Only the labels are read, the selected lines are then kept in a single streaming pass over the file
+    """
     print('Undersampling data:', datapath)
-    data = xgb.DMatrix(datapath)
-    labels = data.get_label()
-    undersampled_indices, unselected_indices = index_undersample_balance(labels)
-    print('unselect lines', unselected_indices.shape)
-    delete_lines(datapath, unselected_indices)
+    labels = read_svmlight_labels(datapath)
+    selector = get_undersample_selector_array(labels)
+    print('unselect lines', np.sum(~selector))
+    filter_lines(datapath, selector)
 
-def get_undersample_selector_array(y, mask = None):
+def undersample_to_svmlight(X, y, datapath, mask = None):
+    """
+    Undersample while writing: only the balanced subset of the samples is appended to the svmlight file,
+    no second pass over the file is needed
+
+    Args:
+        X: data [i, features]
+        y: labels [i]
+        datapath: svmlight file to append to
+        mask (optional): mask representing the samples negatives can be taken from
+    """
+    selector = get_undersample_selector_array(y, mask)
+    with SvmlightWriter(datapath) as writer:
+        writer.write(X, y, selector = selector)
+
+def get_undersample_selector_array(y, mask = None, rng = None, ratio = 1, per_subject = False, regions = None):
     """
     Return boolean array with true for indeces fitting a undersampled balance
     Useful for multidimensional arrays
@@ -28,46 +45,93 @@ def get_undersample_selector_array(y, mask = None):
     Args:
         y: dependent variables of data in a form of an np array (0,1 where 1 is underrepresented)
         mask : mask representing the areas where negative samples of y can be taken from
+        rng (optional): numpy.random.Generator or seed used for sampling
+        ratio (optional, default 1): number of negatives sampled for every positive
+        per_subject (optional, default False): sample the negatives of every subject (first dimension of y)
+            according to its own positives instead of from the population wide pool
+        regions (optional): integer array of the shape of y labelling regions that get their own quota
 
     Returns:
         selector : boolean with true indeces retained after random undersapling
     """
-    flat_labels = np.squeeze(y.reshape(-1, 1))
-    flat_mask = None
     if mask is not None:
         print('Using a mask for sampling.')
-        flat_mask = np.squeeze(mask.reshape(-1, 1))
-    undersampled_indices, unselected_indices = index_undersample_balance(flat_labels, flat_mask)
-    selector = np.full(flat_labels.shape, False)
-    selector[undersampled_indices] = True
-    selector = selector.reshape(y.shape)
+    groups = None
+    if per_subject:
+        groups = np.broadcast_to(np.arange(y.shape[0]).reshape((-1,) + (1,) * (y.ndim - 1)), y.shape)
+    if regions is not None:
+        groups = regions if groups is None else groups * (np.max(regions) + 1) + regions
 
-    return selector
+    return undersample_selector(y, mask, rng = rng, ratio = ratio, groups = groups)
 
-def index_undersample_balance(y, mask = None):
+def undersample_selector(y, mask = None, rng = None, ratio = 1, groups = None):
+    """
+    Random stratified undersampling: all positives and ratio negatives per positive are selected
+    Negatives are drawn by giving every candidate a random key and keeping the candidates with the smallest keys,
+    this is vectorised and, for a given generator state, deterministic.
+
+    Args:
+        y: dependent variables of data (0,1 where 1 is underrepresented), any shape
+        mask (optional): mask representing the areas where negative samples of y can be taken from
+        rng (optional): numpy.random.Generator or seed (if None, the seed is drawn from the global random state)
+        ratio: number of negatives sampled for every positive
+        groups (optional): non negative integer array of the shape of y, every group gets its own quota
+            of ratio * positives of the group (capped by the negatives available in the group)
+
+    Returns:
+        selector : boolean array of the shape of y
+    """
+    print('Undersampling Ratio 1:' + str(ratio))
+    if rng is None:
+        # callers without a generator control the sampling through the global random state (np.random.seed)
+        rng = np.random.randint(0, high=2**31 - 1)
+    rng = np.random.default_rng(rng)
+    flat_labels = y.reshape(-1)
+    positives = flat_labels == 1
+    negatives = flat_labels == 0
+    if mask is not None:
+        # Only take negatives out of the mask (positives are always in the mask)
+        negatives &= mask.reshape(-1) == 1
+
+    negative_indices = np.flatnonzero(negatives)
+    keys = rng.random(negative_indices.size)
+    selector = positives.copy()
+
+    if groups is None:
+        n_negatives = min(int(ratio * np.sum(positives)), negative_indices.size)
+        selected_negatives = np.argpartition(keys, n_negatives - 1)[:n_negatives] if n_negatives > 0 else []
+        selector[negative_indices[selected_negatives]] = True
+        return selector.reshape(y.shape)
+
+    flat_groups = np.asarray(groups).reshape(-1)
+    quotas = (ratio * np.bincount(flat_groups[positives], minlength = np.max(flat_groups) + 1)).astype(np.int64)
+    negative_groups = flat_groups[negative_indices]
+    # rank of every negative within its group, in the order of its random key
+    order = np.lexsort((keys, negative_groups))
+    group_starts = np.searchsorted(negative_groups[order], np.arange(quotas.size))
+    ranks = np.arange(order.size) - group_starts[negative_groups[order]]
+    selector[negative_indices[order[ranks < quotas[negative_groups[order]]]]] = True
+
+    return selector.reshape(y.shape)
+
+def index_undersample_balance(y, mask = None, rng = None, ratio = 1):
     """
     Find indeces fitting a undersampled balance
 
     Args:
         y: dependent variables of data in a form of an np array (0,1 where 1 is underrepresented)
         mask : mask representing the areas where negative samples of y can be taken from
+        rng (optional): numpy.random.Generator or seed used for sampling
+        ratio (optional, default 1): number of negatives sampled for every positive
 
     Returns:
         undersampled_indices : indeces retained after random undersapling
         unselected_indices : indeces rejected after random undersampling
     """
-    print('Undersampling Ratio 1:1')
-    n_pos = np.sum(y)
-    if mask is not None:
-        # Only take negatives out of the mask (positives are always in the mask)
-        masked_negatives = np.all([y == 0, mask == 1], axis = 0)
-        neg_indices = np.squeeze(np.argwhere(masked_negatives))
-    else :
-        neg_indices = np.squeeze(np.argwhere(y == 0))
-    pos_indices = np.squeeze(np.argwhere(y == 1))
-    randomly_downsampled_neg_indices = np.random.choice(neg_indices, int(n_pos), replace = False)
-    undersampled_indices = np.concatenate([pos_indices, randomly_downsampled_neg_indices])
-    unselected_indices = np.setdiff1d(neg_indices, randomly_downsampled_neg_indices)
+    selector = undersample_selector(y, mask, rng = rng, ratio = ratio)
+    candidates = y == 0 if mask is None else np.all([y == 0, mask == 1], axis = 0)
+    undersampled_indices = np.flatnonzero(selector)
+    unselected_indices = np.flatnonzero(candidates & ~selector)
 
     return (undersampled_indices, unselected_indices)
 
@@ -69,6 +69,8 @@ def evaluate_subgroup(Model_Generator, data_set, selected_indexes, save_dir,
         'test_image_wise_jaccards': [],
         'test_image_wise_hausdorff': [],
         'test_image_wise_modified_hausdorff': [],
+        'test_image_wise_hausdorff_95': [],
+        'test_image_wise_average_surface_distance': [],
         'test_image_wise_dice': [],
         'test_image_wise_roc_auc': [],
         'test_image_wise_fpr': [],
@@ -94,7 +96,7 @@ def evaluate_subgroup(Model_Generator, data_set, selected_indexes, save_dir,
 
     # Standardise data (data - mean / std)
     if feature_scaling:
-        imgX, clinX = standardise(imgX, clinX)
+        imgX, clinX = standardise(imgX, clinX, mask_array)
 
     # Smooth data with a gaussian Kernel before using it for training/testing
     if pre_smoothing:
@@ -180,6 +182,8 @@ def evaluate_subgroup(Model_Generator, data_set, selected_indexes, save_dir,
     results['test_image_wise_jaccards'].append(fold_result['image_wise_jaccards'])
     results['test_image_wise_hausdorff'].append(fold_result['image_wise_hausdorff'])
     results['test_image_wise_modified_hausdorff'].append(fold_result['image_wise_modified_hausdorff'])
+    results['test_image_wise_hausdorff_95'].append(fold_result['image_wise_hausdorff_95'])
+    results['test_image_wise_average_surface_distance'].append(fold_result['image_wise_average_surface_distance'])
     results['test_image_wise_dice'].append(fold_result['image_wise_dice'])
     results['test_image_wise_roc_auc'].append(fold_result['image_wise_roc_auc'])
     results['test_image_wise_fpr'].append(fold_result['image_wise_fpr'])
@@ -233,7 +237,8 @@ def subgroup_evaluation_launcher(model_name, Model_Generator, data_set, selected
     f1 = np.median(results['test_f1'])
     positive_predictive_value = np.median(results['test_positive_predictive_value'])
     dice = np.median([item for sublist in results['test_image_wise_dice'] for item in sublist])
-    hausdorff_distance = np.median([item for sublist in results['test_image_wise_hausdorff'] for item in sublist])
+    # undefined distances (only one of prediction and ground truth empty) are nan and left out
+    hausdorff_distance = np.nanmedian([item for sublist in results['test_image_wise_hausdorff'] for item in sublist])
     params = results['params']
     if not None in results['test_penumbra_metrics']['predicted_in_penumbra_ratio']:
         predicted_in_penumbra_ratio = np.median(results['test_penumbra_metrics']['predicted_in_penumbra_ratio'])
@@ -52,10 +52,11 @@ def extract_results(main_dir, output_dir=None):
 
                 kernel_width = int(result_files[0].split('_')[-3].split('.')[0].split('k')[-1])
 
-                mean_list = [[model_name, rf, kernel_width] + [np.mean(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
-                std_list = [[model_name, rf, kernel_width] + [np.std(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
+                # undefined image-wise distances are nan and left out of the aggregates
+                mean_list = [[model_name, rf, kernel_width] + [np.nanmean(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
+                std_list = [[model_name, rf, kernel_width] + [np.nanstd(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
                 median_list = [
-                    [model_name, rf, kernel_width] + [np.median(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
+                    [model_name, rf, kernel_width] + [np.nanmedian(flatten(results[i])) if i in results else np.nan for i in columns[3:]]]
 
                 n_runs = len(results[columns[3]])
                 current_all_list = np.concatenate((
@@ -3,7 +3,7 @@ sys.path.insert(0, '../')
 import data_loader
 from voxelwise.vxl_glm.LogReg_glm import LogReg_glm
 from voxelwise.vxl_continuous.normalized_marker_model import Normalized_marker_Model_Generator
-from voxelwise.wrapper_cv import launch_cv, rf_hyperopt
+from voxelwise.wrapper_cv import launch_cv, rf_hyperopt, smoothing_sweep
 
 
 data_dir = '/home/klug/data/working_data/all_2016_2017'
@@ -11,9 +11,11 @@ main_dir = os.path.join(data_dir, 'smoothing_kernel_hyperopt')
 main_output_dir = os.path.join(main_dir, 'models')
 main_save_dir = os.path.join(main_dir, 'temp_data')
 
-clinical_inputs, ct_inputs, ct_label, _, _, brain_masks, ids, params = data_loader.load_saved_data(data_dir)
+# only the Tmax channel is used: other channels are never loaded
+dataset = data_loader.LazyDataset(data_dir).channels([0])
+ct_label, brain_masks, ids = dataset.ct_lesion_GT, dataset.brain_masks, dataset.ids
 # Order: 'wcoreg_RAPID_Tmax', 'wcoreg_RAPID_rCBF', 'wcoreg_RAPID_MTT', 'wcoreg_RAPID_rCBV'
-ct_inputs = ct_inputs[..., 0]
+ct_inputs = dataset.ct_inputs[..., 0]
 
 # Ignore clinical data for now
 clinical_inputs = None
@@ -46,16 +48,28 @@ Model_Generator = LogReg_glm
 
 model_name = 'Tmax0_glm'
 
-for smoothing_radius in range(0, 9):
-    smoothing_diameter = 1 + 2 * smoothing_radius
-    if threeD_smoothing:
-        smooth_model_name = model_name + '_3D_smooth_k' + str(smoothing_diameter)
-        pre_smoothing = (smoothing_diameter, smoothing_diameter, smoothing_diameter)
-    else:
-        smooth_model_name = model_name + '_2D_smooth_k' + str(smoothing_diameter)
-        pre_smoothing = (smoothing_diameter, smoothing_diameter)
+# Sweep with smoothing_sweep: data is smoothed as in the default loop, but smoothed data is cached in
+# main_save_dir/scale_space and reused by reruns; models are saved as <model_name>_scale_space_2D_smooth_k<width>_rf_0
+scale_space = False
+
+kernel_widths = [1 + 2 * smoothing_radius for smoothing_radius in range(0, 9)]
+
+if scale_space:
     # rf is not used here
-    rf_hp_start = 0; rf_hp_end = 1
-    rf_hyperopt(smooth_model_name, Model_Generator, ct_inputs, ct_label, clinical_inputs, brain_masks, ids,
-                feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation, flat_rf,
-                    n_repeats, n_folds, main_save_dir, main_output_dir, rf_hp_start, rf_hp_end)
+    smoothing_sweep(model_name, Model_Generator, ct_inputs, ct_label, clinical_inputs, brain_masks, ids,
+                    feature_scaling, kernel_widths, threeD_smoothing, channels_to_normalise, undef_normalisation, [0, 0, 0],
+                    n_repeats, n_folds, main_save_dir, main_output_dir,
+                    scale_space_cache_dir = os.path.join(main_save_dir, 'scale_space'))
+else:
+    for smoothing_diameter in kernel_widths:
+        if threeD_smoothing:
+            smooth_model_name = model_name + '_3D_smooth_k' + str(smoothing_diameter)
+            pre_smoothing = (smoothing_diameter, smoothing_diameter, smoothing_diameter)
+        else:
+            smooth_model_name = model_name + '_2D_smooth_k' + str(smoothing_diameter)
+            pre_smoothing = (smoothing_diameter, smoothing_diameter)
+        # rf is not used here
+        rf_hp_start = 0; rf_hp_end = 1
+        rf_hyperopt(smooth_model_name, Model_Generator, ct_inputs, ct_label, clinical_inputs, brain_masks, ids,
+                    feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation, flat_rf,
+                        n_repeats, n_folds, main_save_dir, main_output_dir, rf_hp_start, rf_hp_end)
@@ -1,40 +1,104 @@
-import os
+import os, hashlib, uuid
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nibabel as nib
-from sklearn.preprocessing import StandardScaler
 from scipy.ndimage.filters import gaussian_filter
 
-def gaussian_smoothing(data, kernel_width=5, threeD=False):
+# The precision policy lives in its own module: utils is imported both as 'utils' and as 'analysis.utils',
+# which would otherwise give two independent policies
+try:
+    from analysis.precision import PRECISION, set_precision
+except ImportError:
+    from precision import PRECISION, set_precision
+
+
+def gaussian_smoothing(data, kernel_width=5, threeD=False, n_jobs=1):
     '''
     Smooth a set of n images with a 2D gaussian kernel on their x, y planes iterating through z
     if threeD is set to false; Every plane in z is smoothed independently
     Every channel is smoothed independently
+    Every subject is smoothed in a single call of a separable filter (sigma 0 along z in 2D and along channels),
+    subjects can be smoothed in parallel threads (scipy releases the GIL while filtering)
     :param data: images to smooth (n, x, y, z, c)
     :param kernel_width: 2D or 3D kernel width
         Default width is 5 vxl - (stroke dataset: 10mm width), ie. 5mm radius as inspired by
         Campbell Bruce C.V., Christensen Søren, Levi Christopher R., Desmond Patricia M., Donnan Geoffrey A., Davis Stephen M., et al. Cerebral Blood Flow Is the Optimal CT Perfusion Parameter for Assessing Infarct Core. Stroke. 2011 Dec 1;42(12):3435–40.
     :param threeD, default False: exert smoothing in all 3 spatial dimensions and not only 2
-    :return: smoothed_data
+    :param n_jobs, default 1: number of threads smoothing subjects in parallel
+    :return: smoothed_data (in the input precision, see PRECISION)
     '''
     if len(data.shape) != 5:
         raise ValueError('Shape of data to smooth should be (n, x, y, z, c) and not', data.shape)
 
     sigma = kernel_width / 3
     truncate = ((kernel_width - 1) / 2 - 0.5) / sigma
-    smoothed_data = np.empty(data.shape)
-
-    for i in range(data.shape[0]):
-        for c in range(data.shape[4]):
-            if not threeD:
-                for z in range(data.shape[3]):
-                    smoothed_data[i, :, :, z, c] = gaussian_filter(data[i, :, :, z, c], kernel_width / 3,
-                                                                   truncate=truncate)
-            else:
-                smoothed_data[i, :, :, :, c] = gaussian_filter(data[i, :, :, :, c], kernel_width/3, truncate=truncate)
+    return filter_subjects(data, (sigma, sigma, sigma if threeD else 0, 0), truncate=truncate, n_jobs=n_jobs)
+
+
+def filter_subjects(data, subject_sigma, truncate=4.0, n_jobs=1):
+    '''
+    Apply a gaussian filter to every subject of a set of images
+    :param data: images to smooth (n, x, y, z, c)
+    :param subject_sigma: sigma of the filter along (x, y, z, c)
+    :param truncate: truncate the filter at this many standard deviations
+    :param n_jobs: number of threads smoothing subjects in parallel
+    :return: smoothed_data (in the input precision, see PRECISION)
+    '''
+    smoothed_data = np.empty(data.shape, dtype=PRECISION['inputs'])
+
+    def smooth_subject(i):
+        gaussian_filter(data[i], subject_sigma, truncate=truncate, output=smoothed_data[i])
+
+    if n_jobs > 1 and data.shape[0] > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(smooth_subject, range(data.shape[0])))
+    else:
+        for i in range(data.shape[0]):
+            smooth_subject(i)
 
     return smoothed_data
 
 
+def gaussian_scale_space(data, kernel_widths, threeD=False, n_jobs=1, cache_dir=None):
+    '''
+    Smooth a set of n images with gaussian kernels of several widths, every level being identical to gaussian_smoothing
+    Kernels of gaussian_smoothing are truncated at the kernel width and truncated kernels do not add up (smoothing a
+    level again does not give the level of a larger width), every level is thus computed from the raw data.
+    Levels can be saved to cache_dir, from which later sweeps on the same data read them instead of smoothing again.
+    :param data: images to smooth (n, x, y, z, c)
+    :param kernel_widths: 2D or 3D kernel widths, in any order (a width of 1 leaves the data unsmoothed)
+    :param threeD, default False: exert smoothing in all 3 spatial dimensions and not only 2
+    :param n_jobs, default 1: number of threads smoothing subjects in parallel
+    :param cache_dir (optional): directory in which every level is saved and from which saved levels of the same data
+        are read instead of being computed again
+    :return: generator of (kernel_width, smoothed_data) by increasing kernel width
+    '''
+    if len(data.shape) != 5:
+        raise ValueError('Shape of data to smooth should be (n, x, y, z, c) and not', data.shape)
+
+    level_prefix = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        data_key = hashlib.sha1(str((data.shape, data.dtype, threeD, 'gaussian_smoothing')).encode())
+        data_key.update(np.ascontiguousarray(data))
+        level_prefix = os.path.join(cache_dir, 'scale_space_' + data_key.hexdigest()[:16] + '_k')
+
+    for kernel_width in sorted(set(kernel_widths)):
+        level_path = level_prefix + str(kernel_width) + '.npy' if level_prefix is not None else None
+        if level_path is not None and os.path.exists(level_path):
+            level = np.load(level_path)
+        else:
+            level = gaussian_smoothing(data, kernel_width=kernel_width, threeD=threeD, n_jobs=n_jobs)
+            if level_path is not None:
+                # write to a temporary file first, so that an interrupted write never leaves a corrupted level
+                temp_path = os.path.join(cache_dir, str(uuid.uuid4()) + '.tmp')
+                with open(temp_path, 'wb') as temp_file:
+                    np.save(temp_file, level)
+                os.replace(temp_path, level_path)
+        yield kernel_width, level
+
+
 def find_max_shape(data_dir, file_name):
     '''
     Given a directory and a filename, find the biggest dimension along x, y and z
@@ -69,30 +133,160 @@ def find_max_shape(data_dir, file_name):
     return (max_x, max_y, max_z)
 
 
-def rescale_outliers(imgX, MASKS):
+def rescale_outliers(imgX, MASKS, return_report = False, cohort_medians = None):
     '''
     Rescale outliers as some images from RAPID seem to be scaled x10
     Outliers are detected if their median exceeds 5 times the global median and are rescaled by dividing through 10
+    Medians are taken over the voxels of the brain masks; the cohort median of every channel is computed once,
+    before any subject is rescaled. Rescaling is done in place.
     :param imgX: image data (n, x, y, z, c)
-    :return: rescaled_imgX
+    :param MASKS: brain masks (n, x, y, z)
+    :param return_report: also return the list of corrected subjects and channels
+    :param cohort_medians (optional): median of every channel in the cohort (ie. of the training subjects of a model),
+        computed from imgX if not given
+    :return: rescaled_imgX, or (rescaled_imgX, report) if return_report is set, with report a list of
+        dicts ('subject', 'channel', 'subject_median', 'cohort_median') of every corrected subject and channel
     '''
+    if MASKS is None:
+        MASKS = np.ones(imgX.shape[:4], dtype = bool)
+    MASKS = MASKS.astype(bool)
+    # brain voxels are ordered by subject: split points of the subjects in the masked voxels
+    subject_splits = np.cumsum(MASKS.reshape(MASKS.shape[0], -1).sum(axis = 1))[:-1]
+
+    report = []
+    for channel in range(imgX.shape[-1]):
+        masked_values = imgX[..., channel][MASKS]
+        median_channel = np.median(masked_values) if cohort_medians is None else cohort_medians[channel]
+        subject_medians = [np.median(subject_values) if subject_values.size > 0 else np.nan
+                           for subject_values in np.split(masked_values, subject_splits)]
+        for i in np.flatnonzero(np.array(subject_medians) > 5 * median_channel):
+            imgX[i, ..., channel] = imgX[i, ..., channel] / 10
+            report.append({'subject': int(i), 'channel': channel,
+                           'subject_median': subject_medians[i], 'cohort_median': median_channel})
 
-    for i in range(imgX.shape[0]):
-        for channel in range(imgX.shape[-1]):
-            median_channel = np.median(imgX[..., channel][MASKS])
-            if np.median(imgX[i, ..., 0][MASKS[i]]) > 5 * median_channel:
-                imgX[i, ..., 0] = imgX[i, ..., channel] / 10
+    for correction in report:
+        print('Rescaled outlier: subject', correction['subject'], 'channel', correction['channel'],
+              '(median', correction['subject_median'], 'vs cohort median', correction['cohort_median'], ')')
 
+    if return_report:
+        return imgX, report
     return imgX
 
 
-def standardise(imgX, clinX):
-    original_shape = imgX.shape
-    imgX = imgX.reshape(-1, imgX.shape[-1])
-    scaler = StandardScaler(copy = False)
-    rescaled_imgX = scaler.fit_transform(imgX).reshape(original_shape)
-    if clinX is not None:
-        rescaled_clinX = scaler.fit_transform(clinX)
-    else:
-        rescaled_clinX = clinX
-    return rescaled_imgX, rescaled_clinX
\ No newline at end of file
+class Standardiser():
+    '''
+    Standardisation of the channels of image data (data - mean / std) with statistics restricted to the brain masks
+    Means and variances of the channels are computed in a single streaming pass over chunks of subjects
+    (Welford / Chan et al. update), the data is thus never flattened or copied as a whole and is transformed in place.
+    Clinical data is standardised with its own statistics.
+    The fitted statistics can be stored (statistics()) to apply the identical transform at inference
+    (Standardiser(statistics)).
+    '''
+
+    def __init__(self, statistics = None, chunk_size = 8):
+        '''
+        :param statistics (optional): statistics of a fitted standardiser, as returned by statistics()
+        :param chunk_size (optional, default 8): number of subjects processed at once
+        '''
+        self.chunk_size = chunk_size
+        self.means = None
+        self.stds = None
+        self.clin_means = None
+        self.clin_stds = None
+        self.n_voxels = 0
+        if statistics is not None:
+            self.means = np.asarray(statistics['means'])
+            self.stds = np.asarray(statistics['stds'])
+            self.n_voxels = statistics['n_voxels']
+            if statistics.get('clin_means') is not None:
+                self.clin_means = np.asarray(statistics['clin_means'])
+                self.clin_stds = np.asarray(statistics['clin_stds'])
+
+    @property
+    def fitted(self):
+        return self.means is not None
+
+    def statistics(self):
+        return {'means': self.means, 'stds': self.stds, 'n_voxels': self.n_voxels,
+                'clin_means': self.clin_means, 'clin_stds': self.clin_stds}
+
+    def fit(self, imgX, MASKS = None, clinX = None):
+        '''
+        :param imgX: image data (n, x, y, z, c)
+        :param MASKS (optional): brain masks (n, x, y, z), statistics are computed over all voxels if not given
+        :param clinX (optional): clinical data (n, clinical_data)
+        :return: self
+        '''
+        n_voxels = 0
+        means = np.zeros(imgX.shape[-1])
+        m2 = np.zeros(imgX.shape[-1])
+        for start in range(0, imgX.shape[0], self.chunk_size):
+            if MASKS is None:
+                values = imgX[start:start + self.chunk_size].reshape(-1, imgX.shape[-1])
+            else:
+                values = imgX[start:start + self.chunk_size][MASKS[start:start + self.chunk_size].astype(bool)]
+            if values.shape[0] == 0:
+                continue
+            values = values.astype(np.float64)
+            chunk_n = values.shape[0]
+            chunk_means = values.mean(axis = 0)
+            chunk_m2 = ((values - chunk_means) ** 2).sum(axis = 0)
+            # merge the moments of the chunk into the running moments
+            delta = chunk_means - means
+            total_n = n_voxels + chunk_n
+            means = means + delta * chunk_n / total_n
+            m2 = m2 + chunk_m2 + delta ** 2 * n_voxels * chunk_n / total_n
+            n_voxels = total_n
+        if n_voxels == 0:
+            raise ValueError('Can not standardise: no voxels in the masks.')
+
+        self.n_voxels = n_voxels
+        self.means = means
+        self.stds = self.safe_std(m2 / n_voxels)
+        if clinX is not None:
+            clinX = np.asarray(clinX, dtype = np.float64)
+            self.clin_means = clinX.mean(axis = 0)
+            self.clin_stds = self.safe_std(clinX.var(axis = 0))
+        return self
+
+    @staticmethod
+    def safe_std(variances):
+        # constant features are left unscaled (as with sklearn's StandardScaler)
+        stds = np.sqrt(variances)
+        stds[stds == 0] = 1
+        return stds
+
+    def transform(self, imgX, clinX = None):
+        '''
+        Standardise image data in place (in the input precision, see PRECISION) and clinical data
+        :return: (imgX, clinX) standardised
+        '''
+        if not self.fitted:
+            raise ValueError('Standardiser has to be fitted before transforming data.')
+        if not np.issubdtype(imgX.dtype, np.floating):
+            imgX = imgX.astype(PRECISION['inputs'])
+        means = self.means.astype(imgX.dtype)
+        stds = self.stds.astype(imgX.dtype)
+        for start in range(0, imgX.shape[0], self.chunk_size):
+            chunk = imgX[start:start + self.chunk_size]
+            chunk -= means
+            chunk /= stds
+        if clinX is not None:
+            if self.clin_means is None:
+                raise ValueError('Standardiser was fitted without clinical data.')
+            clinX = (np.asarray(clinX) - self.clin_means) / self.clin_stds
+        return imgX, clinX
+
+    def fit_transform(self, imgX, MASKS = None, clinX = None):
+        return self.fit(imgX, MASKS, clinX).transform(imgX, clinX)
+
+
+def standardise(imgX, clinX, MASKS = None):
+    '''
+    Standardise image and clinical data in place (see Standardiser)
+    :param imgX: image data (n, x, y, z, c)
+    :param clinX: clinical data (n, clinical_data) or None
+    :param MASKS (optional): brain masks (n, x, y, z) restricting the statistics of the image data
+    :return: (rescaled_imgX, rescaled_clinX)
+    '''
+    return Standardiser().fit_transform(imgX, MASKS, clinX)
@@ -45,7 +45,7 @@ def normalise_channel_by_contralateral(all_channel_data, data_positions, channel
     # Recover 3D shape of data
     reconstructed_data = reconstruct_image(all_channel_data, data_positions, all_channel_data.shape[-1])
     channel_to_normalise_data = reconstructed_data[... ,channel]
-    normalised_channel = np.zeros(channel_to_normalise_data.shape, dtype=np.float64)
+    normalised_channel = np.zeros(channel_to_normalise_data.shape, dtype=channel_to_normalise_data.dtype)
     x_center = channel_to_normalise_data.shape[1] // 2
 
     for subj in range(channel_to_normalise_data.shape[0]):
@@ -1,18 +1,24 @@
-import os, sys, shutil, traceback, timeit
+import os, sys, shutil, traceback, timeit, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 sys.path.insert(0, '../')
 from sklearn.model_selection import train_test_split, KFold
 import numpy as np
 from sampling_utils import get_undersample_selector_array
 import voxelwise.receptiveField as rf
 from voxelwise.scoring_utils import evaluate
-from utils import gaussian_smoothing, rescale_outliers, standardise
+from utils import gaussian_smoothing, rescale_outliers, Standardiser, PRECISION
 from voxelwise.penumbra_evaluation import penumbra_match
 from voxelwise.channel_normalisation import normalise_channel_by_contralateral
+from voxelwise.rf_cache import ReceptiveFieldCache
+from voxelwise.preprocessing_pipeline import PreprocessingPipeline
 
 def repeated_kfold_cv(Model_Generator, save_dir, save_function,
             input_data_array, output_data_array, clinical_input_array = None, mask_array = None, id_array = None,
             feature_scaling = True, pre_smoothing = False, channels_to_normalise = False, undef_normalisation = True,
-            receptive_field_dimensions = [1,1,1], n_repeats = 1, n_folds = 5, messaging = None):
+            receptive_field_dimensions = [1,1,1], n_repeats = 1, n_folds = 5, messaging = None,
+            rf_cache_dir = None, rf_cache_max_size_gb = 50, n_jobs = 1, preprocessed = False, seed = None,
+            render_figures = True, results_store = None, resume = False, fold_preprocessing = True,
+            preprocessing_state = None):
     """
     Patient wise Repeated KFold Crossvalidation for a given model
     This function creates and evaluates k datafolds of n-iterations for crossvalidation
@@ -34,6 +40,27 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
         n_repeats (optional, default 1): repeats of kfold CV
         n_folds (optional, default 5): number of folds in kfold (ie. k)
         messaging (optional, defaults to None): instance of notification_system used to report errors
+        rf_cache_dir (optional, defaults to None): directory used to cache the receptive fields of every subject
+            across folds and iterations (and across runs with identical data and preprocessing)
+        rf_cache_max_size_gb (optional, default 50): size of the receptive field cache before LRU eviction
+        n_jobs (optional, default 1): number of processes running folds in parallel
+        preprocessed (optional, default False): data has already been preprocessed with preprocess_data
+            (with the given feature_scaling, pre_smoothing and channels_to_normalise)
+        seed (optional): seed of the crossvalidation, the splits and the undersampling of every fold are derived
+            from it (drawn from the global random generator if not given)
+        render_figures (optional, default True): build the visual check figure of every fold during evaluation,
+            if False figures are None and only the centre slices are recorded in 'test_visual_checks'
+            (rendered on demand with figures/visual_check.py)
+        results_store (optional): ResultsStore to which the result of every fold is appended when it is done
+        resume (optional, default False): resume the crossvalidation saved in results_store: folds that are
+            already done are skipped, the others are run with the seed and splits of the saved crossvalidation
+            (raises a ValueError if any setting differs from the saved ones)
+        fold_preprocessing (optional, default True): compute the statistics of the preprocessing (outlier rescaling,
+            standardisation) on the training subjects of every fold only (see PreprocessingPipeline),
+            if False the data is preprocessed once with the statistics of all subjects (see preprocess_data)
+        preprocessing_state (optional): state of the per-subject transforms of a PreprocessingPipeline
+            (see PreprocessingPipeline.subject_state), the input data is then its subject data and the
+            preprocessing is fitted in every fold
 
 
     Returns: result dictionary
@@ -45,6 +72,10 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
         'test_f1': f1 score in every fold of every iteration
         'test_TPR': true positive rate in every fold of every iteration
         'test_FPR': false positive rate in every fold of every iteration
+        'test_visual_checks': centre slices of GT and prediction of the test subjects in every fold of every iteration
+        'test_roc_histogram': histograms of the probabilities of negative and positive voxels merged over all folds
+            (see scoring_utils.RocAccumulator), giving the pooled ROC curve
+        'preprocessing_statistics': statistics of the preprocessing fitted in every fold (with fold_preprocessing)
     """
     print('CONTINOUS REPEATED KFOLD CV')
     imgX = input_data_array
@@ -67,20 +98,370 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
     failed_folds = 0
     trained_models = []
     figures = []
-    results = {
-        'params': {
-            'model_params': model_params,
-            'rf': receptive_field_dimensions,
-            'used_clinical': used_clinical,
-            'masked_background': used_brain_masking,
-            'scaled': feature_scaling,
-            'smoothed_beforehand': pre_smoothing,
-            'settings_repeats': n_repeats,
-            'settings_folds': n_folds,
-            'settings_imgX_shape': imgX.shape,
-            'settings_y_shape': y.shape,
-            'failed_folds': failed_folds
-        },
+
+    print('Repeated kfold', n_repeats, n_folds)
+    stored_params = None
+    if resume:
+        if results_store is None:
+            raise ValueError('A results store is needed to resume a crossvalidation.')
+        stored_params = results_store.load_params()
+    if stored_params is not None:
+        if seed is not None and seed != stored_params['settings_seed']:
+            raise ValueError('Can not resume crossvalidation with a different seed:', stored_params['settings_seed'], seed)
+        seed = stored_params['settings_seed']
+    if seed is None:
+        seed = np.random.randint(0, high=2**31 - 1)
+    print('Crossvalidation seed:', seed)
+    fold_preprocessing = preprocessing_state is not None or (fold_preprocessing and not preprocessed)
+
+    results = init_results({
+        'model_params': model_params,
+        'rf': receptive_field_dimensions,
+        'used_clinical': used_clinical,
+        'masked_background': used_brain_masking,
+        'scaled': feature_scaling,
+        'smoothed_beforehand': pre_smoothing,
+        'channels_to_normalise': channels_to_normalise,
+        'undef_normalisation': undef_normalisation,
+        'settings_repeats': n_repeats,
+        'settings_folds': n_folds,
+        'settings_seed': seed,
+        'settings_imgX_shape': imgX.shape,
+        'settings_y_shape': y.shape,
+        'failed_folds': failed_folds,
+        'fold_preprocessing': fold_preprocessing,
+        'standardisation': None
+    })
+    if stored_params is not None:
+        # folds of the saved crossvalidation are merged with the new ones: all settings have to be identical
+        # (failed folds and the standardisation statistics are results and not settings)
+        for setting in sorted(set(results['params']) | set(stored_params)):
+            if setting in ['failed_folds', 'standardisation']:
+                continue
+            if setting not in stored_params or setting not in results['params'] \
+                    or not same_setting(stored_params[setting], results['params'][setting]):
+                raise ValueError('Can not resume crossvalidation with different settings:', setting,
+                                 stored_params.get(setting), results['params'].get(setting))
+
+    # seeds of the KFold splits of every iteration, recorded to resume with identical splits
+    kfold_seeds = [int(j) for j in np.random.default_rng(seed).integers(0, high=10000, size=n_repeats)]
+    completed_folds = set()
+    if stored_params is not None:
+        if results_store.kfold_seeds() != kfold_seeds:
+            raise ValueError('Saved KFold seeds do not match the seed of the crossvalidation:',
+                             results_store.kfold_seeds(), kfold_seeds)
+        results, trained_models = results_store.load_results()
+        figures = [None] * len(trained_models)
+        completed_folds = set(results_store.folds())
+        print('Resuming crossvalidation:', len(completed_folds), 'of', n_repeats * n_folds, 'folds already done.')
+
+    print('Input image data shape:', imgX.shape)
+    n_x, n_y, n_z, n_c = imgX[0].shape
+    if clinX is not None:
+        print('Using clinical data.')
+        if clinX.shape[0] != imgX.shape[0]:
+            raise ValueError('Not the same number of clinical and imaging data points:', clinX.shape, imgX.shape)
+    else:
+        print('Not using clinical data')
+
+    if os.path.exists(save_dir):
+        # intermediate data of folds left over by an interrupted run (only directories created by this function)
+        for leftover in os.listdir(save_dir):
+            if leftover.startswith('iteration_') or leftover == 'shared_data':
+                print('Clearing previous data in', os.path.join(save_dir, leftover))
+                shutil.rmtree(os.path.join(save_dir, leftover))
+    start = timeit.default_timer()
+
+    preprocessing_pipeline = None
+    if fold_preprocessing:
+        # per-subject transforms are done once, statistics are computed on the training subjects of every fold
+        preprocessing_pipeline = PreprocessingPipeline(imgX, clinX, mask_array, feature_scaling = feature_scaling,
+                                                       pre_smoothing = pre_smoothing,
+                                                       channels_to_normalise = channels_to_normalise,
+                                                       subject_state = preprocessing_state, n_jobs = n_jobs)
+        imgX = preprocessing_pipeline.subject_data
+    elif not preprocessed:
+        standardiser = Standardiser()
+        imgX, clinX = preprocess_data(imgX, clinX, mask_array, feature_scaling = feature_scaling,
+                                      pre_smoothing = pre_smoothing, channels_to_normalise = channels_to_normalise,
+                                      standardiser = standardiser, n_jobs = n_jobs)
+        if feature_scaling:
+            # recorded so that the identical standardisation can be applied at inference (see model_predict)
+            results['params']['standardisation'] = standardiser.statistics()
+    if stored_params is None and results_store is not None:
+        results_store.save_params(results['params'], kfold_seeds)
+
+    # Receptive fields of a subject are identical in every fold: cache them once preprocessing is done
+    # (with fold preprocessing, receptive fields of the fold independent subject data are cached)
+    rf_cache = None
+    subject_keys = None
+    if rf_cache_dir is not None and preprocessing_pipeline is not None and not preprocessing_pipeline.is_affine:
+        print('Not caching receptive fields: channels normalised by their contralateral side are preprocessed per fold.')
+    elif rf_cache_dir is not None:
+        rf_cache = ReceptiveFieldCache(rf_cache_dir, max_size_gb = rf_cache_max_size_gb)
+        preprocessing_settings = {'scaled': feature_scaling, 'smoothed_beforehand': pre_smoothing,
+                                  'channels_to_normalise': channels_to_normalise,
+                                  'fold_preprocessing': fold_preprocessing}
+        subject_keys = np.array([ReceptiveFieldCache.subject_key(imgX[i], mask_array[i], receptive_field_dimensions,
+                                                                 preprocessing_settings)
+                                 for i in range(imgX.shape[0])])
+
+    fold_settings = {
+        'Model_Generator': Model_Generator, 'receptive_field_dimensions': receptive_field_dimensions,
+        'undef_normalisation': undef_normalisation, 'n_folds': n_folds, 'save_dir': save_dir,
+        'messaging': messaging, 'rf_cache': rf_cache, 'subject_keys': subject_keys, 'render_figures': render_figures,
+        'preprocessing_pipeline': preprocessing_pipeline
+    }
+
+    # Folds are independent once the data is preprocessed: they can be run in parallel by worker processes
+    # sharing the preprocessed data through memory maps
+    executor = None
+    if n_jobs > 1:
+        shared_data_paths = share_arrays(os.path.join(save_dir, 'shared_data'),
+                                         imgX = imgX, y = y, mask_array = mask_array, clinX = clinX, id_array = id_array)
+        executor = ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context('fork'),
+                                       initializer = init_fold_worker, initargs = (shared_data_paths, fold_settings))
+        print('Running folds on', n_jobs, 'processes.')
+    else:
+        init_fold_worker(None, fold_settings, imgX = imgX, y = y, mask_array = mask_array, clinX = clinX, id_array = id_array)
+
+    # Start iteration of repeated_kfold_cv
+    iteration = 0
+    iteration_dirs = []
+    fold_tasks = []
+    for j in kfold_seeds:
+        iteration += 1
+        iteration_dir = os.path.join(save_dir, 'iteration_' + str(iteration))
+        if not os.path.exists(iteration_dir):
+            os.makedirs(iteration_dir)
+        iteration_dirs.append(iteration_dir)
+
+        print('Crossvalidation: Creating iteration ' + str(iteration) + ' of a total of ' + str(n_repeats))
+
+        fold = 0
+        kf = KFold(n_splits = n_folds, shuffle = True, random_state = j)
+        for train, test in kf.split(imgX, y):
+            if (iteration, fold) in completed_folds:
+                fold += 1
+                continue
+            # every fold has its own seed, so that folds are identical when run serially or in parallel
+            seed_of_fold = fold_seed(seed, iteration, fold)
+            if executor is not None:
+                fold_tasks.append((iteration, fold,
+                                   executor.submit(run_fold, train, test, iteration, fold, iteration_dir, seed_of_fold)))
+            else:
+                fold_result = run_fold(train, test, iteration, fold, iteration_dir, seed_of_fold)
+                collect_fold_result(results, trained_models, figures, fold_result)
+                # save current state of progression
+                if results_store is not None:
+                    results_store.append_fold(iteration, fold, fold_result)
+                save_function(results, trained_models, figures)
+
+            fold += 1
+            # End of fold iteration
+
+        if executor is None:
+            try:
+                shutil.rmtree(iteration_dir)
+            except:
+                print('No iteration to clear.')
+        # End of iteration iteration
+
+    if executor is not None:
+        try:
+            # merge results in the order of submission, independently of the order of completion
+            for iteration, fold, fold_task in fold_tasks:
+                fold_result = fold_task.result()
+                collect_fold_result(results, trained_models, figures, fold_result)
+                if results_store is not None:
+                    results_store.append_fold(iteration, fold, fold_result)
+                save_function(results, trained_models, figures)
+        finally:
+            # also release the workers and the shared data if a worker died (ie. BrokenProcessPool)
+            executor.shutdown(cancel_futures = True)
+            for iteration_dir in iteration_dirs + [os.path.join(save_dir, 'shared_data')]:
+                try:
+                    shutil.rmtree(iteration_dir)
+                except:
+                    print('No iteration to clear.')
+
+    end = timeit.default_timer()
+    print('Created, saved and evaluated splits in: ', str(end - start))
+
+    return (results, trained_models)
+
+def same_setting(stored_value, value):
+    """
+    Compare settings of a crossvalidation (nested dicts, lists, tuples, arrays and scalars)
+    """
+    if isinstance(stored_value, dict) or isinstance(value, dict):
+        return isinstance(stored_value, dict) and isinstance(value, dict) and stored_value.keys() == value.keys() \
+               and all(same_setting(stored_value[key], value[key]) for key in stored_value)
+    if isinstance(stored_value, (list, tuple, np.ndarray)) or isinstance(value, (list, tuple, np.ndarray)):
+        try:
+            return np.array_equal(np.asarray(stored_value), np.asarray(value))
+        except Exception:
+            return False
+    try:
+        return bool(stored_value == value)
+    except Exception:
+        return False
+
+def fold_seed(seed, iteration, fold):
+    """
+    Seed of a fold, derived from the seed of the crossvalidation
+    A fold can be regenerated from (seed, iteration, fold) and its train indices instead of being stored
+    """
+    return int(np.random.SeedSequence([seed, iteration, fold]).generate_state(1)[0])
+
+def share_arrays(shared_dir, **arrays):
+    """
+    Save arrays as .npy files to be opened as memory maps by worker processes
+    :param shared_dir: directory to save the arrays to
+    :param arrays: arrays to share (None values are kept as None)
+    :return: dict of paths (or None) per array name
+    """
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir)
+    shared_paths = {}
+    for name, array in arrays.items():
+        if array is None:
+            shared_paths[name] = None
+            continue
+        shared_paths[name] = os.path.join(shared_dir, name + '.npy')
+        np.save(shared_paths[name], np.asarray(array))
+    return shared_paths
+
+def load_shared_arrays(shared_paths):
+    """
+    Open arrays saved by share_arrays as memory maps
+    :param shared_paths: dict of paths (or None) per array name
+    :return: dict of arrays (or None) per array name
+    """
+    arrays = {}
+    for name, path in shared_paths.items():
+        if path is None:
+            arrays[name] = None
+            continue
+        try:
+            arrays[name] = np.load(path, mmap_mode='r')
+        except ValueError:
+            # arrays of python objects can not be memory mapped
+            arrays[name] = np.load(path, allow_pickle=True)
+    return arrays
+
+# data and settings used by run_fold in the current process
+_fold_worker_state = {}
+
+def init_fold_worker(shared_data_paths, fold_settings, **arrays):
+    """
+    Initialise the data used to run folds in this process
+    :param shared_data_paths: paths of memory mapped arrays as given by share_arrays (None to use the given arrays)
+    :param fold_settings: settings of the folds (model generator, rf dimensions, cache...)
+    :param arrays: arrays to use directly if no shared paths are given
+    """
+    _fold_worker_state.clear()
+    _fold_worker_state.update(fold_settings)
+    if shared_data_paths is not None:
+        arrays = load_shared_arrays(shared_data_paths)
+    _fold_worker_state.update(arrays)
+
+def run_fold(train, test, iteration, fold, iteration_dir, seed = None):
+    """
+    Create, train and evaluate a single fold with the data of this process (see init_fold_worker)
+
+    Args:
+        train: indices of subjects used for training
+        test: indices of subjects used for testing
+        iteration: index of the iteration of the repeated kfold
+        fold: index of the fold in this iteration
+        iteration_dir: directory of the iteration in which the fold can save data
+        seed (optional): seed of the fold (see fold_seed) passed to the undersampling, the global numpy
+            random state is left untouched (folds may run in the process of the caller)
+
+    Returns: result dictionary of evaluate_fold or None if the fold failed
+    """
+    Model_Generator = _fold_worker_state['Model_Generator']
+    imgX, y, mask_array = _fold_worker_state['imgX'], _fold_worker_state['y'], _fold_worker_state['mask_array']
+    clinX, id_array = _fold_worker_state['clinX'], _fold_worker_state['id_array']
+    receptive_field_dimensions = _fold_worker_state['receptive_field_dimensions']
+    save_dir, messaging = _fold_worker_state['save_dir'], _fold_worker_state['messaging']
+    preprocessing_pipeline = _fold_worker_state['preprocessing_pipeline']
+    rf_cache = _fold_worker_state['rf_cache']
+    subject_scales, subject_offsets = None, None
+    if preprocessing_pipeline is not None:
+        # preprocess with the statistics of the training subjects of this fold: imgX is the subject data shared
+        # by all folds, the affine transform of every subject is applied to the voxels the fold reads
+        preprocessing_pipeline.fit(train)
+        if preprocessing_pipeline.is_affine:
+            subject_scales, subject_offsets = preprocessing_pipeline.scales, preprocessing_pipeline.offsets
+            clinX = preprocessing_pipeline.transform_clinical()
+        else:
+            # channels normalised by their contralateral side: the data of the fold is transformed as a whole
+            imgX, clinX = preprocessing_pipeline.transform()
+            rf_cache = None
+    n_x, n_y, n_z, n_c = imgX[0].shape
+    n_test_subjects = test.size
+
+    fold_dir = os.path.join(iteration_dir, 'fold_' + str(fold))
+    if not os.path.exists(fold_dir):
+        os.makedirs(fold_dir)
+
+    # Create a new model for every fold
+    model = Model_Generator(fold_dir, fold, n_channels = n_c, n_channels_out = 1, rf = receptive_field_dimensions)
+
+    # Create this fold
+    try:
+        print('Creating fold : ' + str(fold))
+        create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, test, clinX = clinX,
+                    undef_normalisation = _fold_worker_state['undef_normalisation'],
+                    rf_cache = rf_cache, subject_keys = _fold_worker_state['subject_keys'],
+                    sampling_seed = seed, subject_scales = subject_scales, subject_offsets = subject_offsets)
+    except Exception as e:
+        tb = traceback.format_exc()
+        print('Creation of fold failed.')
+        print(e)
+        print(tb)
+        if (messaging):
+            title = 'Minor error upon fold creation rf_hyperopt at ' + str(receptive_field_dimensions) + ' in ' + str(save_dir)
+            body = 'RF ' + str(receptive_field_dimensions) + '\n' + 'fold ' + str(fold) + '\n' +'iteration ' + str(iteration) + '\n' + 'Error ' + str(e) + '\n' + str(tb)
+            messaging.send_message(title, body)
+
+    # Evaluate this fold
+    print('Evaluating fold ' + str(fold) + ' of ' + str(_fold_worker_state['n_folds'] - 1) + ' of iteration' + str(iteration) + ' in', str(fold_dir))
+    fold_result = None
+    try:
+        fold_result = evaluate_fold(model, n_test_subjects, n_x, n_y, n_z, imgX, mask_array, id_array, test,
+                                    render_figure = _fold_worker_state['render_figures'],
+                                    preprocessing_pipeline = preprocessing_pipeline if subject_scales is not None else None)
+        if preprocessing_pipeline is not None:
+            fold_result['preprocessing_statistics'] = preprocessing_pipeline.statistics
+    except Exception as e:
+        print('Evaluation of fold failed.')
+        tb = traceback.format_exc()
+        print(e)
+        print(tb)
+
+        if (messaging):
+            title = 'Minor error upon fold evaluation rf_hyperopt at ' + str(receptive_field_dimensions) + ' in ' + str(save_dir)
+            body = 'RF ' + str(receptive_field_dimensions) + '\n' + 'fold ' + str(fold) + '\n' +'iteration ' + str(iteration) + '\n' + 'Error ' + str(e) + '\n' + str(tb)
+            messaging.send_message(title, body)
+
+    # Erase saved fold to free up space
+    try:
+        shutil.rmtree(fold_dir)
+    except:
+        print('No fold to clear.')
+
+    return fold_result
+
+def init_results(params):
+    """
+    Empty result dictionary of a crossvalidation, fold results are added with collect_fold_result
+    :param params: parameters of the crossvalidation (model params, rf, settings...)
+    """
+    return {
+        'params': params,
         'train_evals': [],
         'test_accuracy': [],
         'test_roc_auc': [],
@@ -89,6 +470,8 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
         'test_TPR': [],
         'test_FPR': [],
         'test_roc_thresholds': [],
+        'test_roc_histogram': None,
+        'preprocessing_statistics': [],
         'test_positive_predictive_value': [],
         'test_thresholded_predicted_volume_vox': [],
         'test_thresholded_volume_deltas': [],
@@ -97,6 +480,8 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
         'test_image_wise_jaccards': [],
         'test_image_wise_hausdorff': [],
         'test_image_wise_modified_hausdorff': [],
+        'test_image_wise_hausdorff_95': [],
+        'test_image_wise_average_surface_distance': [],
         'test_image_wise_dice': [],
         'test_image_wise_roc_auc': [],
         'test_image_wise_fpr': [],
@@ -104,47 +489,100 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
         'test_image_wise_roc_thresholds': [],
         'evaluation_thresholds': [],
         'optimal_thresholds_on_test_data': [],
+        'test_visual_checks': [],
         'test_penumbra_metrics': {
             'predicted_in_penumbra_ratio': []
         }
     }
 
-    print('Repeated kfold', n_repeats, n_folds)
+def collect_fold_result(results, trained_models, figures, fold_result):
+    """
+    Add the result of a fold to the results of the crossvalidation
+    :param fold_result: result dictionary of evaluate_fold or None if the fold failed
+    """
+    if fold_result is None:
+        results['params']['failed_folds'] += 1
+        return
+
+    results['test_accuracy'].append(fold_result['accuracy'])
+    results['test_f1'].append(fold_result['f1'])
+    results['test_roc_auc'].append(fold_result['roc_auc'])
+    results['test_TPR'].append(fold_result['tpr'])
+    results['test_FPR'].append(fold_result['fpr'])
+    results['test_roc_thresholds'].append(fold_result['roc_thresholds'])
+    if results['test_roc_histogram'] is None:
+        results['test_roc_histogram'] = np.zeros_like(fold_result['roc_histogram'])
+    results['test_roc_histogram'] += fold_result['roc_histogram']
+    results['test_jaccard'].append(fold_result['jaccard'])
+    results['test_positive_predictive_value'].append(fold_result['positive_predictive_value'])
+    results['test_thresholded_predicted_volume_vox'].append(fold_result['thresholded_predicted_volume_vox'])
+    results['test_thresholded_volume_deltas'].append(fold_result['thresholded_volume_deltas'])
+    results['test_unthresholded_volume_deltas'].append(fold_result['unthresholded_volume_deltas'])
+    results['test_image_wise_error_ratios'].append(fold_result['image_wise_error_ratios'])
+    results['test_image_wise_jaccards'].append(fold_result['image_wise_jaccards'])
+    results['test_image_wise_hausdorff'].append(fold_result['image_wise_hausdorff'])
+    results['test_image_wise_modified_hausdorff'].append(fold_result['image_wise_modified_hausdorff'])
+    results['test_image_wise_hausdorff_95'].append(fold_result['image_wise_hausdorff_95'])
+    results['test_image_wise_average_surface_distance'].append(fold_result['image_wise_average_surface_distance'])
+    results['test_image_wise_dice'].append(fold_result['image_wise_dice'])
+    results['test_image_wise_roc_auc'].append(fold_result['image_wise_roc_auc'])
+    results['test_image_wise_fpr'].append(fold_result['image_wise_fpr'])
+    results['test_image_wise_tpr'].append(fold_result['image_wise_tpr'])
+    results['test_image_wise_roc_thresholds'].append(fold_result['image_wise_roc_thresholds'])
+    results['train_evals'].append(fold_result['train_evals'])
+    if not (fold_result['penumbra_metrics'] is None):
+        results['test_penumbra_metrics']['predicted_in_penumbra_ratio']\
+            .append(fold_result['penumbra_metrics']['predicted_in_penumbra_ratio'])
+    results['evaluation_thresholds'].append(fold_result['evaluation_threshold'])
+    results['optimal_thresholds_on_test_data'].append(fold_result['optimal_threshold_on_test_data'])
+    results['test_visual_checks'].append(fold_result['visual_check'])
+    results['preprocessing_statistics'].append(fold_result.get('preprocessing_statistics'))
+    trained_models.append(fold_result['trained_model'])
+    figures.append(fold_result['figure'])
+
+def preprocess_data(imgX, clinX, mask_array, feature_scaling = True, pre_smoothing = False, channels_to_normalise = False,
+                    standardiser = None, n_jobs = 1):
+    """
+    Preprocess the data before creating any fold: outlier rescaling, standardisation, smoothing and channel normalisation
 
-    print('Input image data shape:', imgX.shape)
-    n_x, n_y, n_z, n_c = imgX[0].shape
-    if clinX is not None:
-        print('Using clinical data.')
-        if clinX.shape[0] != imgX.shape[0]:
-            raise ValueError('Not the same number of clinical and imaging data points:', clinX.shape, imgX.shape)
-    else:
-        print('Not using clinical data')
+    Args:
+        imgX: image input data for all subjects in form of an np array [subject, x, y, z, c]
+        clinX (optional): clinical input data for all subjects [subject, clinical_data]
+        mask_array: boolean array differentiating brain from background
+        feature_scaling: boolean if data should be normalised
+        pre_smoothing: boolean if gaussian smoothing should be applied on all images slices of z
+            if a tuple is given, it will be used as smoothing kernel shape (only squares allowed)
+        channels_to_normalise: False or array of channels to normalise
+        standardiser (optional): utils.Standardiser used for feature scaling, fitted on the brain voxels of imgX
+            if it is not fitted yet, its statistics can then be stored to standardise new data identically
+        n_jobs (optional, default 1): number of threads used for smoothing
 
-    if os.path.exists(save_dir) and len(os.listdir(save_dir)) != 0:
-        print('This directory already exists: ', save_dir)
-        validation = input('Type `yes` if you wish to delete your previous data:\t')
-        if (validation != 'yes'):
-            raise ValueError('Save Dir for Model already exists. Choose another model name or delete current model')
-        shutil.rmtree(save_dir)
-        os.makedirs(save_dir)
-    start = timeit.default_timer()
+    Returns: (imgX, clinX) preprocessed
+    """
+    if len(imgX.shape) < 5:
+        imgX = np.expand_dims(imgX, axis=5)
+    imgX = imgX.astype(PRECISION['inputs'], copy=False)
 
     # rescale outliers
     imgX = rescale_outliers(imgX, MASKS = mask_array)
 
-    # Standardise data (data - mean / std)
+    # Standardise data (data - mean / std) with the statistics of the brain voxels
     if feature_scaling:
-        imgX, clinX = standardise(imgX, clinX)
+        if standardiser is None:
+            standardiser = Standardiser()
+        if not standardiser.fitted:
+            standardiser.fit(imgX, mask_array, clinX)
+        imgX, clinX = standardiser.transform(imgX, clinX)
 
     # Smooth data with a gaussian Kernel before using it for training/testing
     if pre_smoothing:
         if type(pre_smoothing) == tuple:
             if len(pre_smoothing) == 3:
-                imgX = gaussian_smoothing(imgX, kernel_width=max(pre_smoothing), threeD=True)
+                imgX = gaussian_smoothing(imgX, kernel_width=max(pre_smoothing), threeD=True, n_jobs=n_jobs)
             else:
-                imgX = gaussian_smoothing(imgX, kernel_width=max(pre_smoothing), threeD=False)
+                imgX = gaussian_smoothing(imgX, kernel_width=max(pre_smoothing), threeD=False, n_jobs=n_jobs)
         else:
-            imgX = gaussian_smoothing(imgX)
+            imgX = gaussian_smoothing(imgX, n_jobs=n_jobs)
 
     # Normalise channels by contralateral side before using them for training / testing
     if channels_to_normalise:
@@ -152,113 +590,14 @@ def repeated_kfold_cv(Model_Generator, save_dir, save_function,
             image_normalised_channel, flat_normalised_channel = normalise_channel_by_contralateral(imgX[mask_array], mask_array, c)
             imgX[..., c] = image_normalised_channel
 
-    # Start iteration of repeated_kfold_cv
-    iteration = 0
-    for j in np.random.randint(0, high=10000, size=n_repeats):
-        iteration += 1
-        iteration_dir = os.path.join(save_dir, 'iteration_' + str(iteration))
-        if not os.path.exists(iteration_dir):
-            os.makedirs(iteration_dir)
-
-        print('Crossvalidation: Creating iteration ' + str(iteration) + ' of a total of ' + str(n_repeats))
-
-        fold = 0
-        kf = KFold(n_splits = n_folds, shuffle = True, random_state = j)
-        for train, test in kf.split(imgX, y):
-            n_test_subjects = test.size
-            fold_dir = os.path.join(iteration_dir, 'fold_' + str(fold))
-            if not os.path.exists(fold_dir):
-                os.makedirs(fold_dir)
-
-            # Create a new model for every fold
-            model = Model_Generator(fold_dir, fold, n_channels = n_c, n_channels_out = 1, rf = receptive_field_dimensions)
-
-            # Create this fold
-            try:
-                print('Creating fold : ' + str(fold))
-                create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, test, clinX = clinX, undef_normalisation = undef_normalisation)
-            except Exception as e:
-                tb = traceback.format_exc()
-                print('Creation of fold failed.')
-                print(e)
-                print(tb)
-                if (messaging):
-                    title = 'Minor error upon fold creation rf_hyperopt at ' + str(receptive_field_dimensions) + ' in ' + str(save_dir)
-                    body = 'RF ' + str(receptive_field_dimensions) + '\n' + 'fold ' + str(fold) + '\n' +'iteration ' + str(iteration) + '\n' + 'Error ' + str(e) + '\n' + str(tb)
-                    messaging.send_message(title, body)
-
-            # Evaluate this fold
-            print('Evaluating fold ' + str(fold) + ' of ' + str(n_folds - 1) + ' of iteration' + str(iteration) + ' in', str(fold_dir))
-            try:
-                fold_result = evaluate_fold(model, n_test_subjects, n_x, n_y, n_z, imgX, mask_array, id_array, test)
-
-                results['test_accuracy'].append(fold_result['accuracy'])
-                results['test_f1'].append(fold_result['f1'])
-                results['test_roc_auc'].append(fold_result['roc_auc'])
-                results['test_TPR'].append(fold_result['tpr'])
-                results['test_FPR'].append(fold_result['fpr'])
-                results['test_roc_thresholds'].append(fold_result['roc_thresholds'])
-                results['test_jaccard'].append(fold_result['jaccard'])
-                results['test_positive_predictive_value'].append(fold_result['positive_predictive_value'])
-                results['test_thresholded_predicted_volume_vox'].append(fold_result['thresholded_predicted_volume_vox'])
-                results['test_thresholded_volume_deltas'].append(fold_result['thresholded_volume_deltas'])
-                results['test_unthresholded_volume_deltas'].append(fold_result['unthresholded_volume_deltas'])
-                results['test_image_wise_error_ratios'].append(fold_result['image_wise_error_ratios'])
-                results['test_image_wise_jaccards'].append(fold_result['image_wise_jaccards'])
-                results['test_image_wise_hausdorff'].append(fold_result['image_wise_hausdorff'])
-                results['test_image_wise_modified_hausdorff'].append(fold_result['image_wise_modified_hausdorff'])
-                results['test_image_wise_dice'].append(fold_result['image_wise_dice'])
-                results['test_image_wise_roc_auc'].append(fold_result['image_wise_roc_auc'])
-                results['test_image_wise_fpr'].append(fold_result['image_wise_fpr'])
-                results['test_image_wise_tpr'].append(fold_result['image_wise_tpr'])
-                results['test_image_wise_roc_thresholds'].append(fold_result['image_wise_roc_thresholds'])
-                results['train_evals'].append(fold_result['train_evals'])
-                if not (fold_result['penumbra_metrics'] is None):
-                    results['test_penumbra_metrics']['predicted_in_penumbra_ratio']\
-                        .append(fold_result['penumbra_metrics']['predicted_in_penumbra_ratio'])
-                results['evaluation_thresholds'].append(fold_result['evaluation_threshold'])
-                results['optimal_thresholds_on_test_data'].append(fold_result['optimal_threshold_on_test_data'])
-                trained_models.append(fold_result['trained_model'])
-                figures.append(fold_result['figure'])
-                pass
-            except Exception as e:
-                results['params']['failed_folds'] += 1
-                print('Evaluation of fold failed.')
-                tb = traceback.format_exc()
-                print(e)
-                print(tb)
-
-                if (messaging):
-                    title = 'Minor error upon fold evaluation rf_hyperopt at ' + str(receptive_field_dimensions) + ' in ' + str(save_dir)
-                    body = 'RF ' + str(receptive_field_dimensions) + '\n' + 'fold ' + str(fold) + '\n' +'iteration ' + str(iteration) + '\n' + 'Error ' + str(e) + '\n' + str(tb)
-                    messaging.send_message(title, body)
-
-            # Erase saved fold to free up space
-            try:
-                shutil.rmtree(fold_dir)
-            except:
-                print('No fold to clear.')
-
-            # save current state of progression
-            save_function(results, trained_models, figures)
-
-            fold += 1
-            # End of fold iteration
-
-        try:
-            shutil.rmtree(iteration_dir)
-        except:
-            print('No iteration to clear.')
-        # End of iteration iteration
-
-    end = timeit.default_timer()
-    print('Created, saved and evaluated splits in: ', str(end - start))
-
-    return (results, trained_models)
+    return imgX, clinX
 
-def create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, test, clinX = None, undef_normalisation = True):
+def create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, test, clinX = None, undef_normalisation = True,
+                rf_cache = None, subject_keys = None, sampling_seed = None, subject_scales = None, subject_offsets = None):
     """
     Create a fold given the data and the test / train distribution
+    The inputs are built subject by subject: models with streaming = True receive the FoldBatches of the fold and
+    consume them during training, all other models get the whole fold added to their preallocated buffers
     External Memory: saves the folds as libsvm files
 
     Args:
@@ -269,6 +608,11 @@ def create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, t
         receptive_field_dimensions : in the form of a list as  [rf_x, rf_y, rf_z]
         train: boolean array selecting for Training
         test: boolean array selecting for testing
+        rf_cache (optional): ReceptiveFieldCache to read the receptive fields of the subjects from
+        subject_keys (optional): cache keys of all subjects, required if rf_cache is given
+        sampling_seed (optional): seed of the random undersampling of the training data
+        subject_scales, subject_offsets (optional): affine transform of every subject and channel applied to the
+            receptive fields (imgX * scale - offset, see PreprocessingPipeline)
 
     Returns: undefined
     """
@@ -288,90 +632,185 @@ def create_fold(model, imgX, y, mask_array, receptive_field_dimensions, train, t
     if clinX is not None:
         input_size += clinX[0].size
 
-    imgX_train, y_train, mask_train = imgX[train], y[train], mask_array[train]
-    if clinX is not None:
-        clinX_train = clinX[train]
-
     # Get balancing selector --> random subset respecting population wide distribution
     # Balancing chooses only data inside the brain (mask is applied through balancing)
-    balancing_selector = get_undersample_selector_array(y_train, mask_train)
-
-    model.initialise_train_data(balancing_selector, input_size, n_train, (n_x, n_y, n_z))
-
-    for subject in range(imgX_train.shape[0]):
-        subjects_per_batch = 1
-
-        # reshape to rf expects data with n_subjects in first dimension (here 1)
-        subj_X_train, subj_y_train = np.expand_dims(imgX_train[subject], axis=0), np.expand_dims(y_train[subject], axis=0)
-
-
-        rf_inputs, rf_outputs = rf.reshape_to_receptive_field(subj_X_train, subj_y_train, receptive_field_dimensions)
-
-
-        if clinX is not None:
-            # Add clinical data to every voxel
-            # As discussed here: https://stackoverflow.com/questions/52132331/how-to-add-multiple-extra-columns-to-a-numpy-array/52132400#52132400
-            subj_mixed_inputs = np.zeros((rf_inputs.shape[0], rf_inputs.shape[1] + clinX_train[subject].shape[0]), dtype = np.float) # Initialising matrix of the right size
-            subj_mixed_inputs[:, : rf_inputs.shape[1]] = rf_inputs
-            subj_mixed_inputs[:, rf_inputs.shape[1] :]= clinX_train[subject]
-            all_inputs = subj_mixed_inputs
-        else:
-            all_inputs = rf_inputs
-
-
-        # Add a normalization term to account for the number of voxels outside the defined brain in a receptive field
-        if np.max(receptive_field_dimensions) > 0 and undef_normalisation:
-            undef_normalisation_terms = rf.cardinal_undef_in_receptive_field(
-                np.expand_dims(mask_array[subject], axis=0), receptive_field_dimensions)
-            all_inputs = np.concatenate((all_inputs, undef_normalisation_terms.reshape(-1, 1)), axis=1)
+    balancing_selector = get_undersample_selector_array(y[train], mask_array[train], rng = sampling_seed)
+
+    fold_batch_settings = {
+        'receptive_field_dimensions': receptive_field_dimensions,
+        'input_size': input_size,
+        'clinX': clinX,
+        'undef_normalisation': undef_normalisation,
+        'rf_cache': rf_cache,
+        'subject_keys': subject_keys,
+        'subject_scales': subject_scales,
+        'subject_offsets': subject_offsets
+    }
+    train_batches = FoldBatches(imgX, y, mask_array, train, balancing_selector, **fold_batch_settings)
+    test_batches = FoldBatches(imgX, y, mask_array, test, mask_array[test], **fold_batch_settings)
 
-        # Balance by using predefined balancing_selector
-        selected_for_training = balancing_selector[subject].reshape(-1)
-        subj_X_train, subj_y_train = all_inputs[selected_for_training], rf_outputs[selected_for_training]
+    # Streaming models consume the batches themselves (possibly several times) without the fold ever being materialised
+    if getattr(model, 'streaming', False):
+        model.initialise_train_stream(train_batches, input_size, n_train, (n_x, n_y, n_z))
+        model.initialise_test_stream(test_batches, input_size, n_test, (n_x, n_y, n_z))
+        return
 
-        model.add_train_data(subj_X_train, subj_y_train, selected_for_training, subjects_per_batch)
+    model.initialise_train_data(balancing_selector, input_size, n_train, (n_x, n_y, n_z))
+    for X_batch, y_batch, positions in train_batches:
+        model.add_train_data(X_batch, y_batch, positions, positions.shape[0])
 
+    model.initialise_test_data(np.sum(mask_array[test]), input_size, n_test, (n_x, n_y, n_z))
+    for X_batch, y_batch, positions in test_batches:
+        model.add_test_data(X_batch, y_batch, positions, positions.shape[0])
 
-    X_test, y_test, mask_test = imgX[test], y[test], mask_array[test]
-    if clinX is not None:
-        clinX_test = clinX[test]
-
+class FoldBatches():
+    """
+    Stream over the inputs of one side (train or test) of a fold, built subject by subject when iterated
+    Every iteration yields (X_batch, y_batch, positions) with positions the boolean selector [n_images, x, y, z]
+    of the voxels in the batch. The stream can be iterated several times (ie. once per epoch).
+    """
 
-    model.initialise_test_data(np.sum(mask_test), input_size, n_test, (n_x, n_y, n_z))
+    def __init__(self, imgX, y, mask_array, subjects, selector, receptive_field_dimensions, input_size, clinX = None,
+                 undef_normalisation = True, rf_cache = None, subject_keys = None, subjects_per_batch = 1,
+                 subject_scales = None, subject_offsets = None):
+        """
+        Args:
+            imgX: image input data for all subjects [subject, x, y, z, c]
+            y: dependent variables for all subjects [subject, x, y, z]
+            mask_array: boolean array differentiating brain from background for all subjects
+            subjects: indices or boolean array of the subjects in this stream
+            selector: boolean array selecting the voxels of every subject of the stream [n_subjects, x, y, z]
+            receptive_field_dimensions : in the form of a list as  [rf_x, rf_y, rf_z]
+            input_size: number of features per voxel
+            clinX (optional): clinical input data for all subjects
+            undef_normalisation: add the number of voxels outside the brain in every receptive field
+            rf_cache (optional): ReceptiveFieldCache to read the receptive fields from
+            subject_keys (optional): cache keys of all subjects, required if rf_cache is given
+            subjects_per_batch: number of subjects in every batch
+            subject_scales, subject_offsets (optional): affine transform of every subject and channel
+                (see fill_subject_inputs)
+        """
+        self.imgX, self.y, self.mask_array, self.clinX = imgX, y, mask_array, clinX
+        self.subjects = np.arange(len(imgX))[subjects]
+        self.selector = selector
+        self.receptive_field_dimensions = receptive_field_dimensions
+        self.input_size = input_size
+        self.undef_normalisation = undef_normalisation
+        self.rf_cache = rf_cache
+        self.subject_keys = subject_keys
+        self.subjects_per_batch = subjects_per_batch
+        self.subject_scales = subject_scales
+        self.subject_offsets = subject_offsets
+
+    @property
+    def n_datapoints(self):
+        return int(np.sum(self.selector))
+
+    def __len__(self):
+        return int(np.ceil(len(self.subjects) / self.subjects_per_batch))
+
+    def labels(self):
+        """
+        Labels of all voxels of the stream in iteration order, without building the inputs
+        """
+        return np.concatenate([self.y[subject][self.selector[i]] for i, subject in enumerate(self.subjects)]
+                              + [np.empty(0, dtype = self.y.dtype)])
+
+    def __iter__(self):
+        for start in range(0, len(self.subjects), self.subjects_per_batch):
+            stop = min(start + self.subjects_per_batch, len(self.subjects))
+            X_batch, y_batch = [], []
+            for i in range(start, stop):
+                subject = self.subjects[i]
+                X_batch.append(fill_subject_inputs(
+                    self.imgX[subject], self.selector[i], self.mask_array[subject],
+                    self.receptive_field_dimensions, self.input_size,
+                    subj_clinX = self.clinX[subject] if self.clinX is not None else None,
+                    undef_normalisation = self.undef_normalisation, rf_cache = self.rf_cache,
+                    subj_key = self.subject_keys[subject] if self.rf_cache is not None else None,
+                    subj_scale = self.subject_scales[subject] if self.subject_scales is not None else None,
+                    subj_offset = self.subject_offsets[subject] if self.subject_offsets is not None else None))
+                y_batch.append(self.y[subject][self.selector[i]])
+
+            if len(X_batch) == 1:
+                yield X_batch[0], y_batch[0], self.selector[start:stop]
+            else:
+                yield np.concatenate(X_batch), np.concatenate(y_batch), self.selector[start:stop]
 
-    for subject in range(X_test.shape[0]):
-        # reshape to rf expects data with n_subjects in first
-        subj_X_test, subj_y_test = np.expand_dims(X_test[subject], axis=0), np.expand_dims(y_test[subject], axis=0)
+def fill_subject_inputs(subj_imgX, subj_selector, subj_mask, receptive_field_dimensions, input_size,
+                        subj_clinX = None, undef_normalisation = True, rf_cache = None, subj_key = None,
+                        subj_scale = None, subj_offset = None):
+    """
+    Build the model inputs of the selected voxels of a single subject
+    Only the receptive fields of selected voxels are gathered, directly into the preallocated input array
 
-        rf_inputs, rf_outputs = rf.reshape_to_receptive_field(subj_X_test, subj_y_test, receptive_field_dimensions)
+    Args:
+        subj_imgX: image input data of the subject [x, y, z, c]
+        subj_selector: boolean array selecting the voxels to build inputs for [x, y, z]
+        subj_mask: boolean array differentiating brain from background [x, y, z]
+        receptive_field_dimensions : in the form of a list as  [rf_x, rf_y, rf_z]
+        input_size: number of features per voxel (rf + clinical data + normalisation term)
+        subj_clinX (optional): clinical input data of the subject
+        undef_normalisation: add the number of voxels outside the brain in every receptive field
+        rf_cache (optional): ReceptiveFieldCache to read the receptive fields from
+        subj_key (optional): cache key of the subject
+        subj_scale, subj_offset (optional): affine transform of every channel of the subject (imgX * scale - offset),
+            applied to the gathered receptive fields; voxels outside of the image stay 0 as the zero padding
+
+    Returns: inputs of the selected voxels [n_selected, input_size]
+    """
+    n_selected = np.sum(subj_selector)
+    all_inputs = np.empty((n_selected, input_size), dtype = PRECISION['inputs'])
 
-        if clinX is not None:
-            # Add clinical data to every voxel
-            subj_mixed_inputs = np.zeros((rf_inputs.shape[0], rf_inputs.shape[1] + clinX_test[subject].shape[0]), np.float) # Initialising matrix of the right size
-            subj_mixed_inputs[:, : rf_inputs.shape[1]] = rf_inputs
-            subj_mixed_inputs[:, rf_inputs.shape[1] :]= clinX_test[subject]
-            all_inputs = subj_mixed_inputs
-        else:
-            all_inputs = rf_inputs
+    if rf_cache is not None:
+        rf_inputs = rf_cache.gather(subj_key, subj_imgX, subj_selector, subj_mask, receptive_field_dimensions,
+                                    out = all_inputs)
+    else:
+        rf_inputs = rf.gather_receptive_fields(np.expand_dims(subj_imgX, axis=0), receptive_field_dimensions,
+                                               np.expand_dims(subj_selector, axis=0), out = all_inputs)
+    n_features = rf_inputs.shape[1]
+
+    if subj_scale is not None:
+        n_c = subj_imgX.shape[-1]
+        window_size = n_features // n_c
+        inside = None
+        if np.max(receptive_field_dimensions) > 0:
+            inside = rf.inside_image_in_receptive_field(subj_imgX.shape[:-1], receptive_field_dimensions,
+                                                        np.expand_dims(subj_selector, axis=0))
+            if np.all(inside):
+                inside = None
+        for c in range(n_c):
+            channel_inputs = rf_inputs[:, c * window_size : (c + 1) * window_size]
+            channel_inputs *= subj_scale[c].astype(channel_inputs.dtype)
+            if inside is None:
+                channel_inputs -= subj_offset[c].astype(channel_inputs.dtype)
+            else:
+                channel_inputs -= subj_offset[c].astype(channel_inputs.dtype) * inside
 
-        # Add a normalization term to account for the number of voxels outside the defined brain in a receptive field
-        if np.max(receptive_field_dimensions) > 0 and undef_normalisation:
-            undef_normalisation_terms = rf.cardinal_undef_in_receptive_field(
-                np.expand_dims(mask_array[subject], axis=0), receptive_field_dimensions)
-            all_inputs = np.concatenate((all_inputs, undef_normalisation_terms.reshape(-1, 1)), axis=1)
+    if subj_clinX is not None:
+        # Add clinical data to every voxel
+        all_inputs[:, n_features : n_features + subj_clinX.shape[0]] = subj_clinX
+        n_features += subj_clinX.shape[0]
 
-        selected_for_testing = mask_test[subject].reshape(-1)
-        subj_X_test, subj_y_test = all_inputs[selected_for_testing], rf_outputs[selected_for_testing]
+    # Add a normalization term to account for the number of voxels outside the defined brain in a receptive field
+    if np.max(receptive_field_dimensions) > 0 and undef_normalisation:
+        undef_normalisation_terms = rf.cardinal_undef_in_receptive_field(
+            np.expand_dims(subj_mask, axis=0), receptive_field_dimensions)
+        all_inputs[:, n_features] = undef_normalisation_terms[0][subj_selector]
 
-        model.add_test_data(subj_X_test, subj_y_test, selected_for_testing, subjects_per_batch)
+    return all_inputs
 
-def evaluate_fold(model, n_test_subjects, n_x, n_y, n_z, imgX, mask_array, id_array, test):
+def evaluate_fold(model, n_test_subjects, n_x, n_y, n_z, imgX, mask_array, id_array, test, render_figure = True,
+                  preprocessing_pipeline = None):
     """
     Patient wise Repeated KFold Crossvalidation
     This function evaluates a saved datafold
     Args:
         model
         n_test_subjects
+        render_figure (optional, default True): build the visual check figure (see scoring_utils.evaluate)
+        preprocessing_pipeline (optional): fitted PreprocessingPipeline of the fold, imgX is then its subject data
+            and only the test subjects are transformed
 
     Returns: result dictionary
     """
@@ -381,11 +820,15 @@ def evaluate_fold(model, n_test_subjects, n_x, n_y, n_z, imgX, mask_array, id_ar
     probas_ = model.predict_test_data()
     y_test = model.get_test_labels()
     mask_test = mask_array[test]
-    imgX_test = imgX[test][mask_test]
+    if preprocessing_pipeline is not None:
+        imgX_test = preprocessing_pipeline.transform(test)[0][mask_test]
+    else:
+        imgX_test = imgX[test][mask_test]
     if id_array is not None: ids_test = id_array[test]
     else: ids_test = None
 
-    results = evaluate(probas_, y_test, mask_test, ids_test, n_test_subjects, n_x, n_y, n_z, model_threshold)
+    results = evaluate(probas_, y_test, mask_test, ids_test, n_test_subjects, n_x, n_y, n_z, model_threshold,
+                       render_figure = render_figure)
     print('Model successfully tested.')
     results['trained_model'] = trained_model
     results['train_evals'] = evals_result
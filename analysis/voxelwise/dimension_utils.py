@@ -7,6 +7,6 @@ def reconstruct_image(data_points, data_positions, n_channels):
     :param data_positions: (n, x, y, z) boolean array where True marks a given data_point
     :return: reconstructed
     '''
-    reconstructed = np.zeros(data_positions.shape + tuple([n_channels]))
+    reconstructed = np.zeros(data_positions.shape + tuple([n_channels]), dtype=data_points.dtype)
     reconstructed[data_positions == 1] = data_points
     return reconstructed
\ No newline at end of file
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.ndimage import distance_transform_edt, binary_erosion, generate_binary_structure
+
+
+def surface(segmentation):
+    '''
+    Surface voxels of a segmentation: foreground voxels with at least one background neighbour (6-connectivity)
+    Voxels at the border of the image are part of the surface
+    :param segmentation: boolean array [x, y, z]
+    :return: boolean array of surface voxels [x, y, z]
+    '''
+    structure = generate_binary_structure(segmentation.ndim, 1)
+    return segmentation & ~binary_erosion(segmentation, structure = structure, border_value = 0)
+
+def surface_distances(reference, prediction, spacing = None):
+    '''
+    Distances between the surfaces of two segmentations, computed with euclidean distance transforms
+    The distance transforms are only computed on the bounding box of both segmentations (plus a margin of one voxel),
+    which contains every surface voxel and hence gives the same distances as on the whole image.
+    :param reference: boolean array (ie. ground truth) [x, y, z]
+    :param prediction: boolean array [x, y, z]
+    :param spacing (optional): voxel size along every axis
+    :return: (reference_to_prediction, prediction_to_reference) - distance of every surface voxel of a segmentation
+        to the closest surface voxel of the other one
+    '''
+    reference = np.asarray(reference, dtype = bool)
+    prediction = np.asarray(prediction, dtype = bool)
+    if reference.shape != prediction.shape:
+        raise ValueError('Shape mismatch: reference and prediction must have the same shape.', reference.shape, prediction.shape)
+
+    foreground = np.argwhere(reference | prediction)
+    lower = np.maximum(foreground.min(axis = 0) - 1, 0)
+    upper = np.minimum(foreground.max(axis = 0) + 2, reference.shape)
+    bounding_box = tuple(slice(l, u) for l, u in zip(lower, upper))
+
+    reference_surface = surface(reference[bounding_box])
+    prediction_surface = surface(prediction[bounding_box])
+    # distance of every voxel to the closest surface voxel of the other segmentation
+    distance_to_prediction = distance_transform_edt(~prediction_surface, sampling = spacing)
+    distance_to_reference = distance_transform_edt(~reference_surface, sampling = spacing)
+
+    return distance_to_prediction[reference_surface], distance_to_reference[prediction_surface]
+
+def hausdorff_metrics(reference, prediction, spacing = None, percentile = 95):
+    '''
+    Surface distance metrics between two segmentations
+    If only one of the segmentations is empty, distances are undefined and returned as nan (as sklearn does for
+    undefined metrics), so that they can be left out of aggregates with nan aware functions (ie. np.nanmedian);
+    if both are empty they are 0.
+    :param reference: boolean array (ie. ground truth) [x, y, z]
+    :param prediction: boolean array [x, y, z]
+    :param spacing (optional): voxel size along every axis
+    :param percentile (optional, default 95): percentile used for the robust hausdorff distance
+    :return: dict with
+        'hausdorff': symmetric hausdorff distance
+        'hausdorff_95': symmetric percentile hausdorff distance
+        'modified_hausdorff': modified hausdorff distance (Dubuisson and Jain, 1994) - max of both mean distances
+        'average_surface_distance': mean distance of all surface voxels of both segmentations
+    '''
+    reference_empty, prediction_empty = not np.any(reference), not np.any(prediction)
+    if reference_empty or prediction_empty:
+        distance = 0.0 if reference_empty and prediction_empty else np.nan
+        return {'hausdorff': distance, 'hausdorff_95': distance, 'modified_hausdorff': distance,
+                'average_surface_distance': distance}
+
+    reference_to_prediction, prediction_to_reference = surface_distances(reference, prediction, spacing)
+    return {
+        'hausdorff': max(reference_to_prediction.max(), prediction_to_reference.max()),
+        'hausdorff_95': max(np.percentile(reference_to_prediction, percentile),
+                            np.percentile(prediction_to_reference, percentile)),
+        'modified_hausdorff': max(reference_to_prediction.mean(), prediction_to_reference.mean()),
+        'average_surface_distance': np.concatenate([reference_to_prediction, prediction_to_reference]).mean()
+    }
@@ -1,5 +1,100 @@
 import numpy as np
-import uuid, os
+import uuid, os, shutil, itertools
+
+
+class SvmlightWriter():
+    """
+    Buffered svmlight / libsvm writer appending to a file
+    Rows are formatted in vectorised chunks: the sparse (CSR) structure of a chunk is built with numpy and
+    all its lines are formatted with a single % operation, no Python loop over rows or columns is needed.
+    The output is byte identical to formatting every row with '%i' / '%i:%f'.
+    The first row of every written batch is dense, to mention all columns
+    This avoids having a different column number between training and testing
+
+    Usage:
+        with SvmlightWriter(path) as writer:
+            writer.write(X, y)
+    """
+
+    TOKENS = np.array(['%i', ' %i:%f', ' \n'])
+
+    def __init__(self, path, buffer_size = 2**20, chunk_size = 10000):
+        """
+        Args:
+            path: to save the file to (appended to if it exists)
+            buffer_size: size of the write buffer in bytes
+            chunk_size: number of rows formatted at once
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.file = None
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a', buffering = self.buffer_size)
+        return self
+
+    def write(self, data, labels, selector = None):
+        """
+        Append a batch of samples to the file
+
+        Args:
+            data: X
+            labels: y
+            selector (optional): boolean array selecting the samples to write (ie. to undersample while writing)
+        """
+        if self.file is None:
+            self.open()
+        if selector is not None:
+            data, labels = data[selector], labels[selector]
+        for start in range(0, data.shape[0], self.chunk_size):
+            self.file.write(self.format_rows(data[start : start + self.chunk_size],
+                                             labels[start : start + self.chunk_size], dense_first_row = start == 0))
+
+    def format_rows(self, data, labels, dense_first_row = False):
+        """
+        Format rows as svmlight lines: label index:value ... (indices starting at 1, values as '%f')
+        """
+        data = np.asarray(data)
+        labels = np.asarray(labels)[:data.shape[0]]
+        selected = data != 0
+        if dense_first_row and data.shape[0] > 0:
+            selected[0] = True
+
+        # format all lines with a single % operation
+        # every line is a label token, a token per value and an end of line token
+        rows, columns = np.nonzero(selected)
+        counts = np.bincount(rows, minlength = data.shape[0])
+        line_ends = np.cumsum(counts + 2) - 1
+        token_kinds = np.ones(rows.size + 2 * data.shape[0], dtype = np.intp)
+        token_kinds[line_ends] = 2
+        token_kinds[line_ends - counts - 1] = 0
+        line_format = ''.join(self.TOKENS[token_kinds].tolist())
+
+        arguments = np.empty(data.shape[0] + 2 * rows.size, dtype = np.float64)
+        label_positions = np.cumsum(2 * counts + 1) - (2 * counts + 1)
+        is_label = np.zeros(arguments.size, dtype = bool)
+        is_label[label_positions] = True
+        arguments[is_label] = labels
+        arguments[~is_label] = np.column_stack([columns + 1, data[selected]]).reshape(-1)
+
+        return line_format % tuple(arguments.tolist())
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 # As inspired from https://stackoverflow.com/a/9312702/3903778
@@ -18,58 +113,136 @@ def save_to_svmlight(data, labels, path):
 
     Returns: undefined
     """
+    with SvmlightWriter(path) as writer:
+        writer.write(data, labels)
 
-    try:
-        file = open(path, 'a')
-    except IOError:
-        file = open(path, 'w')
-
-    first = True
-    for i, x in enumerate(data):
-        indexes = x.nonzero()[0]
-        values = x[indexes]
-
-        # Let the first line be not sparse, to mention all columns
-        # This avoids having a different column number between training and testing
-        if first:
-            indexes = np.array(range(x.size))
-            values = x
-            first = False
-
-        label = '%i'%(labels[i])
-        pairs = ['%i:%f'%(indexes[j] + 1, values[j]) for j in range(len(indexes))]
+class BlockStore():
+    """
+    Binary external memory store: every added batch is saved as a block of fixed width rows (.npy)
+    Compared to svmlight files, nothing has to be formatted or parsed and the data takes about 5x less disk space.
+    When iterated, blocks are read back one at a time as memory maps and yielded as (X_block, y_block, None),
+    ie. in the same form as the batches of a fold (see cv_framework.FoldBatches).
+    """
 
-        sep_line = [label]
-        sep_line.extend(pairs)
-        sep_line.append('\n')
+    def __init__(self, store_dir, dtype = np.float32):
+        """
+        Args:
+            store_dir: directory to save the blocks to (created if needed)
+            dtype: dtype of the saved rows
+        """
+        self.store_dir = store_dir
+        self.dtype = dtype
+        self.n_blocks = 0
+        self.n_rows = 0
+        self.n_columns = None
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def block_paths(self, block):
+        return (os.path.join(self.store_dir, 'X_' + str(block) + '.npy'),
+                os.path.join(self.store_dir, 'y_' + str(block) + '.npy'))
+
+    def append(self, data, labels):
+        """
+        Save a batch as a new block
+
+        Args:
+            data: X [n_rows, n_columns]
+            labels: y [n_rows]
+        """
+        if self.n_columns is None:
+            self.n_columns = data.shape[1]
+        if data.shape[1] != self.n_columns:
+            raise ValueError('All blocks need the same number of columns', self.n_columns, data.shape[1])
+        if data.shape[0] == 0:
+            return
+
+        data_path, labels_path = self.block_paths(self.n_blocks)
+        np.save(data_path, np.ascontiguousarray(data, dtype = self.dtype))
+        np.save(labels_path, np.asarray(labels, dtype = np.float32))
+        self.n_blocks += 1
+        self.n_rows += data.shape[0]
+
+    def __len__(self):
+        return self.n_blocks
+
+    def __iter__(self):
+        for block in range(self.n_blocks):
+            data_path, labels_path = self.block_paths(block)
+            yield np.load(data_path, mmap_mode='r'), np.load(labels_path), None
+
+    def labels(self):
+        return np.concatenate([np.load(self.block_paths(block)[1]) for block in range(self.n_blocks)]
+                              + [np.empty(0, dtype = np.float32)])
+
+    def clear(self):
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+        self.n_blocks, self.n_rows = 0, 0
+
+def filter_lines(input_filepath, line_selector, output_filepath = None, buffer_size = 2**24):
+    """
+    Keep only the selected lines of a file in a single pass without loading the whole file into RAM
+    The file is read and written with large buffers, by blocks of lines
 
-        line = ' '.join(sep_line)
+    Args:
+        input_filepath: path of file to filter
+        line_selector: boolean array with True for lines to keep, lines beyond its length are kept
+        output_filepath (optional): path to write the filtered file to, by default the input file is replaced
+        buffer_size: size of read / write buffers in bytes
 
-        file.write(line)
+    Returns: number of lines kept
+    """
+    if output_filepath is None:
+        output_filepath = input_filepath
+    output_dir = os.path.dirname(os.path.abspath(output_filepath))
+    temp_file_path = os.path.join(output_dir, str(uuid.uuid4()))
 
-def delete_lines(input_filepath, indeces_to_delete):
+    line_count = 0
+    kept_lines = 0
+    with open(input_filepath, 'rb', buffering = buffer_size) as input_file:
+        with open(temp_file_path, 'wb', buffering = buffer_size) as temp_file:
+            while True:
+                lines = input_file.readlines(buffer_size)
+                if not lines:
+                    break
+                keep = np.ones(len(lines), dtype = bool)
+                selected_block = line_selector[line_count : line_count + len(lines)]
+                keep[:selected_block.size] = selected_block
+                temp_file.writelines(itertools.compress(lines, keep))
+                line_count += len(lines)
+                kept_lines += int(np.sum(keep))
+
+    os.replace(temp_file_path, output_filepath)
+    return kept_lines
+
+def delete_lines(input_filepath, indeces_to_delete, buffer_size = 2**24):
     """
     Delete selected lines by index without loading whole file into RAM
+    Lines to delete are marked in a bitmap, the file is then filtered in a single buffered pass (see filter_lines)
 
     Args:
         input_filepath: path of file to delete lines from
         indeces_to_delete: np.array of indeces to delete
+        buffer_size: size of read / write buffers in bytes
 
     Returns: undefined
     """
-    line_count = 0
-    input_dir = os.path.dirname(os.path.abspath(input_filepath))
-    temp_file_path = os.path.join(input_dir, str(uuid.uuid4()))
-    if os.path.isfile(temp_file_path):
-        # file exists
-        print('Stopped because overwriting file: ', temp_file_path)
-
-    with open(input_filepath, 'r') as input_file:
-        with open(temp_file_path, 'w+') as temp_file:
-            for line in input_file:
-                if not np.isin(line_count, indeces_to_delete) :
-                    temp_file.write(line)
-                line_count += 1
-
-    os.remove(input_filepath)
-    os.rename(temp_file_path, input_filepath)
+    indeces_to_delete = np.asarray(indeces_to_delete, dtype = np.int64).reshape(-1)
+    line_selector = np.ones(np.max(indeces_to_delete) + 1 if indeces_to_delete.size > 0 else 0, dtype = bool)
+    line_selector[indeces_to_delete] = False
+    filter_lines(input_filepath, line_selector, buffer_size = buffer_size)
+
+def read_svmlight_labels(input_filepath, buffer_size = 2**24):
+    """
+    Read the labels (first element of every line) of an svmlight file, without parsing the features
+
+    Returns: labels as np.array
+    """
+    labels = [np.empty(0)]
+    with open(input_filepath, 'rb', buffering = buffer_size) as input_file:
+        while True:
+            lines = input_file.readlines(buffer_size)
+            if not lines:
+                break
+            labels.append(np.array([line.split(b' ', 1)[0] for line in lines], dtype = np.float64))
+    return np.concatenate(labels)
@@ -0,0 +1,52 @@
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../'))
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from voxelwise.scoring_utils import save_visual_check
+from voxelwise.results_store import load_results
+
+
+def render_visual_checks(output_dir, model_name, n_jobs = 1, overwrite = False):
+    """
+    Render the visual check figures of every fold of a crossvalidation from the centre slices saved in its results
+    (see repeated_kfold_cv with render_figures = False)
+
+    Args:
+        output_dir: output directory of the model (containing its results store or scores_<model_name>.npy)
+        model_name: name of the model
+        n_jobs (optional, default 1): number of processes rendering figures in parallel
+        overwrite (optional, default False): render figures that already exist again
+
+    Returns:
+        list of paths of the rendered figures
+    """
+    plt.ioff()
+    plt.switch_backend('agg')
+    results = load_results(output_dir, model_name)
+    visual_dir = os.path.join(output_dir, 'visual_check')
+    if not os.path.exists(visual_dir):
+        os.makedirs(visual_dir)
+
+    figure_paths = []
+    to_render = []
+    for i, visual_check in enumerate(results.get('test_visual_checks', [])):
+        figure_path = os.path.join(visual_dir, model_name + '_test_predictions_fold_' + str(i))
+        figure_paths.append(figure_path)
+        if overwrite or not os.path.exists(figure_path + '.png'):
+            to_render.append((visual_check, figure_path))
+    print('Rendering', len(to_render), 'of', len(figure_paths), 'visual check figures of', model_name)
+
+    if n_jobs > 1 and len(to_render) > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            list(executor.map(save_visual_check, *zip(*to_render)))
+    else:
+        for visual_check, figure_path in to_render:
+            save_visual_check(visual_check, figure_path)
+
+    return figure_paths
+
+
+if __name__ == '__main__':
+    # python visual_check.py <output_dir> <model_name> [n_jobs]
+    n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    render_visual_checks(sys.argv[1], sys.argv[2], n_jobs = n_jobs)
@@ -13,9 +13,11 @@ data_dir = os.path.join(main_dir, '')
 main_output_dir = os.path.join(main_dir, 'models')
 main_save_dir = os.path.join(main_dir, 'temp_data')
 
-clinical_inputs, ct_inputs, ct_label, _, _, brain_masks, ids, params = data_loader.load_saved_data(data_dir)
+# only the Tmax channel is used: other channels are never loaded
+dataset = data_loader.LazyDataset(data_dir).channels([0])
+ct_label, brain_masks, ids = dataset.ct_lesion_GT, dataset.brain_masks, dataset.ids
 # Order: 'wcoreg_RAPID_Tmax', 'wcoreg_RAPID_rCBF', 'wcoreg_RAPID_MTT', 'wcoreg_RAPID_rCBV'
-ct_inputs = ct_inputs[:, :, :, :, 0]
+ct_inputs = dataset.ct_inputs[..., 0]
 
 # Ignore clinical data for now
 clinical_inputs = None
@@ -4,7 +4,7 @@ import numpy as np
 import data_loader
 from vxl_glm.LogReg_glm import LogReg_glm
 from vxl_continuous.normalized_marker_model import Normalized_marker_Model_Generator
-from utils import rescale_outliers, standardise
+from utils import rescale_outliers, standardise, Standardiser
 from voxelwise import receptiveField
 from visual import display
 import skimage.measure as measure
@@ -22,7 +22,13 @@ def create_background_mask(ct_inputs):
     return labeled
 
 def model_predict(model_path, data_dir, model_type, subject_id, rf=3, fold=0, inverse_relation=False,
-                  feature_scaling=True, channel=None, mask_CSF=True, mask_background=True, save_dir=None, save_GT=False):
+                  feature_scaling=True, channel=None, mask_CSF=True, mask_background=True, save_dir=None, save_GT=False,
+                  standardisation=None):
+    '''
+    Predict the lesion of a subject with a trained model
+    :param standardisation (optional): statistics of the standardisation of the training data (see utils.Standardiser),
+        read from the scores (statistics of the fold) or params saved next to the model if not given
+    '''
     # Load data
     clinical_inputs, ct_inputs, ct_label, _, _, brain_masks, ids, params = data_loader.load_saved_data(data_dir)
     # Order: 'wcoreg_RAPID_Tmax', 'wcoreg_RAPID_rCBF', 'wcoreg_RAPID_MTT', 'wcoreg_RAPID_rCBV'
@@ -58,14 +64,30 @@ def model_predict(model_path, data_dir, model_type, subject_id, rf=3, fold=0, in
     Model_Generator.hello_world()
     model = Model_Generator('', fold, n_channels=n_c, n_channels_out=1, rf=rf, model=saved_model)
 
-    # Preprocess data
+    # Preprocess data with the statistics of the training subjects of the fold if they were saved with the model
+    # (see PreprocessingPipeline), otherwise with the statistics of the whole training data
+    cohort_medians = None
+    model_file = os.path.basename(model_path)
+    scores_path = os.path.join(os.path.dirname(model_path), model_file.replace('trained_models_', 'scores_'))
+    params_path = os.path.join(os.path.dirname(model_path), model_file.replace('trained_models_', 'params_'))
+    if standardisation is None and os.path.exists(scores_path):
+        fold_statistics = torch.load(scores_path).get('preprocessing_statistics')
+        if fold_statistics and fold_statistics[fold] is not None:
+            cohort_medians = fold_statistics[fold]['cohort_medians']
+            standardisation = fold_statistics[fold]['standardisation']
+    if standardisation is None and os.path.exists(params_path):
+        standardisation = torch.load(params_path).get('standardisation')
+
     # rescale outliers
-    imgX = rescale_outliers(imgX, MASKS=maskX)
+    imgX = rescale_outliers(imgX, MASKS=maskX, cohort_medians=cohort_medians)
 
     if feature_scaling:
-        # Standardise data (data - mean / std)
-        if feature_scaling:
-            imgX, _ = standardise(imgX, None)
+        # Standardise data (data - mean / std) with the statistics of the training data
+        if standardisation is not None:
+            imgX, _ = Standardiser(standardisation).transform(imgX)
+        else:
+            print('No standardisation statistics saved with the model, standardising with the statistics of the subject.')
+            imgX, _ = standardise(imgX, None, maskX)
 
     start = timeit.default_timer()
 
@@ -0,0 +1,205 @@
+import numpy as np
+from utils import gaussian_smoothing, Standardiser, PRECISION
+from voxelwise.channel_normalisation import normalise_channel_by_contralateral
+
+
+class PreprocessingPipeline():
+    """
+    Fold aware preprocessing: outlier rescaling, standardisation, smoothing and channel normalisation
+    in the order of preprocess_data, with statistics computed on the training subjects of a fold only
+    (fitted on all subjects, the pipeline gives the data of preprocess_data)
+
+    Per-subject transforms and statistics do not depend on the fold and are computed once for all folds:
+        - gaussian smoothing of the raw data (subject_data)
+        - voxels of every channel in the brain mask of the raw data (for the outlier detection)
+        - count, mean and sum of squared deviations of every channel in the brain mask of the raw data
+    The fold dependent part is then an affine transform per subject and channel:
+        - outliers are subjects whose median exceeds 5 times the median of the brain voxels of the
+          training subjects, they are divided by 10 (as utils.rescale_outliers)
+        - means and variances of the rescaled training subjects are merged from their cached moments
+    Smoothing is linear and preserves constants, it thus commutes with the affine transform.
+    Channels normalised by their contralateral side are normalised after the affine transform, for every subject
+    and fold (see transform). Without channel normalisation, folds can read the subject data directly and apply
+    the affine to the voxels they use (see cv_framework.fill_subject_inputs), instead of transforming all subjects.
+
+    Usage:
+        pipeline = PreprocessingPipeline(imgX, clinX, mask_array, feature_scaling, pre_smoothing, channels_to_normalise)
+        for train, test in folds:
+            pipeline.fit(train)
+            test_imgX, test_clinX = pipeline.transform(test)
+    """
+
+    def __init__(self, imgX, clinX, mask_array, feature_scaling = True, pre_smoothing = False,
+                 channels_to_normalise = False, subject_state = None, n_jobs = 1, smoothed_data = None):
+        """
+        Args:
+            imgX: image input data for all subjects [subject, x, y, z, c]
+            clinX (optional): clinical input data for all subjects [subject, clinical_data]
+            mask_array: boolean array differentiating brain from background
+            feature_scaling: boolean if data should be standardised
+            pre_smoothing: boolean if gaussian smoothing should be applied on all images slices of z
+                if a tuple is given, it will be used as smoothing kernel shape (only squares allowed)
+            channels_to_normalise: False or array of channels to normalise by their contralateral side
+            subject_state (optional): state of the per-subject transforms as given by subject_state(),
+                imgX is then the subject data of that pipeline (ie. shared with other processes) and
+                the per-subject transforms are not computed again
+            n_jobs (optional, default 1): number of threads smoothing subjects in parallel
+            smoothed_data (optional): imgX already smoothed with the kernel of pre_smoothing
+                (ie. a level of utils.gaussian_scale_space), used instead of smoothing imgX
+        """
+        self.clinX = clinX
+        self.mask_array = mask_array
+        self.feature_scaling = feature_scaling
+        self.pre_smoothing = pre_smoothing
+        self.channels_to_normalise = list(channels_to_normalise) if channels_to_normalise else []
+        if len(imgX.shape) < 5:
+            imgX = np.expand_dims(imgX, axis=-1)
+
+        if subject_state is None:
+            if smoothed_data is not None:
+                self.subject_data = np.asarray(smoothed_data, dtype = PRECISION['inputs'])
+            else:
+                self.subject_data = self.smooth(imgX, n_jobs)
+            n_subj, n_c = imgX.shape[0], imgX.shape[-1]
+            self.brain_values = np.empty((int(np.sum(mask_array != 0)), n_c), dtype = PRECISION['inputs'])
+            self.subject_medians = np.zeros((n_subj, n_c))
+            self.subject_counts = np.zeros(n_subj, dtype = np.int64)
+            self.subject_means = np.zeros((n_subj, n_c))
+            self.subject_m2 = np.zeros((n_subj, n_c))
+            for i in range(n_subj):
+                self.preprocess_subject(imgX, i)
+        else:
+            self.subject_data = imgX
+            self.brain_values = subject_state['brain_values']
+            self.subject_medians = np.asarray(subject_state['medians'])
+            self.subject_counts = np.asarray(subject_state['counts'])
+            self.subject_means = np.asarray(subject_state['means'])
+            self.subject_m2 = np.asarray(subject_state['m2'])
+        # brain voxels are ordered by subject: first brain voxel of every subject
+        self.subject_starts = np.concatenate([[0], np.cumsum(self.subject_counts)])
+
+        self.scales = None
+        self.offsets = None
+        self.statistics = None
+
+    @property
+    def is_affine(self):
+        """
+        True if the fold dependent part is only the affine transform (scales, offsets) of subject_data
+        """
+        return len(self.channels_to_normalise) == 0
+
+    def smooth(self, imgX, n_jobs = 1):
+        """
+        :return: copy of imgX in the input precision, smoothed with the kernel of pre_smoothing
+        """
+        if not self.pre_smoothing:
+            return imgX.astype(PRECISION['inputs'])
+        if type(self.pre_smoothing) == tuple:
+            return gaussian_smoothing(imgX, kernel_width=max(self.pre_smoothing), threeD=len(self.pre_smoothing) == 3,
+                                      n_jobs=n_jobs)
+        return gaussian_smoothing(imgX, n_jobs=n_jobs)
+
+    def preprocess_subject(self, imgX, i):
+        """
+        Fold independent statistics of the brain voxels of a subject in the raw data
+        """
+        subj_mask = self.mask_array[i].astype(bool)
+        start = int(self.subject_counts[:i].sum())
+        brain_values = imgX[i][subj_mask].astype(PRECISION['inputs'])
+        self.brain_values[start : start + brain_values.shape[0]] = brain_values
+        self.subject_counts[i] = brain_values.shape[0]
+        if brain_values.shape[0] > 0:
+            self.subject_medians[i] = np.median(brain_values, axis = 0)
+            brain_values = brain_values.astype(np.float64)
+            self.subject_means[i] = brain_values.mean(axis = 0)
+            self.subject_m2[i] = ((brain_values - self.subject_means[i]) ** 2).sum(axis = 0)
+        else:
+            self.subject_medians[i] = np.nan
+
+    def subject_state(self):
+        """
+        :return: statistics of the per-subject transforms, to rebuild the pipeline from subject_data
+        """
+        return {'brain_values': self.brain_values, 'medians': self.subject_medians, 'counts': self.subject_counts,
+                'means': self.subject_means, 'm2': self.subject_m2}
+
+    def fit(self, train_indices):
+        """
+        Compute the statistics of the preprocessing on the training subjects
+        :param train_indices: indices of the training subjects
+        :return: self
+        """
+        n_c = self.subject_data.shape[-1]
+        # outlier detection on the pooled brain voxels of the training subjects (see utils.rescale_outliers)
+        train_brain_values = np.concatenate([self.brain_values[self.subject_starts[i] : self.subject_starts[i + 1]]
+                                             for i in np.arange(self.subject_data.shape[0])[train_indices]])
+        if train_brain_values.shape[0] == 0:
+            raise ValueError('Can not preprocess: no voxels in the masks of the training subjects.')
+        cohort_medians = np.median(train_brain_values, axis = 0).astype(np.float64)
+        outlier_scales = np.where(self.subject_medians > 5 * cohort_medians, 0.1, 1.0)
+
+        standardisation = None
+        means, stds = np.zeros(n_c), np.ones(n_c)
+        if self.feature_scaling:
+            # merge the moments of the rescaled training subjects
+            counts = self.subject_counts[train_indices, None]
+            subject_means = outlier_scales[train_indices] * self.subject_means[train_indices]
+            subject_m2 = outlier_scales[train_indices] ** 2 * self.subject_m2[train_indices]
+            n_voxels = counts.sum()
+            means = (counts * subject_means).sum(axis = 0) / n_voxels
+            m2 = subject_m2.sum(axis = 0) + (counts * (subject_means - means) ** 2).sum(axis = 0)
+            stds = Standardiser.safe_std(m2 / n_voxels)
+            standardisation = {'means': means, 'stds': stds, 'n_voxels': int(n_voxels),
+                               'clin_means': None, 'clin_stds': None}
+            if self.clinX is not None:
+                clin_train = np.asarray(self.clinX[train_indices], dtype = np.float64)
+                standardisation['clin_means'] = clin_train.mean(axis = 0)
+                standardisation['clin_stds'] = Standardiser.safe_std(clin_train.var(axis = 0))
+
+        # (data * scale - mean) / std for every subject and channel
+        self.scales = outlier_scales / stds
+        self.offsets = np.broadcast_to(means / stds, self.scales.shape)
+        self.statistics = {'cohort_medians': cohort_medians, 'standardisation': standardisation,
+                           'outliers': [(int(i), int(c)) for i, c in np.argwhere(outlier_scales != 1)]}
+        return self
+
+    def transform(self, indices = None):
+        """
+        Preprocess subjects with the statistics of the last fit
+        :param indices (optional): indices of the subjects to transform, all subjects if not given
+        :return: (imgX, clinX) of the subjects
+        """
+        if self.scales is None:
+            raise ValueError('PreprocessingPipeline has to be fitted before transforming data.')
+        if indices is None:
+            indices = np.arange(self.subject_data.shape[0])
+        indices = np.arange(self.subject_data.shape[0])[indices]
+        imgX = np.empty((len(indices),) + self.subject_data.shape[1:], dtype = PRECISION['inputs'])
+        for k, i in enumerate(indices):
+            np.multiply(self.subject_data[i], self.scales[i].astype(imgX.dtype), out = imgX[k])
+            imgX[k] -= self.offsets[i].astype(imgX.dtype)
+            # contralateral normalisation of the standardised data (as in preprocess_data)
+            subj_mask = self.mask_array[i].astype(bool)
+            for c in self.channels_to_normalise:
+                image_normalised_channel, _ = normalise_channel_by_contralateral(
+                    imgX[k][subj_mask], np.expand_dims(subj_mask, axis=0), c)
+                imgX[k][..., c] = image_normalised_channel[0]
+
+        return imgX, self.transform_clinical(indices)
+
+    def transform_clinical(self, indices = None):
+        """
+        Standardise clinical data with the statistics of the last fit
+        :param indices (optional): indices of the subjects to transform, all subjects if not given
+        :return: clinX of the subjects (None without clinical data)
+        """
+        if self.clinX is None:
+            return None
+        clinX = np.asarray(self.clinX)
+        if indices is not None:
+            clinX = clinX[indices]
+        standardisation = self.statistics['standardisation']
+        if standardisation is not None:
+            clinX = (clinX - standardisation['clin_means']) / standardisation['clin_stds']
+        return clinX
@@ -31,14 +31,6 @@ def reshape_to_receptive_field(input_data_array, output_data_array, receptive_fi
     receptive_field_size = window_d_x * window_d_y * window_d_z * n_c
     n_voxels_per_subject = n_x * n_y * n_z
 
-    # pass mask array as last channel to apply rf on it as well
-    if mask_array is not None:
-        # add the subject and channel dimension
-        mask_array = np.expand_dims(mask_array, axis=0)
-        mask_array = np.expand_dims(mask_array, axis=-1)
-        # add mask as last channel
-        input_data_array = np.concatenate((input_data_array, mask_array), axis = 4)
-
     # pad all images to allow for an receptive field even at the borders
     padding_x, padding_y, padding_z = rf_x, rf_y, rf_z
 
@@ -51,7 +43,8 @@ def reshape_to_receptive_field(input_data_array, output_data_array, receptive_fi
 
     if mask_array is not None:
         # obtain the number of undefined voxels for every receptive field
-        cardinal_undef_in_rf = np.count_nonzero(input_fields[:, :, :, :, -1, ...] == 0, axis=(-1, -2, -3))
+        cardinal_undef_in_rf = cardinal_undef_in_receptive_field(
+            np.broadcast_to(mask_array, input_data_array.shape[:-1]), receptive_field_dimensions)
         # add the number of undef voxels to the input
         inputs = np.concatenate((inputs, cardinal_undef_in_rf.reshape(-1, 1)), axis=1)
 
@@ -70,23 +63,105 @@ def reshape_to_receptive_field(input_data_array, output_data_array, receptive_fi
 
     return inputs, outputs
 
+def gather_receptive_fields(input_data_array, receptive_field_dimensions, selector, out = None):
+    """
+    Gather the receptive fields of selected voxels only (without expanding the whole image)
+    Features are ordered as in reshape_to_receptive_field, ie. a selected voxel yields the same row in both
+
+    :param input_data_array: input data (n, x, y, z, c)
+    :param receptive_field_dimensions: dimensions of the receptive fields in rf (steps from center voxel)
+    :param selector: boolean array (n, x, y, z) marking the voxels for which the receptive field should be gathered
+    :param out (optional): preallocated array of shape (>= n_selected, >= rf_size) to write the receptive fields to
+        - receptive fields are written to the first n_selected rows and rf_size columns
+    :return: out - receptive fields of selected voxels (n_selected, rf_size)
+    """
+    n_x, n_y, n_z, n_c = input_data_array[0].shape
+    if selector.shape != input_data_array.shape[:-1]:
+        raise ValueError('Selector shape does not match input data:', selector.shape, input_data_array.shape)
+
+    rf_x, rf_y, rf_z = receptive_field_dimensions
+    window_d_x, window_d_y, window_d_z = 2 * np.array(receptive_field_dimensions) + 1
+    window_size = window_d_x * window_d_y * window_d_z
+    receptive_field_size = window_size * n_c
+
+    subj_indices, x_indices, y_indices, z_indices = np.nonzero(selector)
+    n_selected = subj_indices.size
+
+    if out is None:
+        out = np.empty((n_selected, receptive_field_size), dtype = input_data_array.dtype)
+    if out.shape[0] < n_selected or out.shape[1] < receptive_field_size:
+        raise ValueError('Output buffer too small for selected receptive fields:', out.shape, (n_selected, receptive_field_size))
+
+    padded_data = np.pad(input_data_array, ((0, 0), (rf_x, rf_x), (rf_y, rf_y), (rf_z, rf_z), (0, 0)),
+                         mode='constant', constant_values=0)
+
+    # Column of a feature is ((c * window_d_x + d_x) * window_d_y + d_y) * window_d_z + d_z
+    # Hence every window offset fills the columns of all channels at once (every window_size columns)
+    window_offset = 0
+    for d_x in range(window_d_x):
+        for d_y in range(window_d_y):
+            for d_z in range(window_d_z):
+                out[:n_selected, window_offset : receptive_field_size : window_size] = \
+                    padded_data[subj_indices, x_indices + d_x, y_indices + d_y, z_indices + d_z]
+                window_offset += 1
+
+    return out[:n_selected, :receptive_field_size]
+
+def inside_image_in_receptive_field(image_shape, receptive_field_dimensions, selector):
+    """
+    Mark the voxels of the receptive fields of selected voxels that lie inside the image (and not in the zero padding)
+    Columns are ordered as the window offsets of a single channel in gather_receptive_fields
+    :param image_shape: spatial shape of the images (x, y, z)
+    :param receptive_field_dimensions: dimensions of the receptive fields in rf (steps from center voxel)
+    :param selector: boolean array (n, x, y, z) marking the voxels for which the receptive field is gathered
+    :return: inside - boolean array (n_selected, window_size)
+    """
+    selected_indices = np.nonzero(selector)[1:]
+    n_selected = selected_indices[0].size
+    inside = np.ones((n_selected, 1, 1, 1), dtype = bool)
+    for axis, (indices, rf_axis, n_axis) in enumerate(zip(selected_indices, receptive_field_dimensions, image_shape)):
+        positions = indices[:, None] + np.arange(-rf_axis, rf_axis + 1)
+        axis_shape = [n_selected, 1, 1, 1]
+        axis_shape[axis + 1] = 2 * rf_axis + 1
+        inside = inside & ((positions >= 0) & (positions < n_axis)).reshape(axis_shape)
+    return inside.reshape(n_selected, -1)
+
 def cardinal_undef_in_receptive_field(mask_array, receptive_field_dimensions):
     """
     Count the number of voxels that are not inside the defined area (defined by the mask) in every receptive field
+    Counts are obtained from separable box sums over the mask (summed-area table along every axis),
+    hence the cost is linear in the number of voxels, whatever the size of the receptive field
     :param mask_array: mask defining the areas of the brain where perfusion maps are clearly defined (i, x, y, z)
     :param receptive_field_dimensions: dimensions of the receptive field in steps from the center along x, y, z
     :return: cardinal_undef
     """
-    n_i, n_x, n_y, n_z = mask_array.shape
-    rf_x, rf_y, rf_z = receptive_field_dimensions
     window_d_x, window_d_y, window_d_z = 2 * np.array(receptive_field_dimensions) + 1
 
-    padding = max([rf_x, rf_y, rf_z])
-    padded_data = np.pad(mask_array, ((0, 0), (padding, padding), (padding, padding), (padding, padding)),
-                         mode='constant', constant_values=0)
+    defined_in_rf = (mask_array != 0).astype(np.int64)
+    for axis, rf_axis in zip((1, 2, 3), receptive_field_dimensions):
+        defined_in_rf = box_sum(defined_in_rf, rf_axis, axis)
 
-    input_fields_masks = rolling_window(padded_data, (0, window_d_x, window_d_y, window_d_z)).reshape(n_i, n_x, n_y, n_z, window_d_x * window_d_y * window_d_z)
-    cardinal_undef = np.count_nonzero(input_fields_masks == 0, axis=-1)
+    # voxels outside of the image are undefined as well (zero padding)
+    cardinal_undef = window_d_x * window_d_y * window_d_z - defined_in_rf
 
     return cardinal_undef
 
+def box_sum(data_array, radius, axis):
+    """
+    Sum of every window of width 2 * radius + 1 centered on each element along an axis (zero padded)
+    Computed as the difference of a cumulative sum, ie. in linear time whatever the radius
+    :param data_array: data to sum
+    :param radius: steps from the center of the window
+    :param axis: axis along which to sum
+    :return: summed data with the same shape as data_array
+    """
+    if radius == 0:
+        return data_array
+    window_width = 2 * radius + 1
+    padding = [(0, 0)] * data_array.ndim
+    # an additional leading zero allows to take differences for the first window as well
+    padding[axis] = (radius + 1, radius)
+    cumulative_sum = np.cumsum(np.pad(data_array, padding, mode='constant', constant_values=0), axis=axis)
+    n = data_array.shape[axis]
+    return np.take(cumulative_sum, np.arange(window_width, window_width + n), axis=axis) \
+           - np.take(cumulative_sum, np.arange(0, n), axis=axis)
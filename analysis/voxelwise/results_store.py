@@ -0,0 +1,117 @@
+import os, json, uuid, torch
+from voxelwise.cv_framework import init_results, collect_fold_result
+
+
+class ResultsStore():
+    """
+    Append-only store of the results of a crossvalidation
+    The result of every fold is saved in its own file when the fold is done and listed in a manifest,
+    so that saving a fold does not rewrite the previous ones and an interrupted run can be resumed
+    (see repeated_kfold_cv with resume = True).
+    Every file (and the manifest) is first written to a temporary file and then renamed, a crash during a write
+    thus never corrupts results that were already saved.
+    The legacy result dictionary (as returned by repeated_kfold_cv) is reassembled with load_results.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        self.manifest = {'params': None, 'folds': []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def atomic_save(self, obj, file_name):
+        temp_path = os.path.join(self.store_dir, str(uuid.uuid4()) + '.tmp')
+        torch.save(obj, temp_path)
+        os.replace(temp_path, os.path.join(self.store_dir, file_name))
+
+    def save_manifest(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def save_params(self, params, kfold_seeds = None):
+        """
+        Start a new crossvalidation in the store (previously saved folds are dropped from the manifest)
+        :param params: parameters of the crossvalidation
+        :param kfold_seeds (optional): seeds of the KFold splits of every iteration, checked when resuming
+        """
+        self.atomic_save(params, 'params.npy')
+        self.manifest = {'params': 'params.npy', 'kfold_seeds': kfold_seeds, 'folds': []}
+        self.save_manifest()
+
+    def load_params(self):
+        """
+        :return: parameters of the crossvalidation in the store or None if none was started
+        """
+        if self.manifest['params'] is None:
+            return None
+        return torch.load(os.path.join(self.store_dir, self.manifest['params']))
+
+    def kfold_seeds(self):
+        return self.manifest.get('kfold_seeds')
+
+    def append_fold(self, iteration, fold, fold_result):
+        """
+        Save the result of a fold
+        :param iteration: index of the iteration of the repeated kfold
+        :param fold: index of the fold in this iteration
+        :param fold_result: result dictionary of evaluate_fold or None if the fold failed
+        """
+        file_name = None
+        if fold_result is not None:
+            # figures are not saved with the results (they can be rendered from the visual check)
+            fold_result = {key: value for key, value in fold_result.items() if key != 'figure'}
+            file_name = 'fold_' + str(iteration) + '_' + str(fold) + '.npy'
+            self.atomic_save(fold_result, file_name)
+        self.manifest['folds'].append({'iteration': int(iteration), 'fold': int(fold), 'file': file_name})
+        self.save_manifest()
+
+    def folds(self):
+        return [(entry['iteration'], entry['fold']) for entry in self.manifest['folds']]
+
+    def load_fold(self, entry):
+        if entry['file'] is None:
+            return None
+        fold_result = torch.load(os.path.join(self.store_dir, entry['file']))
+        fold_result['figure'] = None
+        return fold_result
+
+    def load_results(self):
+        """
+        Reassemble the result dictionary and the trained models of all saved folds (in the order they were saved)
+        :return: (results, trained_models) as returned by repeated_kfold_cv
+        """
+        params = self.load_params()
+        params['failed_folds'] = 0
+        results = init_results(params)
+        trained_models = []
+        for entry in self.manifest['folds']:
+            collect_fold_result(results, trained_models, [], self.load_fold(entry))
+        return results, trained_models
+
+def save_legacy_results(output_dir, model_name, results, trained_models):
+    """
+    Save results, params and trained models as single files (scores_, params_ and trained_models_<model_name>.npy)
+    as read by the figure and meta scripts
+    """
+    for file_name, obj in [('scores_' + model_name + '.npy', results), ('params_' + model_name + '.npy', results['params']),
+                           ('trained_models_' + model_name + '.npy', trained_models)]:
+        temp_path = os.path.join(output_dir, str(uuid.uuid4()) + '.tmp')
+        torch.save(obj, temp_path)
+        os.replace(temp_path, os.path.join(output_dir, file_name))
+
+def load_results(output_dir, model_name):
+    """
+    Load the results of a model from its output directory: from its results store if there is one
+    (also for runs that did not finish), otherwise from the legacy scores file
+    :return: result dictionary
+    """
+    store_dir = os.path.join(output_dir, 'results_store')
+    if os.path.exists(os.path.join(store_dir, 'manifest.json')):
+        return ResultsStore(store_dir).load_results()[0]
+    return torch.load(os.path.join(output_dir, 'scores_' + model_name + '.npy'))
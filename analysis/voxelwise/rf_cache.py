@@ -0,0 +1,140 @@
+import os, uuid, hashlib, time
+import numpy as np
+import voxelwise.receptiveField as rf
+
+# temporary files older than this (in seconds) are considered left over by an interrupted write
+STALE_TEMP_AGE = 3600
+
+class ReceptiveFieldCache():
+    """
+    On-disk cache of the receptive fields of every brain voxel of a subject
+    Every subject is saved as a .npy file (n_brain_voxels, rf_size) and loaded as memory map,
+    folds then only read the rows they select instead of expanding the subject again.
+    Entries are content addressed: the key is derived from the preprocessed subject data, its mask,
+    the receptive field dimensions and the preprocessing settings.
+    Least recently used entries are evicted when the total size would exceed max_size_gb.
+    """
+
+    def __init__(self, cache_dir, max_size_gb = 50):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_gb * 1e9
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def subject_key(subj_imgX, subj_mask, receptive_field_dimensions, preprocessing_settings = None):
+        """
+        Content based key of the receptive fields of a subject
+        :param subj_imgX: preprocessed image data of the subject [x, y, z, c]
+        :param subj_mask: boolean array differentiating brain from background [x, y, z]
+        :param receptive_field_dimensions: in the form of a list as  [rf_x, rf_y, rf_z]
+        :param preprocessing_settings: dict of settings used to preprocess the data (scaling, smoothing, normalisation)
+        :return: hexadecimal key
+        """
+        key = hashlib.sha1()
+        key.update(str(list(receptive_field_dimensions)).encode())
+        key.update(str(sorted((preprocessing_settings or {}).items())).encode())
+        key.update(str((subj_imgX.shape, subj_imgX.dtype)).encode())
+        key.update(np.ascontiguousarray(subj_imgX))
+        key.update(np.ascontiguousarray(subj_mask, dtype=bool))
+        return key.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, 'rf_' + key + '.npy')
+
+    def evict(self, required_size):
+        """
+        Remove least recently used entries until required_size bytes can be added without exceeding the cache size
+        Temporary files of entries being written count toward the cache size, temporary files left by interrupted
+        writes (not modified for STALE_TEMP_AGE seconds) are removed
+        :return: True if there is enough space
+        """
+        entries, temp_size = [], 0
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            try:
+                if f.endswith('.npy'):
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                elif f.endswith('.tmp'):
+                    if time.time() - os.path.getmtime(path) > STALE_TEMP_AGE:
+                        os.remove(path)
+                    else:
+                        temp_size += os.path.getsize(path)
+            except OSError:
+                # file has been renamed or removed by another process
+                pass
+        entries = sorted(entries)
+        total_size = temp_size + sum(size for _, size, _ in entries)
+        while entries and total_size + required_size > self.max_size:
+            _, size, lru_entry = entries.pop(0)
+            total_size -= size
+            try:
+                os.remove(lru_entry)
+            except OSError:
+                # entry has already been evicted by another process
+                pass
+        return total_size + required_size <= self.max_size
+
+    def get(self, key, subj_imgX, subj_mask, receptive_field_dimensions):
+        """
+        Get the receptive fields of all voxels of the mask of a subject, computing them if they are not cached yet
+        :param key: key of the subject as given by subject_key
+        :param subj_imgX: preprocessed image data of the subject [x, y, z, c]
+        :param subj_mask: boolean array differentiating brain from background [x, y, z]
+        :param receptive_field_dimensions: in the form of a list as  [rf_x, rf_y, rf_z]
+        :return: memory mapped receptive fields (n_mask_voxels, rf_size) or None if it can not be cached
+        """
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            try:
+                # mark as recently used
+                os.utime(path)
+                return np.load(path, mmap_mode='r')
+            except (OSError, ValueError):
+                print('Corrupted receptive field cache entry. Recomputing', path)
+
+        window_d_x, window_d_y, window_d_z = 2 * np.array(receptive_field_dimensions) + 1
+        shape = (int(np.sum(subj_mask)), int(window_d_x * window_d_y * window_d_z * subj_imgX.shape[-1]))
+        entry_size = np.prod(shape) * subj_imgX.dtype.itemsize
+        if not self.evict(entry_size):
+            print('Receptive fields of subject too large for cache:', entry_size / 1e9, 'GB')
+            return None
+
+        # write to a temporary file first, so that an interrupted write never leaves a corrupted entry
+        temp_path = os.path.join(self.cache_dir, str(uuid.uuid4()) + '.tmp')
+        entry = np.lib.format.open_memmap(temp_path, mode='w+', dtype=subj_imgX.dtype, shape=shape)
+        rf.gather_receptive_fields(np.expand_dims(subj_imgX, axis=0), receptive_field_dimensions,
+                                   np.expand_dims(subj_mask, axis=0), out = entry)
+        entry.flush()
+        del entry
+        os.replace(temp_path, path)
+
+        return np.load(path, mmap_mode='r')
+
+    def gather(self, key, subj_imgX, subj_selector, subj_mask, receptive_field_dimensions, out = None):
+        """
+        Gather the receptive fields of the selected voxels of a subject from the cache
+        Falls back to computing them directly if selected voxels lie outside the mask or the subject can not be cached
+        :param subj_selector: boolean array selecting the voxels [x, y, z]
+        :param out (optional): preallocated array to write the receptive fields to
+        :return: receptive fields of selected voxels (n_selected, rf_size)
+        """
+        subj_mask = subj_mask.astype(bool)
+        cached = None
+        if not np.any(subj_selector & ~subj_mask):
+            cached = self.get(key, subj_imgX, subj_mask, receptive_field_dimensions)
+        if cached is None:
+            return rf.gather_receptive_fields(np.expand_dims(subj_imgX, axis=0), receptive_field_dimensions,
+                                              np.expand_dims(subj_selector, axis=0), out = out)
+
+        # cached rows are ordered as the voxels of the mask
+        rows = (np.cumsum(subj_mask.reshape(-1)) - 1)[subj_selector.reshape(-1)]
+        if out is None:
+            return cached[rows]
+        out[:rows.size, :cached.shape[1]] = cached[rows]
+        return out[:rows.size, :cached.shape[1]]
+
+    def clear(self):
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npy') or f.endswith('.tmp'):
+                os.remove(os.path.join(self.cache_dir, f))
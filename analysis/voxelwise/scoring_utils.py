@@ -1,13 +1,13 @@
 import os, torch, math
-from sklearn.metrics import f1_score, jaccard_score, precision_score, roc_curve, auc, accuracy_score
+from sklearn.metrics import auc
 import numpy as np
-from scipy.spatial.distance import directed_hausdorff
-from numpy.core.umath_tests import inner1d
+from voxelwise.distance_metrics import hausdorff_metrics
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 
 
-def evaluate(probas_, y_test, mask_test, ids_test, n_subjects: int, n_x, n_y, n_z, model_threshold = 0.5):
+def evaluate(probas_, y_test, mask_test, ids_test, n_subjects: int, n_x, n_y, n_z, model_threshold = 0.5,
+             render_figure = True):
     '''
     Evaluate performance of prediction
     :param probas_: probability of being of class 1 for every voxel - linear shape of all voxels [i]
@@ -19,6 +19,8 @@ def evaluate(probas_, y_test, mask_test, ids_test, n_subjects: int, n_x, n_y, n_
     :param n_y: integer
     :param n_z: integer
     :param model_threshold : trained threshold used to binarize the probability
+    :param render_figure (optional, default True): build the figure for visual evaluation, if False only the
+        centre slices are recorded (see plot_visual_check) and the figure is None
     :return:
     '''
     probas_ = np.squeeze(probas_)
@@ -26,95 +28,87 @@ def evaluate(probas_, y_test, mask_test, ids_test, n_subjects: int, n_x, n_y, n_
         print('PROBAS AND TEST IMAGE DO NOT HAVE THE SAME SHAPE', probas_.shape, y_test.shape)
 
     # Voxel-wise statistics
-    # Compute ROC curve, area under the curve, f1, and accuracy
-    fpr, tpr, roc_thresholds = roc_curve(y_test, probas_[:])
-    roc_auc = auc(fpr, tpr)
+    # Compute ROC curve and area under the curve from the histograms of the probabilities
+    roc_accumulator = RocAccumulator().update(y_test, probas_)
+    fpr, tpr, roc_thresholds = roc_accumulator.curve()
+    roc_auc = roc_accumulator.auc()
 
     # threshold chosen to evaluate binary metrics of model
     threshold = model_threshold
     if np.isnan(threshold): threshold = 0.5
     print('Using threshold', str(threshold), 'for evaluation.')
     # get optimal cutOff on test data
-    test_threshold = cutoff_youdens_j(fpr, tpr, roc_thresholds)
+    test_threshold = roc_accumulator.youdens_j_threshold()
     print('Optimal threshold based on test data:', str(test_threshold))
 
-    jaccard = jaccard_score(y_test, probas_[:] >= threshold)
-    accuracy = accuracy_score(y_test, probas_[:] >= threshold)
-    f1 = f1_score(y_test, probas_[:] >= threshold)
+    # Confusion counts of all subjects in one pass, image-wise and overall metrics are derived from them
+    mask_test = mask_test[:n_subjects].astype(bool)
+    subj_n_vxl = mask_test.reshape(n_subjects, -1).sum(axis=1)
+    subj_starts = np.concatenate([[0], np.cumsum(subj_n_vxl)[:-1]])
+    binary_probas = probas_ >= threshold
+    tp, fp, fn, tn = subject_confusion_counts(y_test, binary_probas, subj_starts, subj_n_vxl)
+
+    # undefined metrics are 0 (as in sklearn)
+    total_tp, total_fp, total_fn, total_tn = tp.sum(), fp.sum(), fn.sum(), tn.sum()
+    jaccard = total_tp / (total_tp + total_fp + total_fn) if total_tp + total_fp + total_fn > 0 else 0.0
+    accuracy = (total_tp + total_tn) / (total_tp + total_fp + total_fn + total_tn) \
+        if total_tp + total_fp + total_fn + total_tn > 0 else 0.0
+    f1 = 2 * total_tp / (2 * total_tp + total_fp + total_fn) if total_tp + total_fp + total_fn > 0 else 0.0
     # Positive predictive value : tp / (tp + fp)
-    PPV = precision_score(y_test, probas_[:] >= threshold)
+    PPV = total_tp / (total_tp + total_fp) if total_tp + total_fp > 0 else 0.0
 
     # Image-wise statistics
-    thresholded_predicted_volume_vox = []
-    thresholded_volume_deltas = []
-    unthresholded_volume_deltas = []
-    image_wise_error_ratios = []
-    image_wise_jaccards = []
-    image_wise_hausdorff = []
-    image_wise_modified_hausdorff = []
-    image_wise_dice = []
-    image_wise_roc_auc = []
-    image_wise_fpr = []
-    image_wise_tpr = []
-    image_wise_roc_thresholds = []
-    # figure for visual evaluation
-
-    plt.switch_backend('agg')
-    ncol = 14
-    nrow = 2 * (n_subjects // ncol) + 2
-    figure = plt.figure(figsize=(ncol+1, nrow+1))
-    gs = gridspec.GridSpec(nrow, ncol,
-             wspace=0.7, hspace=0.25,
-             top=1.-0.5/(nrow+1), bottom=0.5/(nrow+1),
-             left=0.5/(ncol+1), right=1-0.5/(ncol+1))
-
-    vxl_index = 0
-
-    for subj in range(n_subjects):
-        subj_n_vxl = np.sum(mask_test[subj])
-        if ids_test is not None: subj_id = ids_test[subj]
-        else : subj_id = None
-
-        subj_image_wise_probas = probas_[vxl_index : vxl_index + subj_n_vxl]
-        subj_image_wise_y_test = y_test[vxl_index : vxl_index + subj_n_vxl]
-        vxl_index += subj_n_vxl
-
-        img_fpr, img_tpr, img_roc_thresholds = roc_curve(subj_image_wise_y_test, subj_image_wise_probas[:])
-        image_wise_roc_auc.append(auc(img_fpr, img_tpr))
+    gt_volume = tp + fn
+    thresholded_predicted_volume_vox = list(tp + fp)
+    # Volume delta is defined as GT - predicted volume
+    thresholded_volume_deltas = list(gt_volume - (tp + fp))
+    unthresholded_volume_deltas = list(gt_volume - subject_sums(probas_.astype(np.float64), subj_starts, subj_n_vxl))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # error ratio being defined as sum(FP + FN)/all, 0 for subjects without voxels
+        image_wise_error_ratios = list(np.where(subj_n_vxl > 0, (fp + fn) / subj_n_vxl, 0.0))
+        # empty ground truth and prediction: jaccard defaults to 0 (as sklearn), dice to 1
+        image_wise_jaccards = list(np.where(tp + fp + fn > 0, tp / (tp + fp + fn), 0.0))
+        image_wise_dice = list(np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 1.0))
+
+    image_wise_fpr, image_wise_tpr, image_wise_roc_thresholds, image_wise_roc_auc = [], [], [], []
+    for subj_roc_accumulator in RocAccumulator.per_subject(y_test, probas_, subj_n_vxl):
+        img_fpr, img_tpr, img_roc_thresholds = subj_roc_accumulator.curve()
         image_wise_fpr.append(img_fpr)
         image_wise_tpr.append(img_tpr)
         image_wise_roc_thresholds.append(img_roc_thresholds)
+        image_wise_roc_auc.append(subj_roc_accumulator.auc())
 
-        # Record predicted volume (GT volume can be derived from predicted volume and delta)
-        thresholded_predicted_volume_vox.append(np.sum(subj_image_wise_probas >= threshold))
-
-        # Volume delta is defined as GT - predicted volume
-        thresholded_volume_deltas.append(np.sum(subj_image_wise_y_test) - np.sum(subj_image_wise_probas >= threshold))
-        unthresholded_volume_deltas.append(np.sum(subj_image_wise_y_test) - np.sum(subj_image_wise_probas))
-        n_voxels = subj_image_wise_y_test.shape[0]
-
-        # error ratio being defined as sum(FP + FN)/all
-        image_wise_error_ratios.append(
-            np.sum(abs(subj_image_wise_y_test - (subj_image_wise_probas >= threshold))) / n_voxels
-        )
-        image_wise_jaccards.append(jaccard_score(subj_image_wise_y_test, subj_image_wise_probas[:] >= threshold))
-        image_wise_dice.append(dice(subj_image_wise_y_test, subj_image_wise_probas[:] >= threshold))
+    # To calculate the surface distances, the images have to be rebuild in 3D (subjects are concatenated in mask order)
+    y_test_3D = np.zeros(mask_test.shape, dtype = np.int8)
+    y_test_3D[mask_test] = y_test
+    probas_3D = np.zeros(mask_test.shape, dtype = np.float64)
+    probas_3D[mask_test] = probas_
 
-        # To calculate the hausdorff_distance, the image has to be rebuild as a 3D image
-        subj_3D_probas = np.full(mask_test[subj].shape, 0, dtype = np.float64)
-        subj_3D_probas[mask_test[subj]] = subj_image_wise_probas
-        subj_3D_y_test = np.full(mask_test[subj].shape, 0)
-        subj_3D_y_test[mask_test[subj]] = subj_image_wise_y_test
-
-        visual_compare(subj_3D_y_test, subj_3D_probas, n_subjects, subj, n_z, gs, image_id = subj_id)
+    image_wise_hausdorff = []
+    image_wise_modified_hausdorff = []
+    image_wise_hausdorff_95 = []
+    image_wise_average_surface_distance = []
+    for subj in range(n_subjects):
+        distances = hausdorff_metrics(y_test_3D[subj].reshape(n_x, n_y, n_z) > 0, (probas_3D[subj] >= threshold).reshape(n_x, n_y, n_z))
+        image_wise_hausdorff.append(distances['hausdorff'])
+        image_wise_modified_hausdorff.append(distances['modified_hausdorff'])
+        image_wise_hausdorff_95.append(distances['hausdorff_95'])
+        image_wise_average_surface_distance.append(distances['average_surface_distance'])
 
-        hsd = hausdorff_distance(subj_3D_y_test, subj_3D_probas >= threshold, n_x, n_y, n_z)
-        image_wise_hausdorff.append(hsd)
+    # centre slices for visual evaluation, the figure can be rendered later from them
+    center_z = (n_z - 1) // 2
+    visual_check = {
+        'ids': None if ids_test is None else list(ids_test),
+        'ground_truth': y_test_3D[:, :, :, center_z],
+        'prediction': probas_3D[:, :, :, center_z].astype(np.float32)
+    }
+    figure = plot_visual_check(visual_check) if render_figure else None
 
     return {
         'fpr': fpr,
         'tpr': tpr,
         'roc_thresholds': roc_thresholds,
+        'roc_histogram': roc_accumulator.histogram,
         'evaluation_threshold': threshold,
         'optimal_threshold_on_test_data': test_threshold,
         'accuracy': accuracy,
@@ -129,18 +123,144 @@ def evaluate(probas_, y_test, mask_test, ids_test, n_subjects: int, n_x, n_y, n_
         'image_wise_jaccards': image_wise_jaccards,
         'image_wise_hausdorff': image_wise_hausdorff,
         'image_wise_modified_hausdorff': image_wise_modified_hausdorff,
+        'image_wise_hausdorff_95': image_wise_hausdorff_95,
+        'image_wise_average_surface_distance': image_wise_average_surface_distance,
         'image_wise_dice': image_wise_dice,
         'image_wise_roc_auc': image_wise_roc_auc,
         'image_wise_fpr': image_wise_fpr,
         'image_wise_tpr': image_wise_tpr,
         'image_wise_roc_thresholds': image_wise_roc_thresholds,
+        'visual_check': visual_check,
         'figure': figure
         }
 
+def subject_sums(values, subj_starts, subj_n_vxl):
+    """
+    Sum of values over the voxels of every subject
+    :param values: values of the concatenated voxels of all subjects [i]
+    :param subj_starts: index of the first voxel of every subject [n]
+    :param subj_n_vxl: number of voxels of every subject [n]
+    :return: sums [n]
+    """
+    # a trailing 0 allows starts at the end of the array, subjects without voxels are set to 0 afterwards
+    sums = np.add.reduceat(np.append(values, 0), subj_starts)
+    sums[subj_n_vxl == 0] = 0
+    return sums
+
+def subject_confusion_counts(y_true, y_pred, subj_starts, subj_n_vxl):
+    """
+    Confusion counts of every subject in a single pass over the concatenated voxels
+    :param y_true: GT for every voxel [i]
+    :param y_pred: binary prediction for every voxel [i]
+    :param subj_starts: index of the first voxel of every subject [n]
+    :param subj_n_vxl: number of voxels of every subject [n]
+    :return: tp, fp, fn, tn - counts per subject [n]
+    """
+    y_true = np.asarray(y_true).astype(bool)
+    y_pred = np.asarray(y_pred).astype(bool)
+    tp = subject_sums((y_true & y_pred).astype(np.int64), subj_starts, subj_n_vxl)
+    gt_positives = subject_sums(y_true.astype(np.int64), subj_starts, subj_n_vxl)
+    predicted_positives = subject_sums(y_pred.astype(np.int64), subj_starts, subj_n_vxl)
+    fp = predicted_positives - tp
+    fn = gt_positives - tp
+    tn = subj_n_vxl - tp - fp - fn
+    return tp, fp, fn, tn
+
 def cutoff_youdens_j(fpr, tpr, thresholds):
-    j_scores = tpr-fpr # J = sensivity + specificity - 1
-    j_ordered = sorted(zip(j_scores, thresholds))
-    return j_ordered[-1][1]
+    j_scores = np.asarray(tpr) - np.asarray(fpr) # J = sensivity + specificity - 1
+    thresholds = np.asarray(thresholds)
+    if np.all(np.isnan(j_scores)):
+        # J is undefined without positives (or negatives): fall back to the highest threshold
+        return np.max(thresholds)
+    # highest threshold among the ones maximising J
+    return np.max(thresholds[j_scores == np.nanmax(j_scores)])
+
+class RocAccumulator():
+    """
+    ROC curve computed from histograms of the predicted probabilities of positive and negative voxels
+    Histograms have a fixed number of bins, so they can be updated batch by batch (or subject by subject)
+    and merged across folds with bounded memory and without sorting all voxels.
+    Thresholds are the lower edges of the bins, values outside of value_range are counted in the border bins.
+    The curve is exact at these thresholds, the AUC differs from the exact one by at most the share of
+    positive-negative pairs falling in the same bin.
+    """
+
+    def __init__(self, n_bins = 10000, value_range = (0, 1), histogram = None):
+        self.n_bins = n_bins
+        self.value_range = value_range
+        # row 0: negatives, row 1: positives
+        self.histogram = np.zeros((2, n_bins), dtype = np.int64) if histogram is None \
+            else np.array(histogram, dtype = np.int64)
+
+    def bin_index(self, probas):
+        lower, upper = self.value_range
+        bins = np.floor((np.asarray(probas, dtype = np.float64) - lower) * (self.n_bins / (upper - lower)))
+        return np.clip(bins, 0, self.n_bins - 1).astype(np.int64)
+
+    def update(self, y_true, probas):
+        """
+        Add voxels to the histograms
+        :param y_true: GT for every voxel [i]
+        :param probas: probability of being of class 1 for every voxel [i]
+        """
+        y_true = np.asarray(y_true).reshape(-1).astype(bool)
+        self.histogram += np.bincount(self.bin_index(probas).reshape(-1) + self.n_bins * y_true,
+                                      minlength = 2 * self.n_bins).reshape(2, self.n_bins)
+        return self
+
+    def merge(self, other):
+        if other.n_bins != self.n_bins or tuple(other.value_range) != tuple(self.value_range):
+            raise ValueError('Can not merge ROC histograms with different bins:',
+                             (self.n_bins, self.value_range), (other.n_bins, other.value_range))
+        self.histogram += other.histogram
+        return self
+
+    @staticmethod
+    def per_subject(y_true, probas, subj_n_vxl, n_bins = 10000, value_range = (0, 1)):
+        """
+        Histograms of every subject, computed with a single bincount over the concatenated voxels
+        :param subj_n_vxl: number of voxels of every subject [n]
+        :return: list of RocAccumulator, one per subject
+        """
+        accumulator = RocAccumulator(n_bins, value_range)
+        n_subjects = len(subj_n_vxl)
+        subject_index = np.repeat(np.arange(n_subjects), subj_n_vxl)
+        y_true = np.asarray(y_true).reshape(-1).astype(bool)
+        keys = (2 * subject_index + y_true) * n_bins + accumulator.bin_index(probas).reshape(-1)
+        histograms = np.bincount(keys, minlength = 2 * n_subjects * n_bins).reshape(n_subjects, 2, n_bins)
+        return [RocAccumulator(n_bins, value_range, histogram) for histogram in histograms]
+
+    def curve(self, drop_intermediate = True):
+        """
+        ROC curve in the format of sklearn's roc_curve (starting at (0, 0) with an infinite threshold)
+        :param drop_intermediate: drop thresholds without voxels and the ones collinear with their neighbours
+        :return: fpr, tpr, thresholds
+        """
+        lower, upper = self.value_range
+        thresholds = (lower + np.arange(self.n_bins) * ((upper - lower) / self.n_bins))[::-1]
+        fps = np.cumsum(self.histogram[0, ::-1])
+        tps = np.cumsum(self.histogram[1, ::-1])
+        if drop_intermediate:
+            occupied = np.flatnonzero(self.histogram[:, ::-1].sum(axis = 0))
+            fps, tps, thresholds = fps[occupied], tps[occupied], thresholds[occupied]
+            if fps.shape[0] > 2:
+                optimal_idxs = np.flatnonzero(np.concatenate([[True], np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), [True]]))
+                fps, tps, thresholds = fps[optimal_idxs], tps[optimal_idxs], thresholds[optimal_idxs]
+        tps = np.append(0, tps)
+        fps = np.append(0, fps)
+        thresholds = np.append(np.inf, thresholds)
+        fpr = fps / fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+        tpr = tps / tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+        return fpr, tpr, thresholds
+
+    def auc(self):
+        fpr, tpr, _ = self.curve()
+        if np.isnan(fpr[-1]) or np.isnan(tpr[-1]):
+            return np.nan
+        return auc(fpr, tpr)
+
+    def youdens_j_threshold(self):
+        return cutoff_youdens_j(*self.curve())
 
 def dice(im1, im2, empty_score=1.0):
     """
@@ -180,67 +300,64 @@ def dice(im1, im2, empty_score=1.0):
     return 2. * intersection.sum() / im_sum
 
 def hausdorff_distance(data1, data2, n_x, n_y, n_z):
+    """
+    Symmetric hausdorff distance between the surfaces of two segmentations (see distance_metrics)
+    """
+    data1 = data1.reshape(n_x, n_y, n_z)
+    data2 = data2.reshape(n_x, n_y, n_z)
+
+    return hausdorff_metrics(data1 > 0, data2 > 0)['hausdorff']
+
+def modified_hausdorff_distance(data1, data2, n_x, n_y, n_z):
+    """
+    Modified hausdorff distance (Dubuisson and Jain, 1994) between the surfaces of two segmentations
+    """
     data1 = data1.reshape(n_x, n_y, n_z)
     data2 = data2.reshape(n_x, n_y, n_z)
 
-    coordinates1 = np.array(np.where(data1 > 0)).transpose()
-    coordinates2 = np.array(np.where(data2 > 0)).transpose()
-    # modified_hausdorff =  ModHausdorffDist(coordinates1, coordinates2)[0]
-
-    return directed_hausdorff(coordinates1, coordinates2)[0]
-
-# Too calculation intensive for now
-def ModHausdorffDist(A,B):
-    #This function computes the Modified Hausdorff Distance (MHD) which is
-    #proven to function better than the directed HD as per Dubuisson et al.
-    #in the following work:
-    #
-    #M. P. Dubuisson and A. K. Jain. A Modified Hausdorff distance for object
-    #matching. In ICPR94, pages A:566-568, Jerusalem, Israel, 1994.
-    #http://ieeexplore.ieee.org/xpls/abs_all.jsp?arnumber=576361
-    #
-    #The function computed the forward and reverse distances and outputs the
-    #maximum/minimum of both.
-    #Optionally, the function can return forward and reverse distance.
-    #
-    #Format for calling function:
-    #
-    #[MHD,FHD,RHD] = ModHausdorffDist(A,B);
-    #
-    #where
-    #MHD = Modified Hausdorff Distance.
-    #FHD = Forward Hausdorff Distance: minimum distance from all points of B
-    #      to a point in A, averaged for all A
-    #RHD = Reverse Hausdorff Distance: minimum distance from all points of A
-    #      to a point in B, averaged for all B
-    #A -> Point set 1, [row as observations, and col as dimensions]
-    #B -> Point set 2, [row as observations, and col as dimensions]
-    #
-    #No. of samples of each point set may be different but the dimension of
-    #the points must be the same.
-    #
-    #Edward DongBo Cui Stanford University; 06/17/2014
-
-    # Find pairwise distance
-    D_mat = np.sqrt(inner1d(A,A)[np.newaxis].T + inner1d(B,B)-2*(np.dot(A,B.T)))
-    # Calculating the forward HD: mean(min(each col))
-    FHD = np.mean(np.min(D_mat,axis=1))
-    # Calculating the reverse HD: mean(min(each row))
-    RHD = np.mean(np.min(D_mat,axis=0))
-    # Calculating mhd
-    MHD = np.max(np.array([FHD, RHD]))
-    return(MHD, FHD, RHD)
+    return hausdorff_metrics(data1 > 0, data2 > 0)['modified_hausdorff']
+
+def plot_visual_check(visual_check):
+    """
+    Figure comparing the centre slices of GT and prediction of every subject
+    :param visual_check: dict with 'ground_truth' [n, x, y], 'prediction' [n, x, y] and 'ids' (list or None)
+    :return: figure
+    """
+    plt.switch_backend('agg')
+    n_subjects = visual_check['ground_truth'].shape[0]
+    ncol = 14
+    nrow = 2 * (n_subjects // ncol) + 2
+    figure = plt.figure(figsize=(ncol+1, nrow+1))
+    gs = gridspec.GridSpec(nrow, ncol,
+             wspace=0.7, hspace=0.25,
+             top=1.-0.5/(nrow+1), bottom=0.5/(nrow+1),
+             left=0.5/(ncol+1), right=1-0.5/(ncol+1))
+
+    for subj in range(n_subjects):
+        if visual_check['ids'] is not None: subj_id = visual_check['ids'][subj]
+        else : subj_id = None
+        visual_compare_slices(visual_check['ground_truth'][subj], visual_check['prediction'][subj], subj, gs,
+                              image_id = subj_id)
+    return figure
+
+def save_visual_check(visual_check, figure_path):
+    figure = plot_visual_check(visual_check)
+    figure.savefig(figure_path, dpi='figure')
+    plt.close(figure)
 
 # draw GT and test image on canvas
 def visual_compare(GT, pred, n_images, i_image, n_z, gs, image_id = None):
     center_z = (n_z - 1) // 2
+    visual_compare_slices(GT[:, :, center_z], pred[:, :, center_z], i_image, gs, image_id = image_id)
+
+def visual_compare_slices(GT_slice, pred_slice, i_image, gs, image_id = None):
     i_line = 2 * (i_image // gs.get_geometry()[1])
     i_row = i_image % gs.get_geometry()[1]
 
     # plot GT image
     ax = plt.subplot(gs[i_line, i_row])
     if image_id is not None: ax.set_title(image_id, fontdict={'fontsize': 10})
-    plt.imshow(-GT[:, :, center_z].T)
+    plt.imshow(-GT_slice.T)
     plt.gca().invert_yaxis()
     plt.set_cmap('Greys')
     plt.clim(-1, 0)
@@ -248,7 +365,7 @@ def visual_compare(GT, pred, n_images, i_image, n_z, gs, image_id = None):
 
     # plot reconstructed image
     ax = plt.subplot(gs[i_line + 1, i_row])
-    plt.imshow(pred[:, :, center_z].T)
+    plt.imshow(pred_slice.T)
     plt.gca().invert_yaxis()
     plt.set_cmap('jet')
     plt.clim(0, 1)
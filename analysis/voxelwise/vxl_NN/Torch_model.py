@@ -4,14 +4,33 @@ from torch import nn, Tensor, optim, cuda, device
 from torch.multiprocessing import cpu_count
 from torch.utils.data import TensorDataset, DataLoader
 from sklearn.metrics import roc_curve, auc
+from utils import PRECISION
+
+class StreamLoader():
+    """
+    Re-iterable loader over a stream of fold batches (X_batch, y_batch, positions)
+    Every fold batch is split into torch batches of batch_size, only one fold batch is in memory at a time
+    """
+    def __init__(self, batches, batch_size, sample_shape):
+        self.batches = batches
+        self.batch_size = batch_size
+        self.sample_shape = sample_shape
+
+    def __iter__(self):
+        for X_batch, y_batch, _ in self.batches:
+            ds = TensorDataset(Tensor(X_batch.reshape((-1,) + self.sample_shape)), Tensor(y_batch))
+            for inputs, labels in DataLoader(ds, batch_size=self.batch_size, pin_memory=True):
+                yield inputs, labels
 
 class Torch_model():
     """
     """
 
-    def __init__(self, fold_dir, fold_name, model = None, n_channels = 4, rf_dim = 1, n_epochs = 100):
+    def __init__(self, fold_dir, fold_name, model = None, n_channels = 4, rf_dim = 1, n_epochs = 100, streaming = False):
         super(Torch_model, self).__init__()
         self.model = model
+        # streaming models are trained on the batches of the fold without materialising it
+        self.streaming = streaming
         self.optimizer = optim.Adam(self.model.parameters())
         self.n_channels = n_channels
         self.rf_width = 2 * np.max(rf_dim) + 1
@@ -23,6 +42,8 @@ class Torch_model():
         self.X_test = None
         self.y_test = None
         self.test_index = 0
+        self.train_batches = None
+        self.test_batches = None
 
         self.fold_dir = fold_dir
         self.fold_name = fold_name
@@ -43,12 +64,12 @@ class Torch_model():
     def get_settings():
         return {}
 
-    def initialise_train_data(self, n_datapoints, data_dimensions):
-        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_train = np.empty(np.sum(n_datapoints))
+    def initialise_train_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_train = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.train_index = 0
 
-    def add_train_data(self, batch_X_train, batch_y_train):
+    def add_train_data(self, batch_X_train, batch_y_train, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of training data to the whole training data pool
 
@@ -60,12 +81,12 @@ class Torch_model():
         self.y_train[self.train_index : self.train_index + batch_y_train.shape[0]] = batch_y_train
         self.train_index += batch_X_train.shape[0]
 
-    def initialise_test_data(self, n_datapoints, data_dimensions):
-        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_test = np.empty(np.sum(n_datapoints))
+    def initialise_test_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_test = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.test_index = 0
 
-    def add_test_data(self, batch_X_test, batch_y_test):
+    def add_test_data(self, batch_X_test, batch_y_test, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of testing data to the whole testing data pool
         All testing data is saved in a svmlight file
@@ -74,6 +95,18 @@ class Torch_model():
         self.y_test[self.test_index : self.test_index + batch_y_test.shape[0]] = batch_y_test
         self.test_index += batch_X_test.shape[0]
 
+    def initialise_train_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        """
+        Use a stream of training batches instead of materialising the training data
+
+        Args:
+            batches: FoldBatches yielding (X_batch, y_batch, positions)
+        """
+        self.train_batches = batches
+
+    def initialise_test_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.test_batches = batches
+
     def forward(self, model, dl, optimizer=None):
         total_acc = 0
         total_loss = 0
@@ -103,16 +136,15 @@ class Torch_model():
 
     def train(self):
         self.model.to(self.device)
-        ds_train = TensorDataset(
-            Tensor(self.X_train.reshape(-1, self.n_channels, self.rf_width, self.rf_width, self.rf_width)),
-            Tensor(self.y_train)
-            )
-        ds_test = TensorDataset(
-            Tensor(self.X_test.reshape(-1, self.n_channels, self.rf_width, self.rf_width, self.rf_width)),
-            Tensor(self.y_test)
-            )
-        dl_train = DataLoader(ds_train, batch_size=128, num_workers=cpu_count(), pin_memory=True)
-        dl_test = DataLoader(ds_test, batch_size=1024, num_workers=cpu_count(), pin_memory=True)
+        sample_shape = (self.n_channels, self.rf_width, self.rf_width, self.rf_width)
+        if self.train_batches is not None:
+            dl_train = StreamLoader(self.train_batches, 128, sample_shape)
+            dl_test = StreamLoader(self.test_batches, 1024, sample_shape)
+        else:
+            ds_train = TensorDataset(Tensor(self.X_train.reshape((-1,) + sample_shape)), Tensor(self.y_train))
+            ds_test = TensorDataset(Tensor(self.X_test.reshape((-1,) + sample_shape)), Tensor(self.y_test))
+            dl_train = DataLoader(ds_train, batch_size=128, num_workers=cpu_count(), pin_memory=True)
+            dl_test = DataLoader(ds_test, batch_size=1024, num_workers=cpu_count(), pin_memory=True)
         train = {'loss': [], 'auc': [], 'acc': []}
         eval = {'loss': [], 'auc': [], 'acc': []}
         for e in range(self.n_epochs):
@@ -134,8 +166,12 @@ class Torch_model():
         return probas_
 
     def predict_test_data(self):
+        if self.test_batches is not None:
+            return np.concatenate([self.predict(X_batch) for X_batch, _, _ in self.test_batches] + [np.empty(0)])
         probas_ = self.predict(self.X_test)
         return probas_
 
     def get_test_labels(self):
+        if self.test_batches is not None:
+            return self.test_batches.labels()
         return self.y_test
@@ -1,5 +1,6 @@
 import os
 import numpy as np
+from utils import PRECISION
 
 class Continuous_Model():
     """
@@ -38,8 +39,8 @@ class Continuous_Model():
         :param n_images: number of whole images in train dataset
         :param image_spatial_dimensions: (x, y, z) of a whole image
         '''
-        self.X_train = np.empty([np.sum(n_datapoints), data_point_dimensions])
-        self.y_train = np.empty(np.sum(n_datapoints))
+        self.X_train = np.empty([np.sum(n_datapoints), data_point_dimensions], dtype=PRECISION['inputs'])
+        self.y_train = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         # position indices keep track of where the data was stored spatially
         self.position_indices_train = np.zeros(((n_images,) + image_spatial_dimensions))
         self.train_voxel_index = 0; self.train_image_index = 0
@@ -67,8 +68,8 @@ class Continuous_Model():
         :param n_images: number of whole images in test dataset
         :param image_spatial_dimensions: (x, y, z) of a whole image
         '''
-        self.X_test = np.empty([np.sum(n_datapoints), data_point_dimensions])
-        self.y_test = np.empty(np.sum(n_datapoints))
+        self.X_test = np.empty([np.sum(n_datapoints), data_point_dimensions], dtype=PRECISION['inputs'])
+        self.y_test = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         # position indices keep track of where the data was stored spatially
         self.position_indices_test = np.zeros(((n_images,) + image_spatial_dimensions))
         self.test_voxel_index = 0; self.test_image_index = 0
@@ -1,13 +1,17 @@
 import numpy as np
+from utils import PRECISION
 
 
 class Glm():
     """
     """
 
-    def __init__(self, fold_dir, fold_name, model=None, pre_trained=False):
+    def __init__(self, fold_dir, fold_name, model=None, pre_trained=False, streaming=False, n_epochs=1):
         super().__init__()
         self.model = model
+        # streaming models are trained incrementally (partial_fit) on the batches of the fold
+        self.streaming = streaming
+        self.n_epochs = n_epochs
         self.trained_model = None
         if pre_trained:
             self.trained_model = model
@@ -18,6 +22,8 @@ class Glm():
         self.X_test = None
         self.y_test = None
         self.test_index = 0
+        self.train_batches = None
+        self.test_batches = None
 
         self.fold_dir = fold_dir
         self.fold_name = fold_name
@@ -31,8 +37,8 @@ class Glm():
         return {}
 
     def initialise_train_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
-        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_train = np.empty(np.sum(n_datapoints))
+        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_train = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.train_index = 0
 
     def add_train_data(self, batch_X_train, batch_y_train, batch_positional_indices = None, batch_n_images = None):
@@ -48,8 +54,8 @@ class Glm():
         self.train_index += batch_X_train.shape[0]
 
     def initialise_test_data(self, n_datapoints, data_dimensions,  n_images = None, image_spatial_dimensions = None):
-        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_test = np.empty(np.sum(n_datapoints))
+        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_test = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.test_index = 0
 
     def add_test_data(self, batch_X_test, batch_y_test, batch_positional_indices = None, batch_n_images = None):
@@ -61,6 +67,18 @@ class Glm():
         self.y_test[self.test_index : self.test_index + batch_y_test.shape[0]] = batch_y_test
         self.test_index += batch_X_test.shape[0]
 
+    def initialise_train_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        """
+        Use a stream of training batches instead of materialising the training data
+
+        Args:
+            batches: FoldBatches yielding (X_batch, y_batch, positions)
+        """
+        self.train_batches = batches
+
+    def initialise_test_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.test_batches = batches
+
     def train(self):
         """
         Train the model on the training data that is available
@@ -68,7 +86,13 @@ class Glm():
         :return: trained_threshold - threshold to use on predicted probabilities
         :return: evals - array of train evaluation metrics
         """
-        self.trained_model = self.model.fit(self.X_train, self.y_train)
+        if self.train_batches is not None:
+            for epoch in range(self.n_epochs):
+                for X_batch, y_batch, _ in self.train_batches:
+                    self.model.partial_fit(X_batch, y_batch, classes = [0, 1])
+            self.trained_model = self.model
+        else:
+            self.trained_model = self.model.fit(self.X_train, self.y_train)
 
         # default threshold for logistic regression is 0.5, determining it through analysis of test data exacerbates overfitting
         # https://stackoverflow.com/questions/31417487/sklearn-logisticregression-and-changing-the-default-threshold-for-classification?rq=1
@@ -81,8 +105,12 @@ class Glm():
         return probas_[:, 1]
 
     def predict_test_data(self):
+        if self.test_batches is not None:
+            return np.concatenate([self.predict(X_batch) for X_batch, _, _ in self.test_batches] + [np.empty(0)])
         probas_ = self.predict(self.X_test)
         return probas_
 
     def get_test_labels(self):
+        if self.test_batches is not None:
+            return self.test_batches.labels()
         return self.y_test
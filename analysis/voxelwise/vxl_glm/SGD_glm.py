@@ -0,0 +1,30 @@
+from .Glm import Glm
+from sklearn import linear_model
+from sklearn.base import clone
+
+N_EPOCHS = 5
+base_model = linear_model.SGDClassifier(loss = 'log_loss', verbose = 0, random_state = 0)
+
+class SGD_glm(Glm):
+    """
+    Logistic regression trained by stochastic gradient descent
+    The model is trained incrementally on the streamed batches of a fold, so that the fold is never materialised
+    """
+    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1, model=None):
+        if model is None:
+            # every fold starts from an untrained model as partial_fit continues training
+            super().__init__(fold_dir, fold_name, clone(base_model), streaming=True, n_epochs=N_EPOCHS)
+        else:
+            print('Loading from saved model')
+            super().__init__(fold_dir, fold_name, model, pre_trained=True)
+
+
+    @staticmethod
+    def hello_world():
+        print('SGD Logistic Regression GLM Model')
+
+    @staticmethod
+    def get_settings():
+        settings = base_model.get_params()
+        settings['n_epochs'] = N_EPOCHS
+        return settings
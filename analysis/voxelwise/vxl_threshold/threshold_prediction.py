@@ -5,6 +5,7 @@ import numpy as np
 from RAPID_model import RAPID_Model_Generator
 from Tmax6 import Tmax6_Model_Generator
 import data_loader, visual
+from utils import rescale_outliers
 import scoring_utils
 from scipy.ndimage.morphology import binary_closing, binary_erosion, binary_dilation
 
@@ -19,30 +20,6 @@ def smooth_prediction(prediction):
     # flat_smooth_pred = smooth_pred[data_positions == 1].reshape(-1)
     return smooth_pred
 
-def rescale_outliers(imgX, MASKS):
-    '''
-    Rescale outliers as some images from RAPID seem to be scaled x10
-    Outliers are detected if their median exceeds 5 times the global median and are rescaled by dividing through 10
-    :param imgX: image data (n, x, y, z, c)
-    :return: rescaled_imgX
-    '''
-    median_c0 = np.median(imgX[..., 0][MASKS])
-    median_c1 = np.median(imgX[..., 1][MASKS])
-    median_c2 = np.median(imgX[..., 2][MASKS])
-    median_c3 = np.median(imgX[..., 3][MASKS])
-    for i in range(imgX.shape[0]):
-        if np.median(imgX[i, ..., 0][MASKS[i]]) > 5 * median_c0:
-            imgX[i, ..., 0] = imgX[i, ..., 0] / 10
-        if np.median(imgX[i, ..., 1][MASKS[1]]) > 5 * median_c1:
-            imgX[i, ..., 1] = imgX[i, ..., 1] / 10
-        if np.median(imgX[i, ..., 2][MASKS[i]]) > 5 * median_c2:
-            imgX[i, ..., 2] = imgX[i, ..., 2] / 10
-        if np.median(imgX[i, ..., 3][MASKS[i]]) > 5 * median_c3:
-            imgX[i, ..., 3] = imgX[i, ..., 3] / 10
-
-    return imgX
-
-
 main_dir = '/Users/julian/master/data/all2016_subset_prepro'
 data_dir = os.path.join(main_dir, '')
 
@@ -100,7 +77,7 @@ accuracy = np.median(results['accuracy'])
 roc_auc = np.median(results['roc_auc'])
 f1 = np.median(results['f1'])
 dice = np.median([item for item in results['image_wise_dice']])
-hausdorff_distance = np.median([item for item in results['image_wise_hausdorff']])
+hausdorff_distance = np.nanmedian([item for item in results['image_wise_hausdorff']])
 
 print('Results for', subj_id)
 print('Voxel-wise accuracy: ', accuracy)
@@ -1,6 +1,7 @@
 import os
 import xgboost as xgb
 import numpy as np
+from utils import PRECISION
 
 PARAMS = {
     'eval_metric': 'auc',
@@ -41,8 +42,8 @@ class Default_ram_xgb():
         return PARAMS
 
     def initialise_train_data(self, n_datapoints, data_dimensions):
-        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_train = np.empty(np.sum(n_datapoints))
+        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_train = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.train_index = 0
 
     def add_train_data(self, batch_X_train, batch_y_train):
@@ -58,8 +59,8 @@ class Default_ram_xgb():
         self.train_index += batch_X_train.shape[0]
 
     def initialise_test_data(self, n_datapoints, data_dimensions):
-        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_test = np.empty(np.sum(n_datapoints))
+        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_test = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.test_index = 0
 
     def add_test_data(self, batch_X_test, batch_y_test):
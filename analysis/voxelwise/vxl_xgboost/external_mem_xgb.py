@@ -1,15 +1,20 @@
 import os
 import xgboost as xgb
 from vxl_xgboost.xgb_params import XGB_PARAMS
-from ext_mem_utils import save_to_svmlight
+from vxl_xgboost.xgb_data_iter import BatchIter
+from ext_mem_utils import SvmlightWriter, BlockStore
 
 
 class External_Memory_xgb():
     """
     External Memory: saves the folds as libsvm files and uses the external memory version of xgboost to avoid overloading the RAM
+    With ext_mem_format = 'binary' the folds are saved as blocks of float32 rows instead (see ext_mem_utils.BlockStore)
+    and passed to xgboost through a data iterator over the memory mapped blocks
     """
-    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1):
+    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1, ext_mem_format = 'svmlight'):
         super(External_Memory_xgb, self).__init__()
+        if ext_mem_format not in ['svmlight', 'binary']:
+            raise ValueError('External memory format should be svmlight or binary and not', ext_mem_format)
         self.params = XGB_PARAMS
         self.n_estimators = self.params['n_estimators']
         self.evals_result = {}
@@ -18,8 +23,13 @@ class External_Memory_xgb():
         self.dtest = None
 
         self.ext_mem_extension = '.txt'
+        self.ext_mem_format = ext_mem_format
         self.fold_dir = fold_dir
         self.fold_name = fold_name
+        self.train_store = None
+        self.test_store = None
+        self.train_writer = None
+        self.test_writer = None
 
     @staticmethod
     def hello_world():
@@ -31,10 +41,14 @@ class External_Memory_xgb():
     def get_settings():
         return XGB_PARAMS
 
-    def initialise_train_data(self, n_datapoints, data_dimensions):
-        print()
+    def initialise_train_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        if self.ext_mem_format == 'binary':
+            self.train_store = BlockStore(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_train'))
+        else:
+            self.train_writer = SvmlightWriter(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_train'
+                                                            + self.ext_mem_extension)).open()
 
-    def add_train_data(self, batch_X_train, batch_y_train):
+    def add_train_data(self, batch_X_train, batch_y_train, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of training data to the whole training data pool
         All training data is saved in a svmlight file
@@ -43,21 +57,36 @@ class External_Memory_xgb():
             batch_X_train: batch of training data
             batch_y_train: batch of training labels
         """
-        train_data_path = os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_train' + self.ext_mem_extension)
-        save_to_svmlight(batch_X_train, batch_y_train, train_data_path)
-
-    def initialise_test_data(self, n_datapoints, data_dimensions):
-        print()
-
-    def add_test_data(self, batch_X_test, batch_y_test):
+        if self.ext_mem_format == 'binary':
+            self.train_store.append(batch_X_train, batch_y_train)
+            return
+        self.train_writer.write(batch_X_train, batch_y_train)
+
+    def initialise_test_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        if self.ext_mem_format == 'binary':
+            self.test_store = BlockStore(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_test'))
+        else:
+            self.test_writer = SvmlightWriter(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_test'
+                                                           + self.ext_mem_extension)).open()
+
+    def add_test_data(self, batch_X_test, batch_y_test, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of testing data to the whole testing data pool
         All testing data is saved in a svmlight file
         """
-        test_data_path = os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_test' + self.ext_mem_extension)
-        save_to_svmlight(batch_X_test, batch_y_test, test_data_path)
+        if self.ext_mem_format == 'binary':
+            self.test_store.append(batch_X_test, batch_y_test)
+            return
+        self.test_writer.write(batch_X_test, batch_y_test)
 
     def train(self):
+        if self.ext_mem_format == 'binary':
+            return self.train_binary()
+
+        # all data has been added: write the remaining buffered lines before xgboost reads the files
+        self.train_writer.close()
+        self.test_writer.close()
+
         self.dtrain = xgb.DMatrix(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_train' + self.ext_mem_extension)
             + '#' + os.path.join(self.fold_dir, 'dtrain.cache'))
         self.dtest = xgb.DMatrix(os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_test' + self.ext_mem_extension)
@@ -81,9 +110,26 @@ class External_Memory_xgb():
 
         return self.trained_model, self.evals_result
 
+    def train_binary(self):
+        # xgboost needs at least one batch to build a DMatrix from an iterator
+        if len(self.train_store) == 0 or len(self.test_store) == 0:
+            raise ValueError('Binary external memory needs at least one non empty train and test batch',
+                             len(self.train_store), len(self.test_store))
+        self.dtrain = xgb.DMatrix(BatchIter(self.train_store, os.path.join(self.fold_dir, 'dtrain')))
+        self.dtest = xgb.DMatrix(BatchIter(self.test_store, os.path.join(self.fold_dir, 'dtest')))
+
+        self.trained_model = xgb.train(self.params, self.dtrain,
+            num_boost_round = self.n_estimators,
+            evals = [(self.dtest, 'eval'), (self.dtrain, 'train')],
+            early_stopping_rounds = 30,
+            evals_result = self.evals_result,
+            verbose_eval = False)
+
+        return self.trained_model, self.evals_result
+
     def predict(self, data):
         probas_ = self.trained_model.predict(data,
-                    ntree_limit = self.trained_model.best_ntree_limit)
+                    iteration_range = (0, self.trained_model.best_iteration + 1))
         return probas_
 
     def predict_test_data(self):
@@ -93,3 +139,19 @@ class External_Memory_xgb():
     def get_test_labels(self):
         y_test = self.dtest.get_label()
         return y_test
+
+
+class Binary_External_Memory_xgb(External_Memory_xgb):
+    """
+    External Memory xgb saving the folds in the binary block format
+    """
+    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1):
+        super(Binary_External_Memory_xgb, self).__init__(fold_dir, fold_name, n_channels = n_channels,
+                                                         n_channels_out = n_channels_out, rf = rf,
+                                                         ext_mem_format = 'binary')
+
+    @staticmethod
+    def hello_world():
+        print('Binary External Memory XGB Model')
+        print(XGB_PARAMS)
+        print('Attention! Folds will not be saved.')
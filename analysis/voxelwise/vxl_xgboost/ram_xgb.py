@@ -2,12 +2,16 @@ import os
 import xgboost as xgb
 import numpy as np
 from vxl_xgboost.xgb_params import XGB_PARAMS
+from vxl_xgboost.xgb_data_iter import BatchIter
+from utils import PRECISION
 
 class Ram_xgb():
     """
     """
-    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1):
+    def __init__(self, fold_dir, fold_name, n_channels = 4, n_channels_out = 1, rf = 1, streaming = False):
         super(Ram_xgb, self).__init__()
+        # streaming models build their DMatrix from the batches of the fold through an external memory iterator
+        self.streaming = streaming
         self.params = XGB_PARAMS
         self.n_estimators = self.params['n_estimators']
         self.evals_result = {}
@@ -21,6 +25,8 @@ class Ram_xgb():
         self.X_test = None
         self.y_test = None
         self.test_index = 0
+        self.train_batches = None
+        self.test_batches = None
 
         self.ext_mem_extension = '.txt'
         self.fold_dir = fold_dir
@@ -35,12 +41,12 @@ class Ram_xgb():
     def get_settings():
         return XGB_PARAMS
 
-    def initialise_train_data(self, n_datapoints, data_dimensions):
-        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_train = np.empty(np.sum(n_datapoints))
+    def initialise_train_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.X_train = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_train = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.train_index = 0
 
-    def add_train_data(self, batch_X_train, batch_y_train):
+    def add_train_data(self, batch_X_train, batch_y_train, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of training data to the whole training data pool
 
@@ -52,12 +58,12 @@ class Ram_xgb():
         self.y_train[self.train_index : self.train_index + batch_y_train.shape[0]] = batch_y_train
         self.train_index += batch_X_train.shape[0]
 
-    def initialise_test_data(self, n_datapoints, data_dimensions):
-        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions])
-        self.y_test = np.empty(np.sum(n_datapoints))
+    def initialise_test_data(self, n_datapoints, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.X_test = np.empty([np.sum(n_datapoints), data_dimensions], dtype=PRECISION['inputs'])
+        self.y_test = np.empty(np.sum(n_datapoints), dtype=PRECISION['labels'])
         self.test_index = 0
 
-    def add_test_data(self, batch_X_test, batch_y_test):
+    def add_test_data(self, batch_X_test, batch_y_test, batch_positional_indices = None, batch_n_images = None):
         """
         Add a batch of testing data to the whole testing data pool
         All testing data is saved in a svmlight file
@@ -66,10 +72,30 @@ class Ram_xgb():
         self.y_test[self.test_index : self.test_index + batch_y_test.shape[0]] = batch_y_test
         self.test_index += batch_X_test.shape[0]
 
-    def train(self):
-        self.dtrain = xgb.DMatrix(self.X_train, self.y_train)
+    def initialise_train_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        """
+        Use a stream of training batches instead of materialising the training data
+
+        Args:
+            batches: FoldBatches yielding (X_batch, y_batch, positions)
+        """
+        self.train_batches = batches
+
+    def initialise_test_stream(self, batches, data_dimensions, n_images = None, image_spatial_dimensions = None):
+        self.test_batches = batches
 
-        if self.y_test.size > 0:
+    def train(self):
+        if self.train_batches is not None:
+            self.dtrain = xgb.DMatrix(BatchIter(self.train_batches,
+                                                os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_dtrain')))
+        else:
+            self.dtrain = xgb.DMatrix(self.X_train, self.y_train)
+
+        if self.test_batches is not None and self.test_batches.n_datapoints > 0:
+            self.dtest = xgb.DMatrix(BatchIter(self.test_batches,
+                                               os.path.join(self.fold_dir, 'fold_' + str(self.fold_name) + '_dtest')))
+            evals = [(self.dtest, 'eval'), (self.dtrain, 'train')]
+        elif self.test_batches is None and self.y_test.size > 0:
             self.dtest = xgb.DMatrix(self.X_test, self.y_test)
             evals = [(self.dtest, 'eval'), (self.dtrain, 'train')]
         else :
@@ -0,0 +1,26 @@
+import xgboost as xgb
+
+
+class BatchIter(xgb.DataIter):
+    """
+    xgboost data iterator over a stream of batches (ie. FoldBatches yielding (X_batch, y_batch, positions))
+    xgboost iterates over the batches as many times as it needs, a DMatrix built from it never holds the whole fold
+    in memory: the batches are paged to cache files starting with cache_prefix (requires xgboost >= 1.5)
+    """
+    def __init__(self, batches, cache_prefix):
+        self.batches = batches
+        self.iterator = None
+        super(BatchIter, self).__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.iterator is None:
+            self.iterator = iter(self.batches)
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            return 0
+        input_data(data=batch[0], label=batch[1])
+        return 1
+
+    def reset(self):
+        self.iterator = None
@@ -36,7 +36,7 @@ mask_data = MASKS[subj_index]
 print('input shape', input_data.shape)
 
 if feature_scaling == True:
-    input_data, CLIN = standardise(input_data, CLIN)
+    input_data, CLIN = standardise(input_data, CLIN, mask_data)
 
 rf_dim = [rf, rf, rf]
 n_x, n_y, n_z, n_c = input_data.shape
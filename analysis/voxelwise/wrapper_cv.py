@@ -1,19 +1,24 @@
 import sys, shutil
 sys.path.insert(0, '../')
 
-import os, timeit, traceback, torch
+import os, timeit, traceback, json, multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import matplotlib.pyplot as plt
 from email_notification import NotificationSystem
-from voxelwise.cv_framework import repeated_kfold_cv
+from voxelwise.cv_framework import repeated_kfold_cv, share_arrays, load_shared_arrays
+from voxelwise.preprocessing_pipeline import PreprocessingPipeline
+from utils import gaussian_scale_space
 from voxelwise.figures.train_test_evaluation import wrapper_plot_train_evaluation
 from voxelwise.figures.plot_ROC import plot_roc
+from voxelwise.results_store import ResultsStore, save_legacy_results
 
 notification_system = NotificationSystem()
 
 def launch_cv(model_name, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
               feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
-                n_repeats, n_folds, main_save_dir, main_output_dir):
+                n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = None, n_jobs = 1, preprocessed = False,
+                seed = None, render_figures = True, resume = False, fold_preprocessing = True, preprocessing_state = None):
 
     if not os.path.exists(main_output_dir):
         os.makedirs(main_output_dir)
@@ -22,11 +27,9 @@ def launch_cv(model_name, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
     if os.path.exists(output_dir):
         # file exists
         print('This model already has saved output ', output_dir)
-        validation = input('Type `yes` if you wish to delete your previous model:\t')
-        if (validation != 'yes'):
-            raise ValueError('Model already has saved data. Choose another model name or delete current model')
-        else:
-            shutil.rmtree(output_dir)
+        if not resume:
+            raise ValueError('Model already has saved data. Choose another model name, delete current model or resume it')
+        print('Resuming', model_name)
 
     print('Evaluating', model_name, 'with rf:', rf_dim)
 
@@ -40,25 +43,23 @@ def launch_cv(model_name, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
             os.makedirs(visual_dir)
 
         def save(results, trained_models, figures):
-            # save the results and the params objects
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            torch.save(results, os.path.join(output_dir, 'scores_' + model_name + '.npy'))
-            torch.save(results['params'], os.path.join(output_dir, 'params_' + model_name + '.npy'))
-            torch.save(trained_models, os.path.join(output_dir, 'trained_models_' + model_name + '.npy'))
-            wrapper_plot_train_evaluation(os.path.join(output_dir, 'scores_' + model_name + '.npy'), save_plot = True)
-            plot_roc(results['test_TPR'], results['test_FPR'], output_dir, model_name, save_plot = True)
-
+            # results of every fold are appended to the results store by repeated_kfold_cv,
+            # only save figures of new folds, saved figures are released
+            # (figures are None if rendering is deferred to figures/visual_check.py)
             plt.ioff()
             plt.switch_backend('agg')
             for i, figure in enumerate(figures):
+                if figure is None:
+                    continue
                 figure_path = os.path.join(visual_dir, model_name + '_test_predictions_fold_' + str(i))
                 figure.savefig(figure_path, dpi='figure')
                 plt.close(figure)
+                figures[i] = None
 
         return save
 
     save_function = saveGenerator(output_dir, model_name)
+    results_store = ResultsStore(os.path.join(output_dir, 'results_store'))
 
     try:
         start = timeit.default_timer()
@@ -69,14 +70,26 @@ def launch_cv(model_name, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
             feature_scaling = feature_scaling, pre_smoothing = pre_smoothing, channels_to_normalise = channels_to_normalise,
             undef_normalisation = undef_normalisation,
             receptive_field_dimensions = rf_dim, n_repeats = n_repeats, n_folds = n_folds,
-            messaging = notification_system)
+            messaging = notification_system, rf_cache_dir = rf_cache_dir, n_jobs = n_jobs, preprocessed = preprocessed,
+            seed = seed, render_figures = render_figures, results_store = results_store, resume = resume,
+            fold_preprocessing = fold_preprocessing, preprocessing_state = preprocessing_state)
+
+        # save the results, params and trained models as single files and plot them once all folds are done
+        save_legacy_results(output_dir, model_name, results, trained_models)
+        wrapper_plot_train_evaluation(os.path.join(output_dir, 'scores_' + model_name + '.npy'), save_plot = True)
+        plot_roc(results['test_TPR'], results['test_FPR'], output_dir, model_name, save_plot = True)
+        if not render_figures:
+            print('Visual check figures were not rendered. Render them with: python',
+                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figures', 'visual_check.py'),
+                  os.path.abspath(output_dir), model_name)
 
         accuracy = np.median(results['test_accuracy'])
         roc_auc = np.median(results['test_roc_auc'])
         f1 = np.median(results['test_f1'])
         positive_predictive_value = np.median(results['test_positive_predictive_value'])
         dice = np.median([item for sublist in results['test_image_wise_dice'] for item in sublist])
-        hausdorff_distance = np.median([item for sublist in results['test_image_wise_hausdorff'] for item in sublist])
+        # undefined distances (only one of prediction and ground truth empty) are nan and left out
+        hausdorff_distance = np.nanmedian([item for sublist in results['test_image_wise_hausdorff'] for item in sublist])
         params = results['params']
         if not None in results['test_penumbra_metrics']['predicted_in_penumbra_ratio']:
             predicted_in_penumbra_ratio = np.median(results['test_penumbra_metrics']['predicted_in_penumbra_ratio'])
@@ -118,7 +131,8 @@ def launch_cv(model_name, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
 
 def rf_hyperopt(model_name, Model_Generator, IN, OUT, CLIN, MASKS, IDS,
                 feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation, flat_rf,
-                n_repeats, n_folds, main_save_dir, main_output_dir, rf_hp_start, rf_hp_end):
+                n_repeats, n_folds, main_save_dir, main_output_dir, rf_hp_start, rf_hp_end, rf_cache_dir = None, n_jobs = 1,
+                seed = None, render_figures = True, resume = False):
     print('Running Hyperopt of rf in range:', rf_hp_start, rf_hp_end)
     for rf in range(rf_hp_start, rf_hp_end):
         rf_dim = [rf, rf, rf]
@@ -126,6 +140,180 @@ def rf_hyperopt(model_name, Model_Generator, IN, OUT, CLIN, MASKS, IDS,
         model_id = model_name + '_rf_' + str(rf)
         launch_cv(model_id, Model_Generator, rf_dim, IN, OUT, CLIN, MASKS, IDS,
                   feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
-                        n_repeats, n_folds, main_save_dir, main_output_dir)
+                        n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = rf_cache_dir, n_jobs = n_jobs,
+                        seed = seed, render_figures = render_figures, resume = resume)
 
     print('Hyperopt done.')
+
+def smoothing_sweep(model_name, Model_Generator, IN, OUT, CLIN, MASKS, IDS,
+                    feature_scaling, kernel_widths, threeD_smoothing, channels_to_normalise, undef_normalisation, rf_dim,
+                    n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = None, n_jobs = 1,
+                    seed = None, render_figures = True, resume = False, scale_space_cache_dir = None):
+    """
+    Evaluate a model on data smoothed with gaussian kernels of several widths
+    The data of every width is smoothed as with gaussian_smoothing (see utils.gaussian_scale_space) and can be
+    cached in scale_space_cache_dir, so that reruns and resumed sweeps do not smooth the data again.
+    Models are saved as <model_name>_scale_space_<2D|3D>_smooth_k<width>_rf_<rf>, apart from the models of rf_hyperopt
+
+    Args: as rf_hyperopt
+        kernel_widths: widths of the 2D or 3D gaussian kernels to evaluate
+        threeD_smoothing: smooth in all 3 spatial dimensions and not only on x, y planes
+        rf_dim: receptive field used for every kernel width [rf_x, rf_y, rf_z]
+        scale_space_cache_dir (optional): directory in which every smoothing level is cached
+    """
+    print('Running sweep of smoothing kernel widths:', sorted(kernel_widths))
+    if len(IN.shape) < 5:
+        IN = np.expand_dims(IN, axis=-1)
+    for kernel_width, smoothed_IN in gaussian_scale_space(IN, kernel_widths, threeD = threeD_smoothing, n_jobs = n_jobs,
+                                                          cache_dir = scale_space_cache_dir):
+        if threeD_smoothing:
+            model_id = model_name + '_scale_space_3D_smooth_k' + str(kernel_width)
+            pre_smoothing = (kernel_width, kernel_width, kernel_width)
+        else:
+            model_id = model_name + '_scale_space_2D_smooth_k' + str(kernel_width)
+            pre_smoothing = (kernel_width, kernel_width)
+        model_id += '_rf_' + str(max(rf_dim))
+        preprocessing_pipeline = PreprocessingPipeline(IN, CLIN, MASKS, feature_scaling = feature_scaling,
+                                                       pre_smoothing = pre_smoothing,
+                                                       channels_to_normalise = channels_to_normalise,
+                                                       smoothed_data = smoothed_IN)
+        launch_cv(model_id, Model_Generator, rf_dim, preprocessing_pipeline.subject_data, OUT, CLIN, MASKS, IDS,
+                  feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
+                  n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = rf_cache_dir, n_jobs = n_jobs,
+                  preprocessed = True, seed = seed, render_figures = render_figures, resume = resume,
+                  preprocessing_state = preprocessing_pipeline.subject_state())
+
+    print('Sweep done.')
+
+def rf_sweep(model_name, Model_Generator, IN, OUT, CLIN, MASKS, IDS,
+             feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation, flat_rf,
+             n_repeats, n_folds, main_save_dir, main_output_dir, rf_hp_start, rf_hp_end, n_parallel_rf = 2,
+             rf_cache_dir = None, seed = None, render_figures = True):
+    """
+    Hyperopt of the receptive field where the data is preprocessed only once and
+    several receptive fields are evaluated concurrently by separate processes
+
+    Progress of every rf is recorded in main_output_dir/<model_name>_rf_sweep.json
+    Restarting an interrupted sweep skips receptive fields that were already evaluated
+    and resumes the unfinished ones from their last saved fold (with the seed of the interrupted sweep)
+
+    Args: as rf_hyperopt
+        n_parallel_rf (optional, default 2): number of receptive fields evaluated at the same time
+        rf_cache_dir (optional): directory used to cache receptive fields (see repeated_kfold_cv)
+        seed (optional): seed of the crossvalidation of every receptive field (see repeated_kfold_cv)
+        render_figures (optional, default True): render the visual check figures during the sweep
+            (see repeated_kfold_cv), set to False to render them afterwards with figures/visual_check.py
+    """
+    print('Running sweep of rf in range:', rf_hp_start, rf_hp_end)
+    if not os.path.exists(main_output_dir):
+        os.makedirs(main_output_dir)
+
+    progress_path = os.path.join(main_output_dir, model_name + '_rf_sweep.json')
+    progress = {}
+    if os.path.exists(progress_path):
+        with open(progress_path, 'r') as progress_file:
+            progress = json.load(progress_file)
+        print('Resuming sweep. Already evaluated rf:', [rf for rf in progress if progress[rf]['status'] == 'done'])
+
+    def save_progress():
+        temp_path = progress_path + '.tmp'
+        with open(temp_path, 'w') as progress_file:
+            json.dump(progress, progress_file, indent=2)
+        os.replace(temp_path, progress_path)
+
+    # forked workers share the state of the global random generator: use one explicit seed for all receptive fields
+    # (unfinished receptive fields can only be resumed with the seed they were started with)
+    sweep_seeds = set(progress[rf]['seed'] for rf in progress if progress[rf].get('seed') is not None)
+    if seed is None and len(sweep_seeds) > 0:
+        seed = sweep_seeds.pop()
+    if seed is None:
+        seed = np.random.randint(0, high=2**31 - 1)
+
+    rf_to_evaluate = []
+    for rf in range(rf_hp_start, rf_hp_end):
+        if str(rf) in progress and progress[str(rf)]['status'] == 'done':
+            continue
+        model_id = model_name + '_rf_' + str(rf)
+        progress[str(rf)] = {'status': 'pending', 'model_id': model_id, 'seed': seed}
+        rf_to_evaluate.append(rf)
+    save_progress()
+
+    if len(rf_to_evaluate) == 0:
+        print('Sweep done.')
+        return
+
+    # Per-subject preprocessing is done once for all receptive fields and shared with the workers,
+    # the statistics of the preprocessing are fitted in every fold
+    preprocessing_pipeline = PreprocessingPipeline(IN, CLIN, MASKS, feature_scaling = feature_scaling,
+                                                   pre_smoothing = pre_smoothing,
+                                                   channels_to_normalise = channels_to_normalise, n_jobs = n_parallel_rf)
+    IN = preprocessing_pipeline.subject_data
+    preprocessing_state = preprocessing_pipeline.subject_state()
+    # the brain voxels of the state are shared with the data instead of being pickled for every rf
+    BRAIN_VALUES = preprocessing_state.pop('brain_values')
+    shared_dir = os.path.join(main_save_dir, model_name + '_rf_sweep_shared_data')
+    executor = None
+    rf_tasks = {}
+    try:
+        shared_data_paths = share_arrays(shared_dir, IN = IN, OUT = OUT, CLIN = CLIN, MASKS = MASKS, IDS = IDS,
+                                         BRAIN_VALUES = BRAIN_VALUES)
+
+        executor = ProcessPoolExecutor(max_workers = n_parallel_rf, mp_context = multiprocessing.get_context('fork'))
+        for rf in rf_to_evaluate:
+            rf_dim = [rf, rf, rf]
+            if flat_rf: rf_dim = [rf, rf, 0]
+            model_id = progress[str(rf)]['model_id']
+            rf_tasks[executor.submit(launch_shared_cv, shared_data_paths, model_id, Model_Generator, rf_dim,
+                                     feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
+                                     n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir, seed,
+                                     render_figures, resume = True, preprocessing_state = preprocessing_state)] = rf
+            progress[str(rf)]['status'] = 'submitted'
+        save_progress()
+
+        for rf_task in as_completed(rf_tasks):
+            rf = rf_tasks[rf_task]
+            try:
+                progress[str(rf)]['elapsed'] = rf_task.result()
+                progress[str(rf)]['status'] = 'done'
+            except Exception as e:
+                progress[str(rf)]['status'] = 'failed'
+                progress[str(rf)]['error'] = str(e)
+            save_progress()
+            n_done = len([r for r in progress if progress[r]['status'] == 'done'])
+            print('RF', rf, progress[str(rf)]['status'], '-', n_done, 'of', len(progress), 'receptive fields evaluated.')
+    except BaseException as e:
+        # receptive fields that were submitted but never completed are resumed by the next sweep
+        status = 'interrupted' if isinstance(e, KeyboardInterrupt) else 'failed'
+        for rf in rf_tasks.values():
+            if progress[str(rf)]['status'] == 'submitted':
+                progress[str(rf)]['status'] = status
+                progress[str(rf)]['error'] = repr(e)
+        save_progress()
+        raise
+    finally:
+        # release the workers and the shared copy of the data, also on errors and interruptions
+        if executor is not None:
+            executor.shutdown(cancel_futures = True)
+        shutil.rmtree(shared_dir, ignore_errors = True)
+
+    print('Sweep done.')
+
+def launch_shared_cv(shared_data_paths, model_id, Model_Generator, rf_dim,
+                     feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
+                     n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = None, seed = None,
+                     render_figures = True, resume = False, preprocessing_state = None):
+    """
+    Launch the crossvalidation of a receptive field on preprocessed data shared through memory maps
+    (preprocessing_state: state of the per-subject preprocessing of the shared data, see PreprocessingPipeline)
+    :return: elapsed time
+    """
+    start = timeit.default_timer()
+    shared_data = load_shared_arrays(shared_data_paths)
+    if preprocessing_state is not None and shared_data.get('BRAIN_VALUES') is not None:
+        preprocessing_state = dict(preprocessing_state, brain_values = shared_data['BRAIN_VALUES'])
+    launch_cv(model_id, Model_Generator, rf_dim, shared_data['IN'], shared_data['OUT'], shared_data['CLIN'],
+              shared_data['MASKS'], shared_data['IDS'],
+              feature_scaling, pre_smoothing, channels_to_normalise, undef_normalisation,
+              n_repeats, n_folds, main_save_dir, main_output_dir, rf_cache_dir = rf_cache_dir, preprocessed = True,
+              seed = seed, render_figures = render_figures, resume = resume, preprocessing_state = preprocessing_state)
+    return timeit.default_timer() - start
@@ -43,7 +43,7 @@ if len(IN.shape) < 5:
     IN = numpy.expand_dims(IN, axis=5)
 
 if feature_scaling == True:
-    IN, CLIN = standardise(IN, CLIN)
+    IN, CLIN = standardise(IN, CLIN, MASKS)
 
 train = numpy.full(IN.shape[0], True)
 test = numpy.full(IN.shape[0], False)
@@ -1,23 +1,7 @@
-import numpy as np
 import os, argparse, sys
 sys.path.insert(0, '../../../')
 from analysis import data_loader as dl
-
-def rescale_outliers(imgX, MASKS):
-    '''
-    Rescale outliers as some images from RAPID seem to be scaled x10
-    Outliers are detected if their median exceeds 5 times the global median and are rescaled by dividing through 10
-    :param imgX: image data (n, x, y, z, c)
-    :return: rescaled_imgX
-    '''
-
-    for i in range(imgX.shape[0]):
-        for channel in range(imgX.shape[-1]):
-            median_channel = np.median(imgX[..., channel][MASKS])
-            if np.median(imgX[i, ..., 0][MASKS[i]]) > 5 * median_channel:
-                imgX[i, ..., 0] = imgX[i, ..., channel] / 10
-
-    return imgX
+from analysis.utils import rescale_outliers
 
 
 def rescale_perfusion_maps_dataset(dataset_path, output_path=None):